@@ -1,16 +1,24 @@
 from operator import itemgetter
 import sqlite3
 from sqlite3 import Connection
-from typing import Callable, Iterable, Set, Tuple
+from functools import partial
+from io import TextIOBase
+from typing import Callable, Dict, Iterable, List, Set, TextIO, Tuple
+import warnings
 from zipfile import ZipFile
 from zlib import crc32
 
-from datasketch import MinHash, MinHashLSH, LeanMinHash
+from datasketch import HyperLogLog, MinHash, MinHashLSH, LeanMinHash
 from datasketch.hashfunc import sha1_hash32
-from mmh3 import hash as mmh3_hash
+from mmh3 import hash as mmh3_hash, hash64 as mmh3_hash64
+import numpy as np
 
-from copietje.normalizers import normalize_html, NORMALIZERS
-from copietje.tokenizers import tokenize_white_space, TOKENIZERS
+from copietje.normalizers import normalize_html, normalize_piece, NORMALIZERS, split_point
+from copietje.output import BUFFER_SIZE
+from copietje.sketches import LRUSketchStore, MAX_HASH, MERSENNE_PRIME, permutations as make_permutations, \
+    SketchStore
+from copietje.token_cache import DEFAULT_SIZE as DEFAULT_CACHE_SIZE, TOKEN_CACHES, TokenCache
+from copietje.tokenizers import produces_hashes, streaming_context, tokenize_batch, tokenize_white_space, TOKENIZERS
 
 
 # the module default is the simple white space tokenizer
@@ -30,7 +38,20 @@ HASH_FUNCTIONS = {
 }
 HASH_FUNCTIONS[''] = HASH_FUNCTIONS['sha1']
 
+
+def token_hash64(data: bytes) -> int:
+    # 64-bit hash of a token, keeping collisions between distinct tokens negligible for exact token sets
+    return mmh3_hash64(data, signed=False)[0]
+
+
 DEFAULT_PERMUTATIONS = 128
+# maximum number of tokens to permute at once, bounds the size of the (tokens, permutations) matrix
+BATCH_TOKENS = 1 << 14
+# default number of characters to read at once in Condenser.make_hash_stream
+CHUNK_SIZE = 1 << 20
+# precision of the HyperLogLog a HashAccumulator counts distinct tokens with (2 ** p registers of a byte each),
+# documents of up to several thousands of distinct tokens are counted (close to) exactly by its linear counting
+COUNT_PRECISION = 14
 
 
 class Condenser:
@@ -51,52 +72,321 @@ class Condenser:
                  tokenizer: Callable[[str], Iterable[str]] | None = tokenize,
                  normalizer: Callable[[str], str] | None = normalize,
                  hash_function: Callable = sha1_hash32,
-                 permutations: int = DEFAULT_PERMUTATIONS):
+                 permutations: int = DEFAULT_PERMUTATIONS,
+                 token_cache: TokenCache | None = None):
         # use provided tokenizer, or non-tokenizing fallback
         self.tokenizer = tokenizer or self._single_token
         self.normalizer = normalizer
         self.hash_func = hash_function
         self.permutations = permutations
+        # optional cache of the hash values of tokens, should use the same hash function
+        self.token_cache = token_cache
+
+    def use_token_cache(self, max_size: int = DEFAULT_CACHE_SIZE, policy: str = 'lru') -> TokenCache:
+        """
+        Start caching the hash values of up to *max_size* tokens, evicting
+        tokens according to *policy* (see `copietje.token_cache`).
+        """
+        self.token_cache = TOKEN_CACHES[policy](self.hash_func, max_size)
+        return self.token_cache
 
     def _single_token(self, data):
         yield data
 
     def make_hash(self, data: str) -> MinHash:
-        mh = MinHash(hashfunc=self.hash_func, num_perm=self.permutations)
+        mh = self._new_minhash()
+        self._update(mh, data)
+        return mh
+
+    def make_hash_with_count(self, data: str) -> Tuple[MinHash, int]:
+        """
+        Calculate the minhash of *data* as `make_hash` would, along with the
+        number of distinct tokens it was calculated from (the cardinality of
+        the token set, see `copietje.sketches.size_filter`).
+        """
+        mh = self._new_minhash()
+        return mh, len(self._update(mh, data))
+
+    def make_hash_stream(self, data: TextIO | Iterable[str], chunk_size: int = CHUNK_SIZE) -> MinHash:
+        """
+        Calculate the minhash of a document read from a text file object or
+        provided as an iterable of chunks of text, resulting in the same
+        minhash as `make_hash` would for the full document. Memory use is
+        bounded by *chunk_size*, except for tokenizers that need the full
+        document at once (see `copietje.tokenizers.streaming_context`):
+        the spaCy tokenizers (``words``, ``split-words``, ``sents`` and
+        ``split-sents``), any tokenizer not in `TOKENIZERS` and no
+        tokenizer at all. None of the normalizers in `NORMALIZERS` needs
+        the full document, other normalizers are assumed to normalize
+        lines independently.
+        """
+        if isinstance(data, TextIOBase) or hasattr(data, 'read'):
+            data = iter(partial(data.read, chunk_size), '')
+
+        accumulator = self.accumulator(max_buffer=chunk_size * 4)
+        for chunk in data:
+            accumulator.update(chunk)
+
+        return accumulator.digest()
 
+    def accumulator(self, max_buffer: int = CHUNK_SIZE * 4) -> 'HashAccumulator':
+        """
+        Create an accumulator to calculate the minhash of a document that
+        becomes available in chunks (e.g. while it's being downloaded).
+        """
+        return HashAccumulator(self, max_buffer=max_buffer)
+
+    def _new_minhash(self) -> MinHash:
+        # reuse the permutation parameters, datasketch would otherwise generate them again for every document
+        return MinHash(hashfunc=self.hash_func, num_perm=self.permutations,
+                       permutations=make_permutations(self.permutations))
+
+    def _update(self, mh: MinHash, data: str) -> np.ndarray:
         if self.normalizer:
             data = self.normalizer(data)
 
-        mh.update_batch((
-            # encode every token, mh expects bytes
-            token.encode('utf-8') for token in self.tokenizer(data)
-        ))
+        return self._update_normalized(mh, data)
 
-        return mh
+    def _update_normalized(self, mh: MinHash, data: str) -> np.ndarray:
+        if produces_hashes(self.tokenizer):
+            return self._update_hashes(mh, np.asarray(self.tokenizer(data)))
+
+        # a minhash only depends on the set of tokens, hash every distinct token once
+        return self._update_hashes(mh, np.array(self._hash_tokens(dict.fromkeys(self.tokenizer(data))),
+                                                dtype=np.uint64))
+
+    def _hash_tokens(self, tokens: Iterable[str]) -> List[int]:
+        if self.token_cache is not None:
+            return self.token_cache.hash_tokens(tokens)
+        # encode every token, the hash function expects bytes
+        return [self.hash_func(token.encode('utf-8')) for token in tokens]
+
+    def _update_hashes(self, mh: MinHash, hashes: np.ndarray) -> np.ndarray:
+        # permute hash values like update_batch would have after hashing the tokens (a minhash only depends on the set
+        # of hash values, so drop duplicates first)
+        hashes = np.unique(hashes).astype(np.uint64)
+        a, b = mh.permutations
+        for start in range(0, len(hashes), BATCH_TOKENS):
+            chunk = hashes[np.newaxis, start:start + BATCH_TOKENS]
+            permuted = (a[:, np.newaxis] * chunk + b[:, np.newaxis]) % MERSENNE_PRIME & MAX_HASH
+            mh.hashvalues = np.minimum(mh.hashvalues, permuted.min(axis=1))
+
+        # the distinct hash values that were added, allowing callers to count them
+        return hashes
+
+    def make_hash_batch(self, documents: Iterable[str], n_process: int = 1) -> np.ndarray:
+        """
+        Calculate the minhashes for multiple documents at once, resulting in
+        a ``(len(documents), permutations)`` matrix of uint32 hash values.
+        Rows are equal to the hash values of `make_hash` for the same
+        document (see `copietje.sketches.serialize` to turn them into
+        database blobs). The spaCy based tokenizers process the documents
+        in batches, using *n_process* processes.
+        """
+        if self.normalizer:
+            documents = map(self.normalizer, documents)
+
+        # hash all tokens of all documents into a single flat array, tracking the number of tokens per document
+        counts = []
+        token_hashes: List[int] = []
+        hashes_tokens = produces_hashes(self.tokenizer)
+        for tokens in tokenize_batch(self.tokenizer, documents, n_process=n_process):
+            num_hashes = len(token_hashes)
+            if hashes_tokens:
+                token_hashes.extend(np.asarray(tokens).tolist())
+            else:
+                token_hashes.extend(self._hash_tokens(dict.fromkeys(tokens)))
+            counts.append(len(token_hashes) - num_hashes)
+
+        result = np.full((len(counts), self.permutations), MAX_HASH, dtype=np.uint64)
+        # combine the index of the document every token was taken from with the token's hash value, sorting these
+        # groups the tokens by document (a minhash only depends on the set of hash values, so drop duplicates as well)
+        keys = np.sort(np.repeat(np.arange(len(counts), dtype=np.uint64), counts) << np.uint64(32)
+                       | np.array(token_hashes, dtype=np.uint64))
+        keys = keys[np.diff(keys, prepend=~keys[:1]) != 0]
+        owners, hashes = keys >> np.uint64(32), keys & MAX_HASH
+        a, b = make_permutations(self.permutations)
+
+        for start in range(0, len(hashes), BATCH_TOKENS):
+            chunk = slice(start, start + BATCH_TOKENS)
+            # permute all hashes in this chunk in one go, using the same (overflowing) uint64 arithmetic as datasketch
+            # (laid out as (permutations, tokens), reducing along contiguous rows is considerably faster)
+            permuted = (a[:, np.newaxis] * hashes[np.newaxis, chunk] + b[:, np.newaxis]) % MERSENNE_PRIME & MAX_HASH
+            # determine where the tokens of the next document start within the chunk, min-reduce those segments
+            owner = owners[chunk]
+            segments = np.flatnonzero(np.diff(owner, prepend=~owner[:1]))
+            rows = owner[segments]
+            result[rows] = np.minimum(result[rows], np.minimum.reduceat(permuted, segments, axis=1).T)
+
+        return result.astype(np.uint32)
 
     def make_token_set(self, data: str) -> Set[str]:
         if self.normalizer:
             data = self.normalizer(data)
 
-        return set(self.tokenizer(data))
+        tokens = self.tokenizer(data)
+        return set(np.asarray(tokens).tolist() if produces_hashes(self.tokenizer) else tokens)
+
+    def make_token_hashes(self, data: str) -> np.ndarray:
+        """
+        Calculate the set of tokens of *data* as a sorted array of distinct
+        uint64 token hashes (see `token_hash64`), a compact equivalent of
+        `make_token_set`. Tokenizers that produce hashes keep their hashes.
+        """
+        if self.normalizer:
+            data = self.normalizer(data)
+
+        tokens = self.tokenizer(data)
+        if produces_hashes(self.tokenizer):
+            return np.unique(np.asarray(tokens, dtype=np.uint64))
+        return np.unique(np.fromiter((token_hash64(token.encode('utf-8')) for token in dict.fromkeys(tokens)),
+                                     dtype=np.uint64))
+
+
+class HashAccumulator:
+    """
+    Calculates the minhash of a document provided in chunks of text. Text
+    is normalized up to the last line break that's safe to split on as
+    chunks arrive (or the last white space if no such line break shows up
+    within *max_buffer* characters). The normalized text is tokenized and
+    hashed along with enough trailing context of the text before it to
+    produce the tokens that cross the split, resulting in the same minhash
+    as `Condenser.make_hash` would for the full document. The distinct
+    token hashes are counted along the way by a HyperLogLog of fixed size,
+    providing an estimate of `num_tokens`.
+    """
+
+    def __init__(self, condenser: Condenser, max_buffer: int = CHUNK_SIZE * 4):
+        self.condenser = condenser
+        self.max_buffer = max_buffer
+        self.minhash = condenser._new_minhash()
+        # tokenizers that can't provide their context need the document to be complete
+        self.context = streaming_context(condenser.tokenizer)
+        # normalizers collapse white space, the line breaks we split on will have turned into single spaces (the raw
+        # text would still contain them, but words are separated by any white space)
+        self.separator = ' ' if condenser.normalizer or self.context and self.context[0] == 'words' else ''
+
+        # raw text that has yet to be normalized
+        self.chunks: List[str] = []
+        self.buffered = 0
+        # normalized text yet to be tokenized, starting with the context from text that was tokenized before
+        self.pending = ''
+        self.has_pending = self.started = False
+        # whether the normalizer still unescapes html entities, given the text normalized before
+        self.unescape_html = True
+        # registers of a HyperLogLog counting the distinct token hashes seen so far (keeping the hashes themselves
+        # would grow with the vocabulary of the document)
+        self.registers = np.zeros(1 << COUNT_PRECISION, dtype=np.int8)
+
+    @property
+    def num_tokens(self) -> int:
+        """
+        The estimated number of distinct tokens of the document (after
+        `digest`, the tokens seen so far before that).
+        """
+        with warnings.catch_warnings():
+            # datasketch warns about estimates close to where it stops using linear counting, precise enough for us
+            warnings.simplefilter('ignore')
+            return round(HyperLogLog(reg=self.registers).count())
+
+    def update(self, chunk: str):
+        self.chunks.append(chunk)
+        self.buffered += len(chunk)
+
+        if not self.context or '\n' not in chunk and self.buffered <= self.max_buffer:
+            # nothing to do (yet)
+            return
+
+        data = ''.join(self.chunks)
+        if not (split := split_point(data)) and self.buffered > self.max_buffer:
+            # avoid buffering indefinitely, fall back to splitting on any white space (still outside of markup)
+            split = split_point(data, white_space=True)
+
+        if split:
+            self._normalize(data[:split])
+            data = data[split:]
+
+        self.chunks = [data]
+        self.buffered = len(data)
+
+    def digest(self) -> MinHash:
+        """
+        Process any remaining text, returning the minhash of the complete
+        document.
+        """
+        if not self.context:
+            self._count(self.condenser._update(self.minhash, ''.join(self.chunks)))
+        else:
+            self._normalize(''.join(self.chunks))
+            if self.has_pending:
+                # tokenize the remainder, regardless of its length (the document might just be that short)
+                self._count(self.condenser._update_normalized(self.minhash, self.pending))
+
+        self.chunks = []
+        self.buffered = 0
+        self.pending = ''
+        self.has_pending = self.started = False
+        self.unescape_html = True
+        return self.minhash
+
+    def _normalize(self, data: str):
+        if self.condenser.normalizer:
+            data, self.unescape_html = normalize_piece(self.condenser.normalizer, data, self.unescape_html)
+        if not data:
+            return
+
+        # join normalized text the way it would have been joined when normalizing the text as a whole
+        self.pending = f'{self.pending}{self.separator}{data}' if self.started else data
+        self.has_pending = self.started = True
+
+        unit, size = self.context  # type: ignore[misc]
+        units = self.pending.split() if unit == 'words' else self.pending
+        # tokenizing fewer than size + 1 units would produce tokens a tokenizer only creates for very short documents
+        if len(units) > size:
+            self._count(self.condenser._update_normalized(self.minhash, self.pending))
+            # retain the context needed for the tokens crossing into the next piece of text
+            self.pending = ' '.join(units[len(units) - size:]) if unit == 'words' else self.pending[len(units) - size:]
+            self.has_pending = False
+
+    def _count(self, hashes: np.ndarray):
+        # mix the bits of the hashes first, the rolling hashes of the hashing tokenizers don't spread over the
+        # registers by themselves (murmur3's finalizer, in overflowing uint32 arithmetic)
+        hashes = (hashes & MAX_HASH).astype(np.uint32)
+        hashes ^= hashes >> np.uint32(16)
+        hashes *= np.uint32(0x85ebca6b)
+        hashes ^= hashes >> np.uint32(13)
+        hashes *= np.uint32(0xc2b2ae35)
+        hashes ^= hashes >> np.uint32(16)
+
+        # update the registers like HyperLogLog.update would for every hash: the low bits select a register, which
+        # keeps the highest rank (the position of the first set bit) of the remaining bits
+        rest = hashes >> np.uint32(COUNT_PRECISION)
+        ranks = 32 - COUNT_PRECISION - np.frexp(rest)[1] + 1
+        np.maximum.at(self.registers, hashes & np.uint32(len(self.registers) - 1), ranks.astype(np.int8))
 
 
 class HashIndex:
     def __init__(self,
                  condenser: Condenser,
                  database: Connection,
-                 index: MinHashLSH = None):
+                 index: MinHashLSH = None,
+                 max_sketches: int = None):
         self.condenser = condenser
         self.database = database
         self.database.row_factory = sqlite3.Row
         self.index = index or MinHashLSH(threshold=.8)
+        # hash values of the documents in the index, avoiding a trip to the database for every match
+        # (keeping only the most recently used max_sketches, fetching anything else from the database when needed)
+        self.sketches = LRUSketchStore(self.index.h, max_sketches) if max_sketches else SketchStore(self.index.h)
+        # serialized minhashes by the sha1 digest of the document, exact copies of a document reuse its minhash
+        self.digests: Dict[str, bytes] = {}
 
     def make_index(self, zip_file: str):
         with ZipFile(zip_file) as documents_zip:
             cur = self.database.cursor()
 
             cur.execute("""
-                SELECT path, uid, stream, minhash
+                SELECT path, uid, stream, sha1, minhash
                 FROM documents
                 WHERE tags IS NOT NULL
                 ORDER BY uid ASC
@@ -104,13 +394,14 @@ class HashIndex:
             for row in cur:
                 if minhash := self._get_or_update_minhash(row, documents_zip):
                     self.index.insert(row['uid'], minhash)
+                    self.sketches.add(row['uid'], minhash.hashvalues)
 
     def query_index(self, zip_file: str) -> Iterable[Tuple[str, Iterable[Tuple[str, float]]]]:
         with ZipFile(zip_file) as documents_zip:
             cur = self.database.cursor()
 
             cur.execute("""
-                SELECT path, uid, stream, minhash
+                SELECT path, uid, stream, sha1, minhash
                 FROM documents
                 WHERE tags IS NULL
                 ORDER BY uid ASC
@@ -119,8 +410,7 @@ class HashIndex:
                 if query_hash := self._get_or_update_minhash(row, documents_zip):
                     if matches := self.index.query(query_hash):
                         # build matches as a list of 2-tuples (uid, similarity)
-                        matches = [(match_uid, query_hash.jaccard(self.get_minhash(match_uid)))
-                                   for match_uid in matches]
+                        matches = list(zip(matches, self.similarities(query_hash, matches).tolist()))
                         # provide the uid that hit the database and a ranked list of (uid, similarity)
                         yield row['uid'], sorted(matches, key=itemgetter(1), reverse=True)
 
@@ -128,6 +418,43 @@ class HashIndex:
         min_hash = self.condenser.make_hash(document)
         print(key, 'alike', self.index.query(min_hash))
 
+    def similarities(self, query_hash: MinHash, uids: List[str]) -> np.ndarray:
+        similarities = np.empty(len(uids))
+        cached = np.array([uid in self.sketches for uid in uids], dtype=bool)
+        if cached.any():
+            rows = self.sketches.lookup([uid for uid, hit in zip(uids, cached) if hit])
+            similarities[cached] = self.sketches.jaccard(query_hash.hashvalues, rows)
+
+        if not cached.all():
+            # retrieve whatever is not (or no longer) in memory from the database in one go, remember it for next time
+            missing = self.get_minhashes([uid for uid, hit in zip(uids, cached) if not hit])
+            similarities[~cached] = missing.jaccard(query_hash.hashvalues, range(len(missing)))
+            self.sketches.extend(missing.uids.tolist(), missing.hashvalues)
+
+        return similarities
+
+    def get_minhashes(self, uids: List[str], batch_size: int = 500) -> SketchStore:
+        """
+        Retrieve the minhashes of *uids* from the database in batches, as a
+        `SketchStore` in the order of *uids*.
+        """
+        blobs: Dict[str, bytes] = {}
+        cur = self.database.cursor()
+        for start in range(0, len(uids), batch_size):
+            batch = uids[start:start + batch_size]
+            cur.execute(f"""
+                SELECT uid, minhash
+                FROM documents
+                WHERE uid IN ({', '.join('?' * len(batch))})
+            """, batch)
+            blobs.update((row['uid'], row['minhash']) for row in cur)
+
+        if missing := [uid for uid in uids if uid not in blobs]:
+            raise KeyError(f'Each uid should be unique and present in the database, '
+                           f'but found no rows for uid {missing[0]}.')
+
+        return SketchStore.from_blobs(uids, (blobs[uid] for uid in uids))
+
     def get_minhash(self, uid: str) -> MinHash:
         cur = self.database.cursor()
 
@@ -145,8 +472,15 @@ class HashIndex:
 
     def _get_or_update_minhash(self, row, documents_zip):
         if row['minhash']:
+            if row['sha1']:
+                self.digests.setdefault(row['sha1'], row['minhash'])
             return LeanMinHash.deserialize(row['minhash'], '!')
 
+        if row['sha1'] and (byte_array := self.digests.get(row['sha1'])):
+            # an exact copy of a document that was hashed before, no need to read and hash it again
+            self._update_minhash(row['uid'], byte_array)
+            return LeanMinHash.deserialize(byte_array, '!')
+
         document = documents_zip.read(row['path'])
         try:
             minhash = self.condenser.make_hash(str(document, encoding='utf-8'))
@@ -155,22 +489,25 @@ class HashIndex:
             byte_array = bytearray(lean_minhash.bytesize())
             lean_minhash.serialize(byte_array, '!')
 
-            update_cursor = self.database.cursor()
-            update_cursor.execute(
-                'UPDATE documents SET minhash=? WHERE uid=?',
-                (byte_array, row['uid'])
-            )
+            self._update_minhash(row['uid'], byte_array)
+            if row['sha1']:
+                self.digests[row['sha1']] = bytes(byte_array)
 
             return minhash
         except UnicodeDecodeError:
             print('UnicodeDecoderError for', row['path'])
             return None
 
+    def _update_minhash(self, uid: str, byte_array: bytes):
+        update_cursor = self.database.cursor()
+        update_cursor.execute(
+            'UPDATE documents SET minhash=? WHERE uid=?',
+            (byte_array, uid)
+        )
+
 
 def matches_to_file(index: HashIndex, documents: str, out_file):
-    with open(out_file, 'w') as out_file:
-        for uid, matches in index.query_index(documents):
-            out_file.write(uid)
-            out_file.write('  # similar to ')
-            out_file.write(', '.join(match[0] for match in matches))
-            out_file.write('\n')
+    with open(out_file, 'w', buffering=BUFFER_SIZE) as out_file:
+        # a single write of a complete line per document, buffered into far fewer writes to the file
+        out_file.writelines(f'{uid}  # similar to {", ".join(match[0] for match in matches)}\n'
+                            for uid, matches in index.query_index(documents))
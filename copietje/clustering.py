@@ -0,0 +1,213 @@
+from logging import getLogger as logger
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Iterator, Tuple
+
+import numpy as np
+
+from copietje.lsh import band_keys, lsh_params
+from copietje.matching import get_permutations, PAIR_BLOCK_SIZE
+from copietje.sketches import deserialize
+
+
+LOG = logger(__name__)
+
+# number of documents to read from the database at once
+LOAD_BATCH_SIZE = 10_000
+# buckets up to this size have all of their documents compared to each other, larger buckets (typically boilerplate)
+# only compare their documents to the first document in the bucket
+MAX_BUCKET_SIZE = 64
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS clusters (
+        cluster_id INTEGER,
+        uid TEXT PRIMARY KEY,
+        representative TEXT,
+        similarity_to_rep REAL
+    );
+    CREATE INDEX IF NOT EXISTS clusters_cluster_id ON clusters (cluster_id);
+"""
+
+
+class UnionFind:
+    """
+    Disjoint sets of the integers ``0`` up to *size*, merged by union by
+    size and flattened by path compression on every lookup.
+    """
+
+    def __init__(self, size: int):
+        self.parent = np.arange(size, dtype=np.int64)
+        self.size = np.ones(size, dtype=np.int64)
+
+    def find(self, node: int) -> int:
+        root = node
+        while (parent := self.parent[root]) != root:
+            root = parent
+        # point every node on the path directly to the root
+        while (parent := self.parent[node]) != root:
+            self.parent[node] = root
+            node = parent
+        return int(root)
+
+    def union(self, a: int, b: int) -> bool:
+        """
+        Merge the sets containing *a* and *b*, returning whether they were
+        separate sets before.
+        """
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return False
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+        return True
+
+    def roots(self, nodes: np.ndarray) -> np.ndarray:
+        """
+        Find the root of every node in *nodes* at once, compressing the
+        paths of those nodes only.
+        """
+        roots = self.parent[nodes]
+        while not np.array_equal(parents := self.parent[roots], roots):
+            roots = parents
+        self.parent[nodes] = roots
+        return roots
+
+
+def _load(database, directory: Path, num_documents: int, permutations: int, bands: int, rows: int):
+    """
+    Write the hash values and the band keys of all documents with a
+    minhash to memory-mapped files in *directory*, ordered by uid. Returns
+    the rowids of the documents, the hash values and the band-major band
+    keys.
+    """
+    rowids = np.empty(num_documents, dtype=np.int64)
+    hashvalues = np.lib.format.open_memmap(directory / 'hashvalues.npy', mode='w+', dtype=np.uint32,
+                                           shape=(num_documents, permutations))
+    keys = np.lib.format.open_memmap(directory / 'keys.npy', mode='w+', dtype=np.int64, shape=(bands, num_documents))
+
+    cursor = database.cursor().execute("""
+        SELECT rowid, minhash FROM documents WHERE minhash IS NOT NULL ORDER BY uid
+    """)
+    start = 0
+    while batch := cursor.fetchmany(LOAD_BATCH_SIZE):
+        end = start + len(batch)
+        rowids[start:end] = [row[0] for row in batch]
+        hashvalues[start:end] = batch_values = deserialize(row[1] for row in batch)
+        keys[:, start:end] = band_keys(batch_values, bands, rows).T
+        start = end
+
+    return rowids, hashvalues, keys
+
+
+def _similarities(hashvalues: np.ndarray, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # estimate the jaccard similarity of pairs of rows in blocks of pairs (as LeanMinHash.jaccard would)
+    return np.concatenate([
+        np.count_nonzero(hashvalues[a[start:start + PAIR_BLOCK_SIZE]] == hashvalues[b[start:start + PAIR_BLOCK_SIZE]],
+                         axis=1)
+        for start in range(0, len(a), PAIR_BLOCK_SIZE)
+    ] or [np.empty(0, dtype=np.intp)]) / hashvalues.shape[1]
+
+
+def _bucket_pairs(keys: np.ndarray, max_bucket_size: int,
+                  block_size: int = PAIR_BLOCK_SIZE) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Pair up the documents that share a bucket of equal *keys*, yielding
+    blocks of rows ``a`` and ``b`` of at most *block_size* pairs. All
+    documents in a bucket are paired up when the bucket holds at most
+    *max_bucket_size* documents, documents in larger buckets are only
+    paired with the first document of the bucket.
+    """
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    # position of the first document of the bucket of every position in the sorted keys, and the end of that bucket
+    starts = np.maximum.accumulate(np.where(first, np.arange(len(keys)), 0))
+    ends = np.append(np.flatnonzero(first)[1:], len(keys))[np.cumsum(first) - 1]
+    small = ends - starts <= max_bucket_size
+
+    for start in range(0, len(keys), block_size):
+        # pair up a block of positions at a time, keeping the pairs in memory to a few blocks
+        block = slice(start, start + block_size)
+        positions = np.arange(start, min(start + block_size, len(keys)))
+        if len(paired := positions[~first[block] & ~small[block]]):
+            yield order[starts[paired]], order[paired]
+
+        for offset in range(1, max_bucket_size):
+            # pair every position in a small bucket with the position offset further along, if still in the same bucket
+            if not len(paired := positions[small[block] & (positions + offset < ends[block])]):
+                # buckets in this block don't extend any further
+                break
+            yield order[paired], order[paired + offset]
+
+
+def cluster(database, threshold=0.5, fn_weight=0.75):
+    """
+    Group all documents in the database into clusters of near duplicates,
+    regardless of their labels. Documents sharing an LSH bucket with a
+    similarity of at least *threshold* are connected, clusters are the
+    connected components of those documents. The first uid of every
+    cluster is its representative.
+
+    Clusters are written to the ``clusters`` table as rows of
+    ``(cluster_id, uid, representative, similarity_to_rep)``, replacing
+    the results of a previous run. Documents without near duplicates are
+    left out. Minhashes and band keys are kept in memory-mapped files,
+    keeping memory use to a handful of integers per document. Returns the
+    number of clusters and the number of clustered documents.
+    """
+    database.cursor().executescript(SCHEMA)
+    num_documents = database.execute('SELECT COUNT(*) FROM documents WHERE minhash IS NOT NULL').fetchone()[0]
+    if not num_documents:
+        database.execute('DELETE FROM clusters')
+        database.commit()
+        return 0, 0
+
+    permutations = get_permutations(database)
+    bands, rows = lsh_params(threshold, fn_weight, permutations)
+
+    with TemporaryDirectory(prefix='copietje-') as directory:
+        LOG.info('loading minhashes of %d documents...', num_documents)
+        rowids, hashvalues, keys = _load(database, Path(directory), num_documents, permutations, bands, rows)
+
+        components = UnionFind(num_documents)
+        for band in range(bands):
+            num_compared = num_merged = 0
+            for first, other in _bucket_pairs(keys[band], MAX_BUCKET_SIZE):
+                # only compare documents that are not connected yet
+                separate = components.roots(first) != components.roots(other)
+                first, other = first[separate], other[separate]
+                similar = _similarities(hashvalues, first, other) >= threshold
+                num_compared += len(first)
+                num_merged += sum(components.union(a, b)
+                                  for a, b in zip(first[similar].tolist(), other[similar].tolist()))
+            LOG.debug('band %d: compared %d pairs, merged %d clusters', band, num_compared, num_merged)
+
+        roots = components.roots(np.arange(num_documents))
+        # documents are ordered by uid, the first document of every cluster represents it
+        representatives = np.full(num_documents, num_documents, dtype=np.int64)
+        np.minimum.at(representatives, roots, np.arange(num_documents))
+        members = np.flatnonzero(np.bincount(roots, minlength=num_documents)[roots] > 1)
+        representatives = representatives[roots[members]]
+        # number clusters in the order of their representatives
+        _, cluster_ids = np.unique(representatives, return_inverse=True)
+        similarities = _similarities(hashvalues, members, representatives)
+
+        LOG.info('writing %d documents in %d clusters...', len(members), cluster_ids.max(initial=-1) + 1)
+        cursor = database.cursor()
+        cursor.execute('DELETE FROM clusters')
+        for start in range(0, len(members), LOAD_BATCH_SIZE):
+            batch = slice(start, start + LOAD_BATCH_SIZE)
+            cursor.executemany(
+                """
+                INSERT INTO clusters (cluster_id, uid, representative, similarity_to_rep)
+                VALUES (?, (SELECT uid FROM documents WHERE rowid = ?), (SELECT uid FROM documents WHERE rowid = ?), ?)
+                """,
+                zip(cluster_ids[batch].tolist(), rowids[members[batch]].tolist(),
+                    rowids[representatives[batch]].tolist(), similarities[batch].tolist())
+            )
+        database.commit()
+
+    return int(cluster_ids.max(initial=-1)) + 1, len(members)
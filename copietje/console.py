@@ -1,20 +1,27 @@
 import argparse
+from contextlib import ExitStack, nullcontext
 from functools import partial
 from inspect import signature, Parameter
 import logging
 from pathlib import Path
 import sqlite3
+import sys
 from zoneinfo import ZoneInfo
 
-from datasketch import LeanMinHash, MinHashLSH
 from hansken.query import Term
 from hansken.recipes import export
 from hansken.tool import create_argument_parser, resolve_logging, run
 from tqdm import tqdm
 
 from copietje import Condenser
-from copietje.download import add_metadata_to_db, determine_stream, log_error_to_db, SCHEMA
-from copietje.ranking import rank
+from copietje.clustering import cluster as cluster_documents
+from copietje.download import add_metadata_to_db, create_schema, DatabaseWriter, determine_stream, hash_missing, \
+    HashPool, KnownDigests, log_error_to_db, StreamHasher
+from copietje.matching import ALL_DOCUMENTS, count_unlabeled, ENGINES, match_selections
+from copietje.output import BUFFER_SIZE, FILE_WRITERS, MatchTable
+from copietje.runs import MatchRun
+from copietje.token_cache import TOKEN_CACHES
+from copietje.verification import DEFAULT_MARGIN, VERIFIERS
 
 
 LOG = logging.getLogger(__name__)
@@ -42,6 +49,18 @@ num_jobs.add_argument('--jobs', dest='jobs', type=int, default=4,
                       help='number of parallel tasks during download')
 num_jobs.add_argument('--no-parallel', dest='jobs', action='store_false',
                       help='turn of parallelism during download')
+download_parser.add_argument('--hash-jobs', dest='hash_jobs', type=int, default=0,
+                             help='number of worker processes calculating minhashes, 0 to calculate them while '
+                                  'storing the downloaded documents')
+download_parser.add_argument('--token-cache', dest='token_cache', type=int, default=0,
+                             help='number of tokens to cache the hash values of (per hash worker process), 0 to hash '
+                                  'every token')
+download_parser.add_argument('--token-cache-policy', dest='token_cache_policy', choices=TOKEN_CACHES.keys(),
+                             default='lru', help='how to evict tokens from a full token cache')
+download_parser.add_argument('--batch-size', dest='batch_size', type=int, default=1000,
+                             help='max number of rows to write to the database in a single transaction')
+download_parser.add_argument('--flush-interval', dest='flush_interval', type=float, default=5.0,
+                             help='max number of seconds between writes to the database')
 
 match_parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 match_parser.add_argument('-l', '--log', metavar='FILE', default=None,
@@ -54,12 +73,52 @@ match_parser.add_argument('--threshold', type=zero_to_one, default=0.5,
                           help='minimum value that considers documents similar')
 match_parser.add_argument('--false-negative-weight', dest='fn_weight', type=zero_to_one, default=0.75,
                           help='relative weight of false negative results to optimize minhash index for')
+match_parser.add_argument('--engine', choices=ENGINES.keys(), default='sqlite',
+                          help='matching engine: sqlite uses the index stored in the database, '
+                               'numpy matches in memory')
+match_parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+                          help='number of worker processes matching in parallel (numpy engine only)')
+match_parser.add_argument('--output', choices=[*FILE_WRITERS.keys(), 'database'], default='text',
+                          help='output format: text, jsonl or csv written to the output file, or database to store '
+                               'matches in the matches table of the database')
+match_parser.add_argument('--output-file', dest='output_file', metavar='FILE', default=None,
+                          help='file to write matches to, defaults to standard output')
+match_parser.add_argument('--resume', dest='resume', default=True, action=argparse.BooleanOptionalAction,
+                          help='continue an interrupted run with the same parameters from its last checkpoint '
+                               '(database output only)')
+match_parser.add_argument('--checkpoint-interval', dest='checkpoint_interval', type=float, default=60.0,
+                          help='max number of seconds between checkpoints of the run (database output only)')
+match_parser.add_argument('--verify', choices=['none', *VERIFIERS.keys()], default='none',
+                          help='verify matches estimated close to the threshold: exact calculates their exact jaccard '
+                               'similarity from the downloaded files')
+match_parser.add_argument('--verify-margin', dest='verify_margin', type=zero_to_one, default=DEFAULT_MARGIN,
+                          help='distance to the threshold within which estimated similarities are verified')
+match_parser.add_argument('--verify-jobs', dest='verify_jobs', type=int, default=1,
+                          help='number of worker processes verifying matches in parallel')
+match_parser.add_argument('--condenser', type=Condenser.from_spec, default=Condenser(),
+                          help='tokenizer and normalizer used to download the documents, to verify matches with '
+                               '(e.g.: "ws:norm-html:sha1:128")')
+match_parser.add_argument('--incremental', dest='incremental', action='store_true',
+                          help='only match what the last finished run with the same parameters did not: documents '
+                               'downloaded or unlabeled since, and other documents to documents labeled since '
+                               '(database output only)')
+
+cluster_parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+cluster_parser.add_argument('-l', '--log', metavar='FILE', default=None,
+                            help='log messages to FILE (use - for standard error, log messages are hidden by default)')
+cluster_parser.add_argument('-v', '--verbose', action='count', default=0, help='be verbose')
+cluster_parser.add_argument('-z', '--timezone', type=ZoneInfo, default=ZoneInfo('Europe/Amsterdam'),
+                            help=argparse.SUPPRESS)
+cluster_parser.add_argument('database', metavar='DATABASE', help='path to database file')
+cluster_parser.add_argument('--threshold', type=zero_to_one, default=0.5,
+                            help='minimum value that considers documents similar')
+cluster_parser.add_argument('--false-negative-weight', dest='fn_weight', type=zero_to_one, default=0.75,
+                            help='relative weight of false negative results to optimize minhash index for')
 
 
 def main():
     # before handing argument parsing off to hansken.py or our own command line parser, pop the subcommand off of the
     # arguments here
-    import sys
     args = sys.argv[1:]
     subcommand = args.pop(0) if args else None
 
@@ -73,6 +132,10 @@ def main():
             with resolve_logging(args):
                 # unwrap the argparse namespace into keyword arguments and call the function to do the thing
                 return _unwrap(match, args=args)
+        case 'cluster':
+            args = cluster_parser.parse_args(args)
+            with resolve_logging(args):
+                return _unwrap(cluster, args=args)
         case '-h':
             return usage()
         case '--help':
@@ -84,22 +147,29 @@ def main():
 
 def usage(exitcode=0):
     # mimic the output of argparse
-    print('usage: copietje [-h] [download | match]')
-    print('copietje: error: choose from subcommands download, match')
+    print('usage: copietje [-h] [download | match | cluster]')
+    print('copietje: error: choose from subcommands download, match, cluster')
     raise SystemExit(exitcode)
 
 
-def download(*, context, database, target=None, limit=None, condenser=None, jobs=4, progress=True):
+def download(*, context, database, target=None, limit=None, condenser=None, jobs=4, hash_jobs=0, token_cache=0,
+             token_cache_policy='lru', batch_size=1000, flush_interval=5.0, progress=True):
     if not target:
         # default target to be the folder where the database is stored
         target = Path(database).parent
         LOG.info('using download target derived from database: %s')
     # make sure the target directory exists
     target.mkdir(parents=True, exist_ok=True)
+    if condenser and token_cache:
+        condenser.use_token_cache(token_cache, token_cache_policy)
 
-    with context, sqlite3.connect(database) as database:
+    # the minhashes of exact copies are looked up from the download's worker threads (see KnownDigests.sketch)
+    with context, sqlite3.connect(database, check_same_thread=False) as database:
         database.row_factory = sqlite3.Row
-        database.cursor().executescript(SCHEMA)
+        create_schema(database)
+        # load the digests of what was downloaded before once, rather than querying the database for every trace
+        known = KnownDigests.from_database(database)
+        LOG.info('loaded digests of %d previously downloaded documents', len(known))
         # search hansken for the documents to download + minhash
         documents = context.search(Term('type', 'document'), count=limit)
         # issue bulk download with side effects to store all the documents and the minhashes
@@ -114,60 +184,82 @@ def download(*, context, database, target=None, limit=None, condenser=None, jobs
                 unit='docs',
             )
 
-        export.bulk(documents, target,
-                    stream=partial(determine_stream, database=database),
-                    side_effect=partial(add_metadata_to_db, database=database, condenser=condenser),
-                    on_error=partial(log_error_to_db, database=database),
-                    jobs=jobs)
-
-
-def match(*, database, threshold=0.5, fn_weight=0.75):
+        with (DatabaseWriter(database, batch_size=batch_size, flush_interval=flush_interval, known=known) as writer,
+              HashPool(condenser, hash_jobs) if hash_jobs and condenser else nullcontext() as hash_pool):
+            if condenser and (num_missing := hash_missing(database, writer, condenser, hash_pool)):
+                # documents an interrupted download wrote without their minhash would be skipped otherwise
+                LOG.info('hashing %d previously downloaded documents without a minhash', num_missing)
+            # unless minhashes are calculated by a pool of processes, calculate them while the data is being written
+            stream_hasher = StreamHasher(condenser, known=known) if condenser and not hash_pool else None
+            export.bulk(documents, target,
+                        stream=partial(determine_stream, known=known),
+                        write=stream_hasher or export.to_file,
+                        side_effect=partial(add_metadata_to_db, writer=writer, condenser=condenser,
+                                            hash_pool=hash_pool, stream_hasher=stream_hasher),
+                        on_error=partial(log_error_to_db, writer=writer),
+                        jobs=jobs)
+
+            if hash_pool:
+                LOG.info('waiting for %d pending minhashes', len(hash_pool.pending))
+                writer.add_minhashes(hash_pool.completed(block=True))
+            elif condenser and condenser.token_cache is not None:
+                LOG.info('token cache: %(hits)d hits, %(misses)d misses (hit rate %(hit_rate).3f), '
+                         '%(evictions)d evictions', condenser.token_cache.stats())
+
+
+def match(*, database, threshold=0.5, fn_weight=0.75, engine='sqlite', jobs=1, output='text', output_file=None,
+          resume=True, checkpoint_interval=60.0, incremental=False, verify='none', verify_margin=DEFAULT_MARGIN,
+          verify_jobs=1, condenser=None):
+    match_engine = ENGINES[engine]
+    if jobs > 1:
+        if engine == 'numpy':
+            match_engine = partial(match_engine, jobs=jobs)
+        else:
+            LOG.warning('engine %s does not support parallel matching, ignoring jobs', engine)
+
+    with sqlite3.connect(database) as database, ExitStack() as files:
+        database.row_factory = sqlite3.Row
+        # databases created before the number of tokens of documents was recorded lack its column
+        create_schema(database)
+        if output == 'database':
+            # pick up where an interrupted run left off, or start a new one
+            run = (resume and MatchRun.resume(database, threshold, fn_weight)) or \
+                MatchRun.start(database, engine, threshold, fn_weight, incremental=incremental)
+            writer = MatchTable(database, run, flush_interval=checkpoint_interval)
+            selections = run.selections
+        else:
+            if incremental:
+                LOG.warning('incremental matching requires database output, matching all documents')
+            out_file = files.enter_context(open(output_file, 'w', buffering=BUFFER_SIZE, newline='')) \
+                if output_file else sys.stdout
+            writer = FILE_WRITERS[output](out_file)
+            selections = [ALL_DOCUMENTS]
+
+        # match all unlabeled documents to the index of labeled documents
+        if verify != 'none':
+            verifier = VERIFIERS[verify](database, condenser or Condenser(), threshold, verify_margin, verify_jobs)
+            # include the matches estimated just below the threshold, verification decides whether they match
+            results = verifier.verify(match_selections(match_engine, database, verifier.engine_threshold, fn_weight,
+                                                       selections))
+        else:
+            results = match_selections(match_engine, database, threshold, fn_weight, selections)
+
+        with writer:
+            for uid, matches in results:
+                writer.write(uid, matches)
+
+        LOG.info('matched %d out of %d documents', writer.num_queries, count_unlabeled(database))
+
+
+def cluster(*, database, threshold=0.5, fn_weight=0.75):
     with sqlite3.connect(database) as database:
         database.row_factory = sqlite3.Row
-        permutations = _get_permutations(database)
-        # build index of documents that already have a label
-        index = MinHashLSH(threshold=threshold, weights=(1.0 - fn_weight, fn_weight), num_perm=permutations)
-        # also track the labeled uids with their minhashes to post-process results later
-        hashes = {}
-        labeled = database.cursor().execute("""
-            SELECT uid, minhash FROM documents
-            WHERE privileged_status IS NOT NULL AND minhash IS NOT NULL
-        """)
-        LOG.info('building index of labeled documents...')
-        for document in labeled:
-            mh = LeanMinHash.deserialize(document['minhash'], '!')
-            index.insert(key=document['uid'],
-                         minhash=mh,
-                         # avoid duplicate keys check, the uid column will be unique
-                         check_duplication=False)
-            hashes[document['uid']] = mh
-        LOG.info('indexed %d documents', len(hashes))
-
-        documents = database.cursor().execute("""
-            SELECT uid, minhash FROM documents
-            WHERE privileged_status IS NULL AND minhash IS NOT NULL
-        """)
-        LOG.info('matching unlabeled documents to index...')
-        num_documents = num_matches = 0
-        # match all *other* documents to previously created index
-        for num_documents, document in enumerate(documents, start=1):
-            query_hash = LeanMinHash.deserialize(document['minhash'], '!')
-            # collect not only the uids but also their corresponding minhashes to post-process the results
-            matches = {uid: hashes[uid] for uid in index.query(query_hash)}
-            # filter + rank matches, only output if filter leaves anything
-            if matches := rank(matches, query_hash, threshold=threshold):
-                print(document['uid'], f' # max {matches[0][0]:.3f} matches', ', '.join(match[1] for match in matches))
-                num_matches += 1
-
-        LOG.info('matched %d out of %d documents', num_matches, num_documents)
-
-
-def _get_permutations(database):
-    cursor = database.cursor().execute("""
-        SELECT minhash FROM documents WHERE minhash IS NOT NULL LIMIT 1
-    """)
-    minhash = LeanMinHash.deserialize(cursor.fetchone()['minhash'], '!')
-    return len(minhash.hashvalues)
+        # group all documents into clusters of near duplicates, stored in the database
+        num_clusters, num_documents = cluster_documents(database, threshold, fn_weight)
+        print(f'{num_documents} documents in {num_clusters} clusters')
+
+        LOG.info('clustered %d out of %d documents', num_documents,
+                 database.execute('SELECT COUNT(*) FROM documents WHERE minhash IS NOT NULL').fetchone()[0])
 
 
 def _unwrap(target_func, *, context=None, args):
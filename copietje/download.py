@@ -1,6 +1,11 @@
+from codecs import getincrementaldecoder
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from io import IncrementalNewlineDecoder
 from logging import getLogger as logger
+from threading import Lock
+from time import monotonic
 
-from datasketch import LeanMinHash
+from copietje.sketches import serialize
 
 
 LOG = logger(__name__)
@@ -17,7 +22,13 @@ SCHEMA = """
         sha1 TEXT,
         tags TEXT,
         privileged_status TEXT,
-        minhash BLOB
+        minhash BLOB,
+        -- number of distinct tokens the minhash was calculated from, NULL if unknown
+        num_tokens INTEGER,
+        -- documents are numbered in the order they were downloaded (unlike the rowid, VACUUM leaves it alone)
+        seq INTEGER,
+        -- 1 when calculating the minhash failed (e.g. the stream is not text), those are not retried on resume
+        hash_failed INTEGER
     );
     CREATE TABLE IF NOT EXISTS errors (
         uid TEXT,
@@ -29,10 +40,123 @@ SCHEMA = """
         -- compound primary key to allow multiple failures of the same trace uid, differentiated by timestamp
         PRIMARY KEY (uid, ts)
     );
+    -- looking up the minhash of an exact copy by its digest, see KnownDigests.sketch
+    CREATE INDEX IF NOT EXISTS documents_sha1 ON documents (sha1 COLLATE NOCASE);
+    CREATE INDEX IF NOT EXISTS documents_seq ON documents (seq);
+    -- number documents inserted without a sequence number (DatabaseWriter provides its own)
+    CREATE TRIGGER IF NOT EXISTS documents_seq AFTER INSERT ON documents WHEN NEW.seq IS NULL
+    BEGIN
+        UPDATE documents SET seq = (SELECT COALESCE(MAX(seq), 0) + 1 FROM documents) WHERE rowid = NEW.rowid;
+    END;
 """
 
 
-def determine_stream(trace, database=None):
+def create_schema(database):
+    """
+    Create the tables of a case database, adding the columns that were
+    introduced since to the tables of a database created before.
+    """
+    # add missing columns before the schema indexes them
+    columns = {row[1] for row in database.execute('PRAGMA table_info(documents)')}
+    if columns and 'num_tokens' not in columns:
+        LOG.info('adding column num_tokens to documents table')
+        database.execute('ALTER TABLE documents ADD COLUMN num_tokens INTEGER')
+    if columns and 'seq' not in columns:
+        LOG.info('adding column seq to documents table')
+        database.execute('ALTER TABLE documents ADD COLUMN seq INTEGER')
+        # the rowids of the documents still reflect the order they were downloaded in
+        database.execute('UPDATE documents SET seq = rowid')
+    if columns and 'hash_failed' not in columns:
+        LOG.info('adding column hash_failed to documents table')
+        database.execute('ALTER TABLE documents ADD COLUMN hash_failed INTEGER')
+
+    database.cursor().executescript(SCHEMA)
+    database.commit()
+
+
+class KnownDigests:
+    """
+    In-memory mapping of trace uid to the sha1 digest of the stream that
+    was downloaded for it, avoiding a database query for every trace when
+    a download is resumed. Digests are kept as raw bytes rather than hex
+    strings to save memory.
+
+    Digests are also used to look up the serialized minhash calculated for
+    a stream with that digest (along with its number of distinct tokens),
+    allowing exact copies of that stream to reuse it rather than
+    calculating the same minhash again. Those are queried from *database*
+    on demand, only the minhashes that have yet to be written to it are
+    kept in memory (see `DatabaseWriter.flush`).
+    """
+
+    def __init__(self, digests=None, database=None):
+        self.digests = digests or {}
+        self.database = database
+        # minhashes by digest that might not have been written to the database yet
+        self.pending = {}
+        # the minhashes are looked up from the threads writing streams (see StreamHasher), while the DatabaseWriter
+        # keeping these digests in sync writes to the same connection, both hold this lock to use it
+        self.lock = Lock()
+
+    @classmethod
+    def from_database(cls, database):
+        cursor = database.cursor().execute("""
+            SELECT uid, sha1 FROM documents
+        """)
+        known = cls(database=database)
+        for uid, sha1 in cursor:
+            known.add(uid, sha1)
+        return known
+
+    @staticmethod
+    def _compact(sha1):
+        try:
+            return bytes.fromhex(sha1)
+        except (TypeError, ValueError):
+            # not a hex digest, keep the value as-is
+            return sha1
+
+    def __len__(self):
+        return len(self.digests)
+
+    def add(self, uid, sha1, minhash=None, num_tokens=None):
+        self.digests[uid] = digest = self._compact(sha1)
+        if minhash and digest is not None:
+            self.pending[digest] = minhash, num_tokens
+
+    def add_sketch(self, uid, minhash, num_tokens=None):
+        # the minhash of a stream calculated after its trace was added (see HashPool)
+        if minhash and (digest := self.digests.get(uid)) is not None:
+            self.pending[digest] = minhash, num_tokens
+
+    def written(self):
+        # the pending minhashes have been committed to the database, they can be queried from there
+        self.pending.clear()
+
+    def matches(self, uid, sha1):
+        return sha1 is not None and self.digests.get(uid) == self._compact(sha1)
+
+    def sketch(self, sha1):
+        """
+        Retrieve the serialized minhash of a stream with digest *sha1* and
+        its number of distinct tokens, or `None` if no such stream was
+        hashed before.
+        """
+        if sha1 is None:
+            return None
+        if (sketch := self.pending.get(self._compact(sha1))) is not None or self.database is None:
+            return sketch
+
+        with self.lock:
+            row = self.database.execute("""
+                SELECT minhash, num_tokens FROM documents
+                WHERE sha1 = ? COLLATE NOCASE AND minhash IS NOT NULL
+                LIMIT 1
+            """, (sha1,)).fetchone()
+        return tuple(row) if row else None
+
+
+def determine_stream(trace, database=None, known=None):
     # Initializing the dict with `False: MIN_SIZE` ensures that only data streams larger than the minimum size will be
     # downloaded. If there are no data streams with a size above the minimum size, this will serve as the maximum size,
     # and `False` will be returned.
@@ -42,7 +166,13 @@ def determine_stream(trace, database=None):
                   if trace.get(f'data.{stream}.mimeClass', '') == 'text'})
     selected = max(sizes, key=sizes.get)
 
-    if selected and database:
+    if selected and known is not None:
+        # a stream has been selected, and we've been handed the known digests, skip this trace if the known digest
+        # matches the one in trace' metadata
+        if known.matches(trace.uid, sha1 := trace.get(f'data.{selected}.hash.sha1')):
+            LOG.debug('skipping download for trace %s, already present in database (sha1=%s)', trace.uid, sha1)
+            return False
+    elif selected and database:
         cursor = database.cursor()
         # a stream has been selected, and we've been handed a database, attempt to select trace' stream sha1
         cursor.execute(
@@ -60,56 +190,309 @@ def determine_stream(trace, database=None):
     return selected
 
 
-def log_error_to_db(database, trace, stream, exception=None, **_):
-    database.cursor().execute(
+def condense_file(condenser, path):
+    """
+    Calculate the minhash for the text file at *path*, serialized to the
+    format stored in the database, and its number of distinct tokens (or
+    `None` if the file can't be read).
+    """
+    try:
+        # open the freshly written file in text mode and calculate a minhash for the output
+        with open(path, 'rt') as text:
+            mh, num_tokens = condenser.make_hash_with_count(text.read())
+            return serialize(mh.hashvalues, mh.seed)[0], num_tokens
+    except (IOError, UnicodeError) as e:
+        LOG.warning('failed to process file "%s": %s', path, e)
+        return None
+
+
+class StreamHasher:
+    """
+    Writes a data stream of a trace to a file (as ``export.to_file`` would),
+    calculating its minhash from the data as it is being written. Intended
+    to be passed as *write* to ``export.bulk``, which calls it from its
+    worker threads. Minhashes are collected by the thread that owns the
+    database through `pop`, along with their number of distinct tokens.
+    Exact copies of a stream that was hashed before reuse its minhash when
+    provided with the *known* digests.
+    """
+
+    def __init__(self, condenser, bufsize=1 << 20, known=None):
+        self.condenser = condenser
+        self.bufsize = bufsize
+        self.known = known
+        # serialized minhashes and numbers of tokens by output path, waiting to be popped (dict operations are
+        # thread-safe)
+        self.minhashes = {}
+
+    def __call__(self, trace, output, stream):
+        sketch = self.known.sketch(trace.get(f'data.{stream}.hash.sha1')) if self.known is not None else None
+        # only calculate a minhash when the data is not an exact copy of something that was hashed before
+        accumulator = self.condenser.accumulator() if sketch is None else None
+        # translate line endings like condense_file's text mode does, for both paths to hash the same text
+        decoder = IncrementalNewlineDecoder(getincrementaldecoder('utf-8')(), translate=True)
+
+        with open(output, 'wb') as out_file, trace.open(stream=stream) as data:
+            # pre-allocate a reusable buffer
+            buffer = memoryview(bytearray(self.bufsize))
+            while num_read := data.readinto(buffer):
+                out_file.write(buffer[:num_read])
+                if accumulator:
+                    try:
+                        accumulator.update(decoder.decode(buffer[:num_read]))
+                    except UnicodeError as e:
+                        # keep writing the stream, but there won't be a minhash for it
+                        LOG.warning('failed to process stream %s of trace %s: %s', stream, trace.uid, e)
+                        accumulator = None
+
+        if sketch is not None:
+            LOG.debug('reusing minhash for stream %s of trace %s (sha1=%s)',
+                      stream, trace.uid, trace.get(f'data.{stream}.hash.sha1'))
+            self.minhashes[output] = sketch
+        elif accumulator:
+            try:
+                accumulator.update(decoder.decode(b'', final=True))
+                mh = accumulator.digest()
+                self.minhashes[output] = serialize(mh.hashvalues, mh.seed)[0], accumulator.num_tokens
+            except UnicodeError as e:
+                LOG.warning('failed to process stream %s of trace %s: %s', stream, trace.uid, e)
+
+    def pop(self, output):
+        return self.minhashes.pop(output, None)
+
+
+# the condenser to be used by a process in a HashPool, set by the pool's initializer
+_condenser = None
+
+
+def _init_worker(condenser):
+    global _condenser
+    _condenser = condenser
+
+
+def _condense_file(uid, path, condenser=None):
+    minhash, num_tokens = condense_file(condenser or _condenser, path) or (None, None)
+    return uid, minhash, num_tokens
+
+
+class HashPool:
+    """
+    Calculates minhashes for downloaded files in a pool of worker
+    processes. Results are to be collected by the thread that owns the
+    database through `completed`.
+    """
+
+    def __init__(self, condenser, jobs):
+        self.executor = ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(condenser,))
+        self.pending = set()
+        # allow a fixed number of files to be pending before submit blocks
+        self.pending_threshold = jobs * 4
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown(cancel_futures=True)
+
+    def submit(self, uid, path):
+        if len(self.pending) >= self.pending_threshold:
+            # provide back pressure, wait for at least one of the pending tasks to be done
+            wait(self.pending, return_when=FIRST_COMPLETED)
+        self.pending.add(self.executor.submit(_condense_file, uid, path))
+
+    def completed(self, block=False):
         """
-        INSERT INTO errors (uid, stream, privileged_status, error)
-        VALUES (?, ?, ?, ?)
-        """,
-        (
-            trace.uid,
-            stream,
-            str(trace.privileged or '') or None,
-            str(exception) if exception else None,
-        )
+        Collect the ``(uid, minhash, num_tokens)`` results of the tasks that
+        are done, waiting for all pending tasks if *block* is set.
+        """
+        done, _ = wait(self.pending, timeout=None if block else 0)
+        self.pending.difference_update(done)
+        return [future.result() for future in done]
+
+
+class DatabaseWriter:
+    """
+    Collects the rows resulting from a download, writing them to the
+    database in batches. A batch is written when it reaches *batch_size*
+    rows or when the last batch was written more than *flush_interval*
+    seconds ago, whichever comes first.
+
+    Only complete batches are committed, a crashing download loses at most
+    the rows of a single batch, which will be downloaded again when the
+    download is resumed (see `determine_stream`).
+    """
+
+    def __init__(self, database, batch_size=1000, flush_interval=5.0, known=None):
+        self.database = database
+        # known digests to keep in sync with the documents being written, sharing their lock on the connection
+        self.known = known
+        self.lock = known.lock if known is not None else Lock()
+        # write-ahead logging avoids rewriting the database file on every commit
+        self.database.execute('PRAGMA journal_mode=WAL')
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.documents = []
+        self.errors = []
+        self.minhashes = []
+
+        self.num_rows = 0
+        self.write_time = 0.0
+        self.last_flush = monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        # write whatever is left, those rows are complete regardless of the reason we're exiting
+        self.flush()
+        LOG.info('wrote %d rows to database in %.1fs (%.0f rows/s)',
+                 self.num_rows, self.write_time, self.num_rows / (self.write_time or 1.0))
+
+    def __len__(self):
+        return len(self.documents) + len(self.errors) + len(self.minhashes)
+
+    def add_document(self, uid, path, stream, size, sha1, tags, privileged_status, minhash=None, num_tokens=None,
+                     hash_failed=None):
+        self.documents.append((uid, path, stream, size, sha1, tags, privileged_status, minhash, num_tokens,
+                               hash_failed))
+        if self.known is not None:
+            self.known.add(uid, sha1, minhash, num_tokens)
+        self.maybe_flush()
+
+    def add_error(self, uid, stream, privileged_status, error):
+        self.errors.append((uid, stream, privileged_status, error))
+        self.maybe_flush()
+
+    def add_minhashes(self, results):
+        results = list(results)
+        if self.known is not None:
+            for uid, minhash, num_tokens in results:
+                self.known.add_sketch(uid, minhash, num_tokens)
+        # a result without a minhash means calculating it failed
+        self.minhashes.extend((minhash, num_tokens, None if minhash else 1, uid)
+                              for uid, minhash, num_tokens in results)
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if len(self) >= self.batch_size or monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        start = monotonic()
+        num_rows = len(self)
+
+        if num_rows:
+            with self.lock:
+                cursor = self.database.cursor()
+                cursor.executemany(
+                    """
+                    INSERT INTO documents (uid, path, stream, size, sha1, tags, privileged_status, minhash, num_tokens,
+                                           hash_failed, seq)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM documents))
+                    """,
+                    self.documents
+                )
+                cursor.executemany(
+                    """
+                    INSERT INTO errors (uid, stream, privileged_status, error)
+                    VALUES (?, ?, ?, ?)
+                    """,
+                    self.errors
+                )
+                # minhashes are applied after the documents were inserted, their rows might be part of this batch
+                cursor.executemany(
+                    """
+                    UPDATE documents SET minhash = ?, num_tokens = ?, hash_failed = ? WHERE uid = ?
+                    """,
+                    self.minhashes
+                )
+                self.database.commit()
+
+                self.documents.clear()
+                self.errors.clear()
+                self.minhashes.clear()
+                if self.known is not None:
+                    self.known.written()
+
+        self.last_flush = monotonic()
+        if num_rows:
+            elapsed = self.last_flush - start
+            self.num_rows += num_rows
+            self.write_time += elapsed
+            LOG.debug('wrote batch of %d rows in %.3fs (%.0f rows/s)', num_rows, elapsed, num_rows / (elapsed or 1.0))
+
+
+def log_error_to_db(writer, trace, stream, exception=None, **_):
+    writer.add_error(
+        trace.uid,
+        stream,
+        str(trace.privileged or '') or None,
+        str(exception) if exception else None,
     )
-    database.commit()
 
 
-def add_metadata_to_db(database, trace, stream, output, condenser=None, **_):
-    mh = None
+def add_metadata_to_db(writer, trace, stream, output, condenser=None, hash_pool=None, stream_hasher=None, **_):
+    # the serialized minhash and number of distinct tokens of the stream, if available right away
+    sketch = None
+    sha1 = trace.get(f'data.{stream}.hash.sha1')
 
-    if condenser:
-        try:
-            # open the freshly written file in text mode and calculate a minhash for the output
-            # NB: doing this while the data is being written (as part of download.to_file in download.bulk) would be
-            #     grand, but as download.bulk does not facilitate message passing and sqlite is *very* fussy about
-            #     accessing things from different threads, re-reading the content here the best we have, hoping the
-            #     file's contents will still be available in memory and we won't slow things down too much 🙏
-            with open(output, 'rt') as text:
-                mh = LeanMinHash(condenser.make_hash(text))
-                buffer = bytearray(mh.bytesize('!'))
-                mh.serialize(buffer, '!')
-                # mh is the local used to write to the database, save the buffer to the database
-                mh = buffer
-        except (IOError, UnicodeError) as e:
-            LOG.warning('failed to process file "%s" for trace %s', output, trace.uid, e)
-
-    database.cursor().execute(
-        """
-        INSERT INTO documents (uid, path, stream, size, sha1, tags, privileged_status, minhash)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-        (
-            trace.uid,
-            output,
-            stream,
-            trace.get(f'data.{stream}.size'),
-            trace.get(f'data.{stream}.hash.sha1'),
-            ', '.join(trace.tags) or None,
-            str(trace.privileged or '') or None,
-            mh,
-        )
+    if stream_hasher:
+        # the minhash was calculated while the stream was being written
+        sketch = stream_hasher.pop(output)
+    elif (hash_pool or condenser) and writer.known is not None and (sketch := writer.known.sketch(sha1)):
+        # an exact copy of a stream that was hashed before, no need to calculate the same minhash again
+        LOG.debug('reusing minhash for stream %s of trace %s (sha1=%s)', stream, trace.uid, sha1)
+    elif hash_pool:
+        # hand the file off to be hashed by a worker process, the minhash column will be updated once it's done
+        hash_pool.submit(trace.uid, output)
+    elif condenser:
+        # re-read the freshly written file, hoping its contents will still be available in memory (see StreamHasher
+        # to avoid this)
+        sketch = condense_file(condenser, output)
+
+    minhash, num_tokens = sketch or (None, None)
+    # the minhash should have been available right away, but calculating it failed
+    hash_failed = 1 if sketch is None and not hash_pool and (stream_hasher or condenser) else None
+    writer.add_document(
+        trace.uid,
+        output,
+        stream,
+        trace.get(f'data.{stream}.size'),
+        sha1,
+        ', '.join(trace.tags) or None,
+        str(trace.privileged or '') or None,
+        minhash,
+        num_tokens,
+        hash_failed,
     )
-    # commit open transactions now, a crashing download would otherwise roll back any open inserts
-    database.commit()
+
+    if hash_pool:
+        # queue the minhashes of whatever files the pool has finished in the meantime
+        writer.add_minhashes(hash_pool.completed())
+
+
+def hash_missing(database, writer, condenser, hash_pool=None):
+    """
+    Calculate the minhashes of the documents that were downloaded before but
+    have no minhash, returning the number of documents that were (queued to
+    be) hashed. A download calculating minhashes in a `HashPool` writes the
+    documents before their minhashes, an interrupted download can leave
+    documents without one that a resumed download would otherwise skip.
+    Documents that failed to hash before are not retried.
+    """
+    cursor = database.cursor()
+    if num_failed := cursor.execute('SELECT COUNT(*) FROM documents WHERE hash_failed').fetchone()[0]:
+        LOG.info('skipping %d previously downloaded documents that failed to hash', num_failed)
+
+    rows = cursor.execute("""
+        SELECT uid, path FROM documents WHERE minhash IS NULL AND path IS NOT NULL AND hash_failed IS NULL
+    """).fetchall()
+    for uid, path in rows:
+        if hash_pool:
+            hash_pool.submit(uid, path)
+            writer.add_minhashes(hash_pool.completed())
+        else:
+            writer.add_minhashes([_condense_file(uid, path, condenser)])
+
+    return len(rows)
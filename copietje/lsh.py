@@ -0,0 +1,199 @@
+from logging import getLogger as logger
+from typing import Any, Dict, Tuple
+
+import numpy as np
+
+from copietje.sketches import deserialize
+
+
+LOG = logger(__name__)
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS bands (
+        -- the LSH parameters the band keys were calculated for, formatted as permutations:bands:rows
+        params TEXT,
+        uid TEXT,
+        band INTEGER,
+        key INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS bands_key ON bands (params, band, key);
+    CREATE INDEX IF NOT EXISTS bands_uid ON bands (params, uid);
+"""
+
+# constants for the 64-bit FNV-1a hash function, used to turn a band of hash values into a single key
+_FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+_FNV_PRIME = np.uint64(0x100000001b3)
+
+
+def _scale_nodes(nodes: np.ndarray, weights: np.ndarray, start: float, end: float) -> Tuple[np.ndarray, np.ndarray]:
+    # map quadrature nodes and weights for [-1, 1] onto [start, end]
+    half = (end - start) / 2
+    return start + half * (nodes + 1.0), half * weights
+
+
+def lsh_params(threshold: float, fn_weight: float, permutations: int) -> Tuple[int, int]:
+    """
+    Determine the number of bands and the number of rows per band that
+    datasketch's ``MinHashLSH`` would use for the provided parameters.
+    """
+    # the false positive / negative probabilities are integrals of polynomials of degree bands * rows <= permutations,
+    # which Gauss-Legendre quadrature with this many nodes integrates exactly (datasketch uses scipy's quad instead)
+    nodes, weights = np.polynomial.legendre.leggauss(permutations // 2 + 1)
+    fp_nodes, fp_weights = _scale_nodes(nodes, weights, 0.0, threshold)
+    fn_nodes, fn_weights = _scale_nodes(nodes, weights, threshold, 1.0)
+
+    # search for the parameters that minimize the weighted error, the same way datasketch's MinHashLSH does
+    min_error = float('inf')
+    bands, rows = 0, 0
+    for b in range(1, permutations + 1):
+        for r in range(1, permutations // b + 1):
+            fp = float(fp_weights @ (1.0 - (1.0 - fp_nodes ** r) ** b))
+            fn = float(fn_weights @ ((1.0 - fn_nodes ** r) ** b))
+            error = fp * (1.0 - fn_weight) + fn * fn_weight
+            if error < min_error:
+                min_error = error
+                bands, rows = b, r
+
+    if bands < 2:
+        raise ValueError('The number of bands are too small (b < 2)')
+    return bands, rows
+
+
+def band_keys(hashvalues: np.ndarray, bands: int, rows: int) -> np.ndarray:
+    """
+    Calculate a 64-bit key for every band of *rows* hash values of every
+    row of *hashvalues*, resulting in a ``(n, bands)`` matrix of int64 keys.
+    Two minhashes share a key for a band when their hash values for that
+    band are equal (as they would share a bucket in ``MinHashLSH``).
+    """
+    hashvalues = np.asarray(hashvalues)
+    banded = hashvalues[:, :bands * rows].reshape(len(hashvalues), bands, rows).astype(np.uint64)
+
+    keys = np.full((len(hashvalues), bands), _FNV_OFFSET, dtype=np.uint64)
+    for row in range(rows):
+        keys ^= banded[:, :, row]
+        keys *= _FNV_PRIME
+
+    # store keys as signed integers, sqlite doesn't do unsigned 64-bit integers
+    return keys.view(np.int64)
+
+
+class BandIndex:
+    """
+    LSH index of the minhashes in the documents table, persisted in the
+    database as band keys. Band keys are calculated once per document for
+    a particular combination of permutations, bands and rows, repeated
+    matches with the same parameters only need to index new documents.
+    """
+
+    def __init__(self, database, permutations: int, bands: int, rows: int):
+        self.database = database
+        self.permutations = permutations
+        self.bands = bands
+        self.rows = rows
+        self.params = f'{permutations}:{bands}:{rows}'
+
+        self.database.cursor().executescript(SCHEMA)
+
+    def update(self, batch_size: int = 10_000) -> int:
+        """
+        Add the band keys of documents that have not been indexed yet,
+        returning the number of documents that were added.
+        """
+        documents = self.database.cursor().execute("""
+            SELECT uid, minhash FROM documents
+            WHERE minhash IS NOT NULL AND uid NOT IN (SELECT uid FROM bands WHERE params = ?)
+        """, (self.params,))
+
+        num_documents = 0
+        while batch := documents.fetchmany(batch_size):
+            keys = band_keys(deserialize(row['minhash'] for row in batch), self.bands, self.rows)
+            self.database.cursor().executemany(
+                """
+                INSERT INTO bands (params, uid, band, key)
+                VALUES (?, ?, ?, ?)
+                """,
+                ((self.params, row['uid'], band, int(key))
+                 for row, row_keys in zip(batch, keys)
+                 for band, key in enumerate(row_keys))
+            )
+            num_documents += len(batch)
+            LOG.debug('indexed %d documents', num_documents)
+
+        self.database.commit()
+        return num_documents
+
+    def candidates(self, queries: str = '1', labeled: str = '1', parameters: Dict[str, Any] = None):
+        """
+        Retrieve the labeled documents sharing at least one band with an
+        unlabeled document, as rows of ``(query_uid, query_minhash,
+        query_num_tokens, uid, minhash, num_tokens)``, ordered by the uid of
+        the unlabeled document. Of every
+        group of unlabeled exact duplicates (documents sharing a sha1), only
+        the first is included (see `copietje.matching.duplicate_groups`).
+
+        Unlabeled and labeled documents can be narrowed down by SQL
+        conditions on the documents table, *queries* and *labeled*, using
+        the named *parameters* (see `copietje.matching.DocumentSelection`).
+        """
+        return self.database.cursor().execute(f"""
+            WITH query_document AS (
+                SELECT uid, minhash, num_tokens FROM (
+                    SELECT uid, sha1, minhash, num_tokens, ROW_NUMBER() OVER (PARTITION BY sha1 ORDER BY uid) AS copy
+                    FROM documents
+                    WHERE privileged_status IS NULL AND minhash IS NOT NULL AND ({queries})
+                )
+                WHERE sha1 IS NULL OR copy = 1
+            ), candidate_document AS (
+                SELECT uid, minhash, num_tokens FROM documents
+                WHERE privileged_status IS NOT NULL AND ({labeled})
+            )
+            SELECT DISTINCT
+                query.uid AS query_uid,
+                query_document.minhash AS query_minhash,
+                query_document.num_tokens AS query_num_tokens,
+                candidate.uid AS uid,
+                candidate_document.minhash AS minhash,
+                candidate_document.num_tokens AS num_tokens
+            FROM bands AS query
+            JOIN query_document
+                ON query_document.uid = query.uid
+            JOIN bands AS candidate
+                ON candidate.params = query.params AND candidate.band = query.band AND candidate.key = query.key
+            JOIN candidate_document
+                ON candidate_document.uid = candidate.uid
+            WHERE query.params = :params
+            ORDER BY query.uid
+        """, {**(parameters or {}), 'params': self.params})
+
+
+def bucket_index(keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Create an in-memory LSH index from a ``(n, bands)`` matrix of band keys
+    (see `band_keys`), as 2-tuple of ``(bands, n)`` matrices of the keys
+    sorted per band and the row numbers in that order.
+    """
+    # store the index band-major, searching a band should not need to copy a strided column
+    keys = np.ascontiguousarray(keys.T)
+    order = np.argsort(keys, axis=1, kind='stable')
+    return np.take_along_axis(keys, order, axis=1), order
+
+
+def candidate_pairs(query_keys: np.ndarray, sorted_keys: np.ndarray, order: np.ndarray) -> np.ndarray:
+    """
+    Find the candidates for every row of *query_keys* in the index created
+    by `bucket_index`, resulting in a sorted array of unique pairs of row
+    numbers, encoded as ``query_row * num_indexed + indexed_row``.
+    """
+    num_indexed = order.shape[1]
+    pairs = []
+    for band in range(query_keys.shape[1]):
+        # find the range of equal keys in the index for every query
+        start = np.searchsorted(sorted_keys[band], query_keys[:, band], side='left')
+        counts = np.searchsorted(sorted_keys[band], query_keys[:, band], side='right') - start
+        # expand the ranges into positions in the sorted index, paired up with the query they belong to
+        queries = np.repeat(np.arange(len(query_keys), dtype=np.int64), counts)
+        positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(start, counts)
+        pairs.append(queries * num_indexed + order[band, positions])
+
+    return np.unique(np.concatenate(pairs)) if pairs else np.empty(0, dtype=np.int64)
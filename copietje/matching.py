@@ -0,0 +1,331 @@
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from heapq import heappop, heappush, merge
+from itertools import compress, groupby
+from logging import getLogger as logger
+from operator import itemgetter
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Dict, List
+
+from datasketch import LeanMinHash
+import numpy as np
+
+from copietje.lsh import band_keys, BandIndex, bucket_index, candidate_pairs, lsh_params
+from copietje.sketches import deserialize, size_filter, SketchStore
+
+
+LOG = logger(__name__)
+
+# number of unlabeled documents to find candidates for at once in match_numpy (per worker process)
+QUERY_BLOCK_SIZE = 10_000
+# number of candidate pairs to compare at once in match_numpy
+PAIR_BLOCK_SIZE = 1 << 16
+
+
+def get_permutations(database):
+    cursor = database.cursor().execute("""
+        SELECT minhash FROM documents WHERE minhash IS NOT NULL LIMIT 1
+    """)
+    minhash = LeanMinHash.deserialize(cursor.fetchone()['minhash'], '!')
+    return len(minhash.hashvalues)
+
+
+def count_unlabeled(database):
+    cursor = database.cursor().execute("""
+        SELECT COUNT(*) FROM documents
+        WHERE privileged_status IS NULL AND minhash IS NOT NULL
+    """)
+    return cursor.fetchone()[0]
+
+
+class DocumentSelection:
+    """
+    Narrows down the documents taking part in a match by SQL conditions on
+    the documents table: *queries* for the unlabeled documents to match and
+    *labeled* for the labeled documents to match them to. Conditions can
+    refer to named *parameters* (e.g. ``'uid > :start_after'``).
+    """
+
+    def __init__(self, queries: str = '1', labeled: str = '1', parameters: Dict[str, Any] = None):
+        self.queries = queries
+        self.labeled = labeled
+        self.parameters = parameters or {}
+
+    def is_empty(self, database) -> bool:
+        """
+        Determine whether there is nothing to match: no unlabeled or no
+        labeled documents with a minhash.
+        """
+        return not database.cursor().execute(f"""
+            SELECT EXISTS (
+                SELECT 1 FROM documents
+                WHERE privileged_status IS NULL AND minhash IS NOT NULL AND ({self.queries})
+            ) AND EXISTS (
+                SELECT 1 FROM documents
+                WHERE privileged_status IS NOT NULL AND minhash IS NOT NULL AND ({self.labeled})
+            )
+        """, self.parameters).fetchone()[0]
+
+
+# select all documents
+ALL_DOCUMENTS = DocumentSelection()
+
+
+def duplicate_groups(database, selection: DocumentSelection = ALL_DOCUMENTS) -> Dict[str, List[str]]:
+    """
+    Group the unlabeled documents that are exact duplicates of each other
+    (sharing the sha1 digest of their stream), mapping the first uid of
+    every group to the uids of the other documents in the group.
+    """
+    cursor = database.cursor().execute(f"""
+        SELECT uid, sha1 FROM documents
+        WHERE privileged_status IS NULL AND minhash IS NOT NULL AND ({selection.queries}) AND sha1 IN (
+            SELECT sha1 FROM documents
+            WHERE privileged_status IS NULL AND minhash IS NOT NULL AND ({selection.queries})
+            GROUP BY sha1 HAVING COUNT(*) > 1
+        )
+        ORDER BY sha1, uid
+    """, selection.parameters)
+    groups = {}
+    for _, group in groupby(cursor, key=itemgetter('sha1')):
+        first, *others = (row['uid'] for row in group)
+        groups[first] = others
+
+    return groups
+
+
+def expand_duplicates(results, duplicates):
+    """
+    Expand the results of matching only the first of every group of exact
+    duplicates (see `duplicate_groups`) to the same results for every
+    document in the group, keeping the results ordered by uid.
+    """
+    # results of duplicates waiting for the results of preceding uids, ordered by uid
+    pending = []
+    for uid, matches in results:
+        while pending and pending[0][0] < uid:
+            yield heappop(pending)
+        yield uid, matches
+        for duplicate in duplicates.get(uid, ()):
+            heappush(pending, (duplicate, matches))
+
+    while pending:
+        yield heappop(pending)
+
+
+def match_sqlite(database, threshold=0.5, fn_weight=0.75, selection=ALL_DOCUMENTS):
+    """
+    Match unlabeled documents to labeled documents using the LSH index
+    persisted in the database (see `copietje.lsh.BandIndex`). Yields
+    2-tuples of the uid of an unlabeled document and its ranked list of
+    ``(similarity, uid)`` matches, ordered by uid. Exact duplicates are
+    matched once, sharing their results. Only the documents in *selection*
+    are matched. Candidates that can't be threshold similar by the number of
+    tokens of both documents alone are pruned before their minhashes are
+    compared (see `copietje.sketches.size_filter`).
+    """
+    permutations = get_permutations(database)
+    index = BandIndex(database, permutations, *lsh_params(threshold, fn_weight, permutations))
+    LOG.info('updating index of documents...')
+    LOG.info('indexed %d new documents', index.update())
+
+    duplicates = duplicate_groups(database, selection)
+    LOG.info('matching unlabeled documents to index, skipping %d exact duplicates...',
+             sum(len(others) for others in duplicates.values()))
+    counts: Counter = Counter()
+    yield from expand_duplicates(_rank_candidates(index, threshold, selection, counts), duplicates)
+    _log_pruned(counts)
+
+
+def _log_pruned(counts):
+    LOG.info('size filter pruned %d out of %d candidate pairs', counts['pruned'], counts['candidates'])
+
+
+def _rank_candidates(index, threshold, selection, counts):
+    candidates = index.candidates(selection.queries, selection.labeled, selection.parameters)
+    for query_uid, candidates in groupby(candidates, key=itemgetter('query_uid')):
+        candidates = list(candidates)
+        query_hash = deserialize([candidates[0]['query_minhash']])[0]
+        # leave out the candidates that can't be threshold similar by their number of tokens, before deserializing them
+        possible = size_filter(np.array([candidates[0]['query_num_tokens']], dtype=np.float64),
+                               np.array([candidate['num_tokens'] for candidate in candidates], dtype=np.float64),
+                               threshold)
+        counts['candidates'] += len(candidates)
+        counts['pruned'] += int(np.count_nonzero(~possible))
+        if not (candidates := list(compress(candidates, possible))):
+            continue
+
+        # deserialize the minhashes of the candidates into a store to post-process the results
+        store = SketchStore.from_blobs([candidate['uid'] for candidate in candidates],
+                                       (candidate['minhash'] for candidate in candidates),
+                                       [candidate['num_tokens'] for candidate in candidates])
+        similarities = store.jaccard(query_hash, range(len(store)))
+        # filter + rank matches (as rank would), only yield if filter leaves anything
+        if matches := sorted(((similarity, uid)
+                              for similarity, uid in zip(similarities.tolist(), store.uids)
+                              if similarity >= threshold),
+                             reverse=True):
+            yield query_uid, matches
+
+
+def load_minhashes(database, labeled, exclude=frozenset(), selection=ALL_DOCUMENTS):
+    """
+    Load the uids, minhashes and numbers of tokens of all labeled or
+    unlabeled documents in *selection* into a `SketchStore`, ordered by uid,
+    leaving out the uids in *exclude*.
+    """
+    cursor = database.cursor().execute(f"""
+        SELECT uid, minhash, num_tokens FROM documents
+        WHERE privileged_status IS {'NOT NULL' if labeled else 'NULL'} AND minhash IS NOT NULL
+            AND ({selection.labeled if labeled else selection.queries})
+        ORDER BY uid
+    """, selection.parameters)
+    uids = []
+    minhashes = []
+    num_tokens = []
+    for uid, minhash, tokens in cursor:
+        if uid in exclude:
+            continue
+        uids.append(uid)
+        minhashes.append(minhash)
+        num_tokens.append(tokens)
+
+    return SketchStore.from_blobs(uids, minhashes, num_tokens)
+
+
+def _match_block(queries, start, end, labeled, sorted_keys, order, bands, rows, threshold, query_cardinalities,
+                 labeled_cardinalities):
+    """
+    Match rows *start* up to *end* of the query minhashes to the labeled
+    minhashes indexed by `bucket_index`, resulting in arrays of query rows,
+    labeled rows and similarities of the matches, ordered by query row and
+    ranked like `rank` would, followed by the number of candidate pairs and
+    the number of those pruned by the cardinalities of their token sets.
+    """
+    queries = queries[start:end]
+    pairs = candidate_pairs(band_keys(queries, bands, rows), sorted_keys, order)
+    query_rows, labeled_rows = np.divmod(pairs, len(labeled))
+    # leave out the pairs that can't be threshold similar by the cardinalities of their token sets alone
+    possible = size_filter(query_cardinalities[start:end][query_rows], labeled_cardinalities[labeled_rows], threshold)
+    query_rows, labeled_rows = query_rows[possible], labeled_rows[possible]
+
+    # estimate the jaccard similarity of the candidate pairs in blocks of pairs (as LeanMinHash.jaccard would)
+    similarities = np.concatenate([
+        np.count_nonzero(queries[query_rows[start:end]] == labeled[labeled_rows[start:end]], axis=1)
+        for start, end in zip(range(0, len(query_rows), PAIR_BLOCK_SIZE),
+                              range(PAIR_BLOCK_SIZE, len(query_rows) + PAIR_BLOCK_SIZE, PAIR_BLOCK_SIZE))
+    ] or [np.empty(0, dtype=np.intp)]) / labeled.shape[1]
+
+    selected = similarities >= threshold
+    query_rows, labeled_rows, similarities = query_rows[selected], labeled_rows[selected], similarities[selected]
+    # order by query, then rank the matches of every query like rank does (by similarity, then uid, descending)
+    # (labeled_rows follows the order of the uids)
+    ranked = np.lexsort((-labeled_rows, -similarities, query_rows))
+    return (query_rows[ranked] + start, labeled_rows[ranked], similarities[ranked],
+            len(pairs), int(np.count_nonzero(~possible)))
+
+
+# arrays shared with worker processes through memory-mapped files, set by _init_worker
+SHARED_ARRAYS = ('queries', 'query_cardinalities', 'labeled', 'labeled_cardinalities', 'sorted_keys', 'order')
+_shared: Dict[str, np.ndarray] = {}
+
+
+def _init_worker(directory):
+    for name in SHARED_ARRAYS:
+        _shared[name] = np.load(Path(directory) / f'{name}.npy', mmap_mode='r')
+
+
+def _match_shard(start, end, bands, rows, threshold):
+    return _match_block(_shared['queries'], start, end, _shared['labeled'], _shared['sorted_keys'], _shared['order'],
+                        bands, rows, threshold, _shared['query_cardinalities'], _shared['labeled_cardinalities'])
+
+
+def _match_parallel(arrays, bands, rows, threshold, jobs):
+    queries = arrays['queries']
+    with TemporaryDirectory(prefix='copietje-') as directory:
+        # write the matrices and the index to disk once, workers map them into memory rather than receiving a copy
+        for name in SHARED_ARRAYS:
+            np.save(Path(directory) / f'{name}.npy', arrays[name])
+
+        with ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(directory,)) as executor:
+            # keep a limited number of shards in flight, yielding their results in the order of the shards
+            pending = deque()
+            for start in range(0, len(queries), QUERY_BLOCK_SIZE):
+                pending.append(executor.submit(_match_shard, start, start + QUERY_BLOCK_SIZE, bands, rows, threshold))
+                if len(pending) >= jobs * 2:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+
+
+def match_numpy(database, threshold=0.5, fn_weight=0.75, selection=ALL_DOCUMENTS, jobs=1):
+    """
+    Match unlabeled documents to labeled documents using an in-memory LSH
+    index of band keys calculated from matrices of minhashes. Yields the
+    same results as `match_sqlite`. With *jobs* > 1, blocks of unlabeled
+    documents are matched by worker processes sharing memory-mapped copies
+    of the minhashes and the index. Like `match_sqlite`, candidates are
+    pruned by the number of tokens of both documents.
+    """
+    LOG.info('loading minhashes...')
+    duplicates = duplicate_groups(database, selection)
+    labeled_store = load_minhashes(database, labeled=True, selection=selection)
+    # only match the first of every group of exact duplicates
+    query_store = load_minhashes(database, labeled=False,
+                                 exclude={uid for others in duplicates.values() for uid in others},
+                                 selection=selection)
+    if not len(labeled_store) or not len(query_store):
+        return
+
+    labeled, queries = labeled_store.hashvalues, query_store.hashvalues
+    bands, rows = lsh_params(threshold, fn_weight, labeled.shape[1])
+    LOG.info('building index of %d labeled documents...', len(labeled_store))
+    sorted_keys, order = bucket_index(band_keys(labeled, bands, rows))
+
+    LOG.info('matching %d unlabeled documents to index, skipping %d exact duplicates...',
+             len(query_store), sum(len(others) for others in duplicates.values()))
+    if jobs > 1:
+        results = _match_parallel({'queries': queries, 'query_cardinalities': query_store.cardinalities,
+                                   'labeled': labeled, 'labeled_cardinalities': labeled_store.cardinalities,
+                                   'sorted_keys': sorted_keys, 'order': order},
+                                  bands, rows, threshold, jobs)
+    else:
+        results = (_match_block(queries, start, start + QUERY_BLOCK_SIZE, labeled, sorted_keys, order,
+                                bands, rows, threshold, query_store.cardinalities, labeled_store.cardinalities)
+                   for start in range(0, len(query_store), QUERY_BLOCK_SIZE))
+
+    counts: Counter = Counter()
+    yield from expand_duplicates(_group_matches(results, query_store, labeled_store, counts), duplicates)
+    _log_pruned(counts)
+
+
+def _group_matches(results, query_store, labeled_store, counts):
+    for query_rows, labeled_rows, similarities, num_candidates, num_pruned in results:
+        counts['candidates'] += num_candidates
+        counts['pruned'] += num_pruned
+        # split the ranked pairs into groups of the same query
+        boundaries = np.flatnonzero(np.diff(query_rows)) + 1
+        for group_rows, group_labeled, group_similarities in zip(np.split(query_rows, boundaries),
+                                                                 np.split(labeled_rows, boundaries),
+                                                                 np.split(similarities, boundaries)):
+            if len(group_rows):
+                matches = list(zip(group_similarities.tolist(), labeled_store.uids[group_labeled].tolist()))
+                yield query_store.uids[group_rows[0]], matches
+
+
+def match_selections(engine, database, threshold, fn_weight, selections):
+    """
+    Match the documents of every selection in *selections* using *engine*,
+    merging the results into a single sequence ordered by uid. The
+    selections should not share any unlabeled documents.
+    """
+    yield from merge(*(engine(database, threshold, fn_weight, selection) for selection in selections),
+                     key=itemgetter(0))
+
+
+ENGINES = {
+    'sqlite': match_sqlite,
+    'numpy': match_numpy,
+}
@@ -1,14 +1,48 @@
-from cleantext import clean
-from bs4 import BeautifulSoup
+from functools import cache, partial
+from html import unescape
+from html.parser import HTMLParser
+from itertools import groupby
+import re
+from typing import List, Set, Tuple
+from unicodedata import is_normalized
 
+from bs4.dammit import EntitySubstitution
+from cleantext import clean, constants, to_ascii_unicode
+from emoji import EMOJI_DATA, emojize, STATUS
+from ftfy import fix_text, fixes, TextFixerConfig
+# not part of ftfy's public api, pyproject.toml pins ftfy to the releases normalize_fast has been verified against
+from ftfy.badness import BADNESS_RE
+from unidecode import unidecode
 
-def normalize(data: str) -> str:
+
+# complete comments, elements excluded from the text (see HTMLTextExtractor.EXCLUDED) and other tags, text within
+# these should not be split up
+_MARKUP = re.compile(r'<!--.*?-->|<(script|style|template|rt|rp)\b.*?</\1\s*>'
+                     r'|<(?!!--|(?:script|style|template|rt|rp)\b)[^<>]*>',
+                     re.DOTALL | re.IGNORECASE)
+
+
+def _decode_escapes(data: str) -> str:
+    # clean decodes backslash escapes before fixing unicode errors
+    try:
+        return data.encode('latin', 'backslashreplace').decode('unicode-escape')
+    except Exception:
+        return data
+
+
+def normalize(data: str, unescape_html: bool = True) -> str:
     """
     Uses the clean function from clean-text package. See the documentation for all options:
     https://github.com/jfilter/clean-text
+
+    Html entities are not unescaped when *unescape_html* is false (see
+    `normalize_piece`).
     """
+    if not unescape_html:
+        # fix unicode errors like clean would, other than unescaping html entities
+        data = fix_text(_decode_escapes(data), normalization='NFC', unescape_html=False)
     return clean(data,
-                 fix_unicode=True,  # fix various unicode errors
+                 fix_unicode=unescape_html,  # fix various unicode errors
                  to_ascii=True,  # transliterate to closest ASCII representation
                  lower=True,  # lowercase text
                  no_line_breaks=True,  # fully strip line breaks as opposed to only normalizing them
@@ -18,16 +52,356 @@ def normalize(data: str) -> str:
                  )
 
 
-def normalize_html(data: str):
+def _character_class(ordinals) -> re.Pattern:
+    # compile a set of characters to a character class of ranges, which re matches a lot quicker than many characters
+    ranges: List[List[int]] = []
+    for ordinal in sorted(set(ordinals)):
+        if ranges and ranges[-1][1] == ordinal - 1:
+            ranges[-1][1] = ordinal
+        else:
+            ranges.append([ordinal, ordinal])
+
+    if not ranges:
+        # an empty character class matches nothing
+        return re.compile('[^\\s\\S]')
+    # re is quick to skip ascii characters, so check for those first when none of the characters are ascii
+    prefix = '(?=[^\\x00-\\x7f])' if ranges[0][0] > 0x7f else ''
+    return re.compile(prefix + '[{}]'.format(''.join(f'{re.escape(chr(first))}-{re.escape(chr(last))}'
+                                                     for first, last in ranges)))
+
+
+_MAX_DECODE_LENGTH = TextFixerConfig().max_decode_length
+# ftfy's fixes that replace individual characters
+_CHARACTER_FIXES = (fixes.fix_c1_controls, fixes.fix_latin_ligatures, fixes.fix_character_width, fixes.uncurl_quotes,
+                    fixes.fix_line_breaks, fixes.fix_surrogates, fixes.remove_terminal_escapes,
+                    fixes.remove_control_chars)
+# characters that are part of emoji, which survive clean's transliteration
+_EMOJI = _character_class(ord(char) for emoji in EMOJI_DATA for char in emoji if not char.isascii())
+# anything that might be an emoji alias like :thumbsup:, turned into an emoji by clean (starting at every colon)
+_EMOJI_ALIAS = re.compile(r'(?=(:[^\s:]+:))')
+
+
+@cache
+def _emoji_names() -> Set[str]:
+    # the names emojize(…, language='alias') recognizes (which loads the aliases on first use)
+    emojize('', language='alias')
+    return {name
+            for data in EMOJI_DATA.values() if data['status'] <= STATUS['fully_qualified']
+            for name in (data['en'], *data.get('alias', ()))}
+
+
+class _Transliterations(dict):
+    # per-character equivalent of clean's currency symbol removal, quote fixing and transliteration, filled on demand
+    def __missing__(self, ordinal):
+        char = chr(ordinal)
+        if char in constants.CURRENCIES:
+            value = ''
+        elif constants.SINGLE_QUOTE_REGEX.fullmatch(char):
+            value = "'"
+        elif constants.DOUBLE_QUOTE_REGEX.fullmatch(char):
+            value = '"'
+        else:
+            value = unidecode(char)
+
+        self[ordinal] = value
+        return value
+
+
+_TRANSLITERATIONS = _Transliterations()
+# the characters _TRANSLITERATIONS changes: any (run of) non-ascii characters and a few ascii ones
+_TRANSLITERATED = re.compile('[^\\x00-\\x7f]+|' + _character_class(
+    ordinal for ordinal in range(0x80) if _TRANSLITERATIONS[ordinal] != chr(ordinal)).pattern)
+# str.translate is a lot quicker for ascii characters that are deleted (mapped to None) rather than replaced
+_PUNCTUATION = dict.fromkeys(constants.PUNCT_TRANSLATE_UNICODE)
+# characters ftfy fixes depending on the characters around them: \r\n, terminal escapes and surrogates
+_CONTEXTUAL = re.compile('[\r\x1b\ud800-\udfff]')
+_NON_ASCII = re.compile('[^\x00-\x7f]')
+# every kind of mojibake ftfy detects includes a non-ascii character within its first three characters, checking that
+# first saves trying all of them at every position
+_BADNESS = re.compile(r'(?=[\s\S]{0,2}[^\x00-\x7f])(?:' + BADNESS_RE.pattern + ')', BADNESS_RE.flags)
+
+
+def _is_bad(segment: str) -> bool:
+    # equivalent of ftfy's is_bad
+    match = _NON_ASCII.search(segment)
+    return match is not None and _BADNESS.search(segment, max(match.start() - 2, 0)) is not None
+
+
+def _apply_fixes(data: str) -> str:
+    for fix in _CHARACTER_FIXES:
+        data = fix(data)
+    return data
+
+
+@cache
+def _fix_character(char: str) -> str | None:
+    # result of ftfy's fixes for char on its own, None if ftfy needs to look at the characters around it
+    if _CONTEXTUAL.match(char):
+        return None
+
+    fixed = _apply_fixes(char)
+    # ftfy repeats its fixes until nothing changes, the result should not introduce new lines (segments) either
+    if _CONTEXTUAL.search(fixed) or _apply_fixes(fixed) != fixed or (fixed != char and '\n' in fixed):
+        return None
+    return fixed
+
+
+def _segments(data: str) -> List[str]:
+    segments = [line + '\n' for line in data.split('\n')]
+    segments[-1] = segments[-1][:-1]
+    return segments
+
+
+def _fix_unicode(data: str, fix, unescape_html: bool = True) -> str:
+    # ftfy fixes segments of data (lines, unless they're very long) independently, most of them only need html entities
+    # and individual characters replaced, pass it only the segments that need more than that
+    unescaped_data = fixes.unescape_html(data) if unescape_html and '&' in data else data
+    if unescaped_data.count('\n') != data.count('\n'):
+        # entities for line breaks would change the segments
+        return fix(data)
+
+    fixes_by_char = {char: _fix_character(char) for char in set(unescaped_data)}
+    contextual = _character_class(ord(char) for char, fixed in fixes_by_char.items() if fixed is None)
+    changes = {char: fixed for char, fixed in fixes_by_char.items() if fixed is not None and fixed != char}
+    fixed_data = unescaped_data
+    if changes:
+        fixed_data = _character_class(map(ord, changes)).sub(lambda match: changes[match[0]], unescaped_data)
+
+    def needs_fix(segment: str, unescaped: str, fixed: str) -> bool:
+        return (len(segment) > _MAX_DECODE_LENGTH or contextual.search(unescaped) is not None or _is_bad(unescaped)
+                or (fixed != unescaped and _is_bad(fixed)) or not is_normalized('NFC', fixed)
+                # ftfy repeats unescaping as well
+                or (unescape_html and '&' in fixed and fixes.unescape_html(fixed) != fixed))
+
+    parts = []
+    segments = zip(_segments(data), _segments(unescaped_data), _segments(fixed_data))
+    for fix_segments, group in groupby(segments, key=lambda segments: needs_fix(*segments)):
+        if fix_segments:
+            parts.append(fix(''.join(segment for segment, _, _ in group)))
+        else:
+            parts.extend(fixed for _, _, fixed in group)
+
+    return ''.join(parts)
+
+
+def _map_lines(data: str, pattern: re.Pattern, func, otherwise=str) -> str:
+    # apply func to the (runs of consecutive) lines in data that contain a match for pattern, otherwise to the rest
+    parts = []
+    position = 0
+    while match := pattern.search(data, position):
+        start = data.rfind('\n', position, match.start()) + 1
+        end = data.find('\n', match.end()) + 1 or len(data)
+        while (match := pattern.search(data, end)) and data.find('\n', end, match.start()) < 0:
+            end = data.find('\n', match.end()) + 1 or len(data)
+
+        parts.append(otherwise(data[position:start]))
+        parts.append(func(data[start:end]))
+        position = end
+
+    parts.append(otherwise(data[position:]))
+    return ''.join(parts)
+
+
+def _to_ascii(data: str) -> str:
+    # equivalent of clean's transliteration for lines with emoji
+    return to_ascii_unicode(constants.CURRENCY_REGEX.sub('', data))
+
+
+def _transliterate(data: str) -> str:
+    # zł is the only currency symbol of multiple characters
+    data = _TRANSLITERATED.sub(lambda match: match[0].translate(_TRANSLITERATIONS), data.replace('zł', ''))
+    if any(name in _emoji_names() for name in _EMOJI_ALIAS.findall(data)):
+        data = emojize(data, language='alias')
+    return data
+
+
+def normalize_fast(data: str, unescape_html: bool = True) -> str:
+    """
+    Equivalent of normalize(), replacing most of clean's passes over the
+    data with translation tables. Only the lines that need it are passed to
+    ftfy to fix unicode errors.
+    """
+    if '\\' in data:
+        data = _decode_escapes(data)
+
+    fix = partial(fix_text, normalization='NFC')
+    if not unescape_html:
+        data = _fix_unicode(data, partial(fix, unescape_html=False), unescape_html=False)
+    elif (markup := data.find('<')) >= 0:
+        # ftfy stops unescaping html entities from the first segment (usually a line) containing a < onward
+        line = data.rfind('\n', 0, markup) + 1
+        split = line + (markup - line) // _MAX_DECODE_LENGTH * _MAX_DECODE_LENGTH
+        data = (_fix_unicode(data[:split], fix)
+                + _fix_unicode(data[split:], partial(fix, unescape_html=False), unescape_html=False))
+    else:
+        data = _fix_unicode(data, fix)
+
+    # lines with emoji are left to clean's implementation, everything else is transliterated a character at a time
+    data = _map_lines(data, _EMOJI, _to_ascii, _transliterate)
+    data = data.translate(_PUNCTUATION).lower()
+    return ' '.join(data.split())
+
+
+class HTMLTextExtractor(HTMLParser):
+    """
+    Streaming html parser collecting the text of the data fed to it into
+    `text`, equal to ``BeautifulSoup(data, 'html.parser').get_text()`` but
+    without building a document tree.
+    """
+
+    # BeautifulSoup doesn't consider strings within these elements to be text
+    EXCLUDED = frozenset(('script', 'style', 'template', 'rt', 'rp'))
+    # (…) and collapses strings of only whitespace, except within these elements
+    PRESERVE_WHITESPACE = frozenset(('pre', 'textarea'))
+
+    def __init__(self):
+        # handle character references like BeautifulSoup does, see handle_charref and handle_entityref
+        super().__init__(convert_charrefs=False)
+        self.text = []
+        self.data = []
+        self.open_tags = []
+        self.excluded = 0
+        self.preserved = 0
+
+    def end_data(self, include=False):
+        # like BeautifulSoup, consider consecutive data a single string, ended by any markup
+        if self.data:
+            data = ''.join(self.data)
+            self.data = []
+            if not self.preserved and not data.strip(' \n\t\f\r'):
+                data = '\n' if '\n' in data else ' '
+            if include or not self.excluded:
+                self.text.append(data)
+
+    def handle_starttag(self, tag, attrs):
+        self.end_data()
+        self.open_tags.append(tag)
+        self.excluded += tag in self.EXCLUDED
+        self.preserved += tag in self.PRESERVE_WHITESPACE
+
+    def handle_startendtag(self, tag, attrs):
+        # self-closing tags contain no text
+        self.end_data()
+
+    def handle_endtag(self, tag):
+        self.end_data()
+        # like BeautifulSoup, close everything up to the matching start tag, ignore the end tag if there's none
+        if tag in self.open_tags:
+            closed = None
+            while closed != tag:
+                closed = self.open_tags.pop()
+                self.excluded -= closed in self.EXCLUDED
+                self.preserved -= closed in self.PRESERVE_WHITESPACE
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    def handle_charref(self, name):
+        if (digits := re.match(r'x[0-9a-f]+|[0-9]+', name, re.IGNORECASE)) is None:
+            self.handle_data(name)
+        else:
+            # unescape deals with out of range references (and windows-1252 codepoints) like BeautifulSoup
+            self.handle_data(unescape(f'&#{digits.group()};') + name[digits.end():])
+
+    def handle_entityref(self, name):
+        self.handle_data(EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name, f'&{name}'))
+
+    def handle_comment(self, data):
+        self.end_data()
+
+    def handle_decl(self, decl):
+        self.end_data()
+
+    def handle_pi(self, data):
+        self.end_data()
+
+    def unknown_decl(self, data):
+        self.end_data()
+        if data.upper().startswith('CDATA['):
+            # BeautifulSoup considers CDATA to be text, even within excluded elements
+            self.handle_data(data[len('CDATA['):])
+            self.end_data(include=True)
+
+    def close(self):
+        super().close()
+        self.end_data()
+
+
+def strip_html(data: str) -> str:
+    """
+    Remove html markup from *data*, leaving only its text.
+    """
+    if '<' not in data and '&' not in data and data.strip(' \n\t\f\r'):
+        # fast path, no markup or character references to deal with
+        return data
+
+    parser = HTMLTextExtractor()
+    parser.feed(data)
+    parser.close()
+    return ''.join(parser.text)
+
+
+def normalize_html(data: str, unescape_html: bool = True):
     """
     Removed html text such as <br>, <p>, then calls the normalize() function
     """
-    soup = BeautifulSoup(data, features='html.parser')
-    return normalize(soup.get_text())
+    return normalize(strip_html(data), unescape_html=unescape_html)
+
+
+def normalize_piece(normalizer, data: str, unescape_html: bool = True) -> Tuple[str, bool]:
+    """
+    Normalize *data*, a piece of a larger text, with *normalizer* as if it
+    were normalized along with the text before it. ftfy stops unescaping
+    html entities for the rest of a text from the first line containing a
+    < onward, *unescape_html* tells whether it still would for this piece.
+    Returns the normalized text and whether ftfy would still unescape html
+    entities in the text after it.
+    """
+    if normalizer not in NORMALIZERS.values():
+        # not known to fix unicode errors with ftfy
+        return normalizer(data), unescape_html
+
+    if normalizer is normalize_html:
+        # ftfy gets to see the text of the html
+        data, normalizer = strip_html(data), normalize
+    # (…) after the backslash escapes have been decoded
+    return normalizer(data, unescape_html=unescape_html), unescape_html and '<' not in _decode_escapes(data)
+
+
+def _last_break(data: str, start: int, end: int, white_space: bool) -> int:
+    if white_space:
+        return max(data.rfind(' ', start, end), data.rfind('\t', start, end), data.rfind('\n', start, end)) + 1
+    return data.rfind('\n', start, end) + 1
+
+
+def split_point(data: str, white_space: bool = False) -> int:
+    """
+    Determine the position right after the last line break (or any white
+    space if *white_space* is set) in *data* that is not part of html
+    markup. Normalizing the text up to that point and the text after it
+    separately (with `normalize_piece`, which carries over whether html
+    entities are still unescaped) yields the same words as normalizing
+    *data* as a whole. Returns 0 when there's no such position.
+    """
+    if '<' not in data:
+        # fast path, no markup to avoid
+        return _last_break(data, 0, len(data), white_space)
+
+    split = position = 0
+    for markup in _MARKUP.finditer(data):
+        if (start := data.find('<', position, markup.start())) >= 0:
+            # a < that doesn't start complete markup, the remainder of data is not safe to split
+            return max(split, _last_break(data, position, start, white_space))
+        split = max(split, _last_break(data, position, markup.start(), white_space))
+        position = markup.end()
+
+    end = data.find('<', position)
+    return max(split, _last_break(data, position, len(data) if end < 0 else end, white_space))
 
 
 NORMALIZERS = {
     'norm': normalize,
     'norm-html': normalize_html,
+    'norm-fast': normalize_fast,
 }
 NORMALIZERS[''] = NORMALIZERS['norm-html']
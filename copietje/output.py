@@ -0,0 +1,165 @@
+from abc import ABC, abstractmethod
+import csv
+import json
+from logging import getLogger as logger
+from time import monotonic
+from typing import List, Tuple
+
+from copietje.runs import MatchRun
+
+
+LOG = logger(__name__)
+
+# buffer size of files written to, avoiding a system call for every few matches
+BUFFER_SIZE = 1 << 20
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS matches (
+        query_uid TEXT,
+        match_uid TEXT,
+        similarity REAL,
+        run_id INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS matches_query_uid ON matches (run_id, query_uid);
+"""
+
+
+class MatchWriter(ABC):
+    """
+    Writes the ranked ``(similarity, uid)`` matches of unlabeled documents
+    as yielded by the match engines (see `copietje.matching.ENGINES`).
+    """
+
+    def __init__(self):
+        self.num_queries = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, uid: str, matches: List[Tuple[float, str]]):
+        self.num_queries += 1
+        self._write(uid, matches)
+
+    @abstractmethod
+    def _write(self, uid: str, matches: List[Tuple[float, str]]):
+        """
+        Write the *matches* of the document identified by *uid*.
+        """
+
+    def close(self):
+        pass
+
+
+class TextWriter(MatchWriter):
+    """
+    Writes a line for every unlabeled document, listing the uids of its
+    matches and the highest similarity.
+    """
+
+    def __init__(self, out_file):
+        super().__init__()
+        self.out_file = out_file
+
+    def _write(self, uid, matches):
+        self.out_file.write(f'{uid}  # max {matches[0][0]:.3f} matches {", ".join(match[1] for match in matches)}\n')
+
+    def close(self):
+        self.out_file.flush()
+
+
+class JSONLinesWriter(TextWriter):
+    """
+    Writes a JSON object for every unlabeled document, listing its matches
+    as objects of ``uid`` and ``similarity``.
+    """
+
+    def _write(self, uid, matches):
+        self.out_file.write(json.dumps({
+            'uid': uid,
+            'matches': [{'uid': match_uid, 'similarity': similarity} for similarity, match_uid in matches],
+        }))
+        self.out_file.write('\n')
+
+
+class CSVWriter(TextWriter):
+    """
+    Writes a row of ``query_uid, match_uid, similarity`` for every match.
+    """
+
+    def __init__(self, out_file):
+        super().__init__(out_file)
+        self.writer = csv.writer(out_file)
+        self.writer.writerow(('query_uid', 'match_uid', 'similarity'))
+
+    def _write(self, uid, matches):
+        self.writer.writerows((uid, match_uid, similarity) for similarity, match_uid in matches)
+
+
+class MatchTable(MatchWriter):
+    """
+    Writes matches to the ``matches`` table of the case database, tagged
+    with the id of the *run* they were produced by. Rows are inserted in
+    batches, each batch in a transaction of its own, checkpointing the
+    progress of the run. A batch is written when it reaches *batch_size*
+    rows or when the last batch was written more than *flush_interval*
+    seconds ago, whichever comes first. The run is marked as finished when
+    leaving the context without errors.
+    """
+
+    def __init__(self, database, run: MatchRun, batch_size: int = 10_000, flush_interval: float = 60.0):
+        super().__init__()
+        self.database = database
+        self.database.cursor().executescript(SCHEMA)
+        self.run = run
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rows: List[Tuple[str, str, float, int]] = []
+        self.num_rows = 0
+        self.last_uid = run.last_uid
+        self.last_flush = monotonic()
+
+    @property
+    def run_id(self) -> int:
+        return self.run.run_id
+
+    def __exit__(self, exc_type, *exc_info):
+        # store whatever is complete, also when exiting because of an error, the checkpoint allows resuming from there
+        self.close()
+        if exc_type is None:
+            self.run.finish()
+
+    def _write(self, uid, matches):
+        self.rows.extend((uid, match_uid, similarity, self.run_id) for similarity, match_uid in matches)
+        # rows are only written for complete documents, the last one being the checkpoint
+        self.last_uid = uid
+        if len(self.rows) >= self.batch_size or monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.database.cursor().executemany(
+                """
+                INSERT INTO matches (query_uid, match_uid, similarity, run_id)
+                VALUES (?, ?, ?, ?)
+                """,
+                self.rows
+            )
+            self.run.checkpoint(self.last_uid)
+            self.database.commit()
+            self.num_rows += len(self.rows)
+            self.rows.clear()
+
+        self.last_flush = monotonic()
+
+    def close(self):
+        self.flush()
+
+
+FILE_WRITERS = {
+    'text': TextWriter,
+    'jsonl': JSONLinesWriter,
+    'csv': CSVWriter,
+}
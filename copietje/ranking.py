@@ -1,7 +1,20 @@
+from collections import defaultdict
 from os import PathLike
-from typing import Tuple, Iterable
+from typing import Any, Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
 
 from copietje import Condenser
+from copietje.sketches import SketchStore
+
+
+# number of documents compared to all documents of the corpus at once by rank_matrix and score_matrix, comparing a
+# block takes a few bytes for every document in the corpus for every document in the block
+BLOCK_SIZE = 64
+# number of documents to find similar pairs of documents for at once in full_jaccard_pairs
+PAIRS_BLOCK_SIZE = 1024
+# number of hash values compared between checks for documents that can no longer be similar enough when thresholding
+PRUNE_INTERVAL = 4
 
 
 def rank(corpus, query_hash, threshold=None):
@@ -24,14 +37,101 @@ def score(corpus, query_hash, threshold=None):
     )
 
 
-def rank_matrix(corpus):
-    for query_path, query_hash in corpus.items():
-        yield query_path, rank(corpus, query_hash)
+def _scores(corpus, threshold=None, block_size=BLOCK_SIZE):
+    """
+    Compare the minhashes of all documents in *corpus* to each other, in
+    blocks of *block_size* documents. Yields 3-tuples of the identifier of
+    a document, the positions in *corpus* of the documents that are at
+    least *threshold* similar to it and their similarities.
+    """
+    if not corpus:
+        return
+
+    store = SketchStore.from_hashvalues(list(corpus), np.stack([minhash.hashvalues for minhash in corpus.values()]))
+    hashvalues = store.hashvalues
+    num_documents, permutations = hashvalues.shape
+    # the minimum number of equal hash values of a pair to be at least threshold similar (as MinHash.jaccard would)
+    min_count = np.count_nonzero(np.arange(permutations + 1) / permutations < (threshold or 0.0))
+    # permutation-major copy, comparing a single hash value of every document in a block to all documents at a time
+    columns = np.ascontiguousarray(hashvalues.T)
+    equal = np.empty(block_size * num_documents, dtype=bool)
+    # when thresholding, blocks are only compared to the documents from the start of the block onwards, the pairs with
+    # documents of later blocks are kept for those blocks (mirrored) by the number of the block
+    mirrored: Dict[int, List[Tuple[np.ndarray, np.ndarray, np.ndarray]]] = defaultdict(list)
+
+    for start in range(0, num_documents, block_size):
+        block = hashvalues[start:start + block_size]
+        end = start + len(block)
+        first = start if min_count else 0
+        # the documents that can still be at least threshold similar to one of the documents in the block
+        candidates = np.arange(first, num_documents)
+        counts = np.zeros((len(block), len(candidates)), dtype=np.min_scalar_type(permutations))
+        pruned = False
+        for permutation, values in enumerate(columns):
+            block_equal = equal[:counts.size].reshape(counts.shape)
+            np.equal(block[:, permutation, None], values[candidates] if pruned else values[first:], out=block_equal)
+            counts += block_equal.view(np.uint8)
+
+            remaining = permutations - permutation - 1
+            if min_count and remaining % PRUNE_INTERVAL == 0:
+                # drop the documents that would not reach min_count even if all remaining hash values are equal
+                reachable = np.flatnonzero(counts.max(axis=0) + remaining >= min_count)
+                if len(reachable) < len(candidates):
+                    candidates, counts, pruned = candidates[reachable], counts[:, reachable], True
+
+        rows, positions = np.nonzero(counts >= min_count)
+        rows, others, similarities = rows + start, candidates[positions], counts[rows, positions] / permutations
+        if min_count:
+            later = np.flatnonzero(others >= end)
+            # keep the pairs with later documents for the blocks of those documents, ordered by block number
+            order = later[np.argsort(others[later], kind='stable')]
+            numbers, boundaries = np.unique(others[order] // block_size, return_index=True)
+            for number, pairs in zip(numbers.tolist(), np.split(order, boundaries[1:])):
+                mirrored[number].append((others[pairs], rows[pairs], similarities[pairs]))
+
+            if earlier := mirrored.pop(start // block_size, None):
+                # add the pairs with documents of earlier blocks, ordering the pairs by row and position in corpus
+                earlier.append((rows, others, similarities))
+                rows, others, similarities = (np.concatenate(arrays) for arrays in zip(*earlier))
+                order = np.lexsort((others, rows))
+                rows, others, similarities = rows[order], others[order], similarities[order]
+
+        # split the pairs (ordered by row) into those of every document in the block, including those without any
+        boundaries = np.searchsorted(rows, np.arange(start + 1, end))
+        yield from zip(store.uids[start:end], np.split(others, boundaries), np.split(similarities, boundaries))
+
 
+def rank_matrix(corpus, threshold=None, block_size=BLOCK_SIZE):
+    """
+    Rank all documents in *corpus* for every document in *corpus* (see
+    `rank`), yielding 2-tuples of the identifier of a document and its
+    ranked list of ``(similarity, identifier)``. Documents are compared in
+    blocks of *block_size* documents, using *threshold* to leave out less
+    similar documents (rather than creating a tuple for every pair of
+    documents).
+    """
+    identifiers = list(corpus)
+    # position of every identifier in sorted order, ranking documents of equal similarity as rank would
+    order = np.empty(len(identifiers), dtype=np.intp)
+    order[sorted(range(len(identifiers)), key=identifiers.__getitem__)] = np.arange(len(identifiers))
 
-def score_matrix(corpus):
-    for query_path, query_hash in corpus.items():
-        yield query_path, score(corpus, query_hash)
+    for query_path, others, similarities in _scores(corpus, threshold, block_size):
+        ranked = np.lexsort((-order[others], -similarities))
+        yield query_path, [(similarity, identifiers[other])
+                           for similarity, other in zip(similarities[ranked].tolist(), others[ranked].tolist())]
+
+
+def score_matrix(corpus, threshold=None, block_size=BLOCK_SIZE):
+    """
+    Score all documents in *corpus* for every document in *corpus* (see
+    `score`), yielding 2-tuples of the identifier of a document and its
+    list of ``(similarity, identifier)`` in the order of *corpus*. See
+    `rank_matrix` for *threshold* and *block_size*.
+    """
+    identifiers = list(corpus)
+    for query_path, others, similarities in _scores(corpus, threshold, block_size):
+        yield query_path, [(similarity, identifiers[other])
+                           for similarity, other in zip(similarities.tolist(), others.tolist())]
 
 
 def corpus_from_generator(iter_data: Iterable[Tuple[PathLike, str]], condenser=None):
@@ -50,6 +150,13 @@ def full_jaccard_on_token_set(tokens1: set, tokens2: set):
     return len(tokens1 & tokens2) / union_length
 
 
+def full_jaccard_on_hashes(hashes1: np.ndarray, hashes2: np.ndarray) -> float:
+    # equivalent to full_jaccard_on_token_set for sorted arrays of distinct token hashes
+    intersection_length = len(np.intersect1d(hashes1, hashes2, assume_unique=True))
+    union_length = len(hashes1) + len(hashes2) - intersection_length
+    return intersection_length / union_length if union_length else 0
+
+
 def full_jaccard(corpus, query_token_set):
     return (
         # create 2-tuples of (jaccard, document) for every document in the corpus
@@ -58,12 +165,199 @@ def full_jaccard(corpus, query_token_set):
     )
 
 
-def full_jaccard_matrix(corpus):
-    for query_path, query_token_set in corpus.items():
-        yield query_path, full_jaccard(corpus, query_token_set)
+class TokenSets:
+    """
+    Token sets of a corpus of documents as sorted arrays of distinct uint64
+    token hashes (see `Condenser.make_token_hashes`), kept in a single
+    buffer: the hashes of the document at position ``i`` are
+    ``hashes[offsets[i]:offsets[i + 1]]``.
+    """
+
+    def __init__(self, identifiers: Sequence, hashes: np.ndarray, offsets: np.ndarray):
+        self.identifiers = list(identifiers)
+        self.hashes = hashes
+        self.offsets = offsets
+        self.rows = {identifier: row for row, identifier in enumerate(self.identifiers)}
+
+    @classmethod
+    def from_arrays(cls, items: Iterable[Tuple[Any, np.ndarray]]) -> 'TokenSets':
+        """
+        Create token sets from 2-tuples of an identifier and the sorted
+        array of distinct token hashes of that document.
+        """
+        identifiers, arrays = [], []
+        for identifier, hashes in items:
+            identifiers.append(identifier)
+            arrays.append(hashes)
+
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(hashes) for hashes in arrays], out=offsets[1:])
+        return cls(identifiers, np.concatenate(arrays or [np.empty(0)]).astype(np.uint64), offsets)
+
+    def __len__(self) -> int:
+        return len(self.identifiers)
+
+    def __getitem__(self, identifier) -> np.ndarray:
+        row = self.rows[identifier]
+        return self.hashes[self.offsets[row]:self.offsets[row + 1]]
+
+    @property
+    def sizes(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def jaccard(self, query: np.ndarray) -> np.ndarray:
+        """
+        Calculate the exact jaccard similarity of the token hashes of
+        *query* to the token set of every document.
+        """
+        # look up every hash of every document in the (sorted) query at once, count the hashes found per document
+        positions = np.minimum(np.searchsorted(query, self.hashes), max(len(query) - 1, 0))
+        found = np.zeros(len(self.hashes) + 1, dtype=np.int64)
+        if len(query):
+            np.cumsum(query[positions] == self.hashes, out=found[1:])
+        intersections = found[self.offsets[1:]] - found[self.offsets[:-1]]
+        unions = self.sizes + len(query) - intersections
+        # a union of 0 means both documents are empty, which are 0 similar
+        return np.divide(intersections, unions, out=np.zeros(len(self)), where=unions > 0)
+
+
+def full_jaccard_pairs(token_sets: TokenSets, threshold: float, block_size: int = PAIRS_BLOCK_SIZE):
+    """
+    Find all pairs of documents in *token_sets* that share any tokens and
+    are at least *threshold* similar by their exact jaccard similarity, as
+    a sparse matrix of three arrays: the positions of the first and the
+    second document of every pair (the first being the smaller) and their
+    similarities.
+
+    Documents are paired up through an index of the first tokens of every
+    document by increasing frequency, as two documents can only be at least
+    *threshold* similar when these share a token (prefix filtering). Pairs
+    are found for blocks of *block_size* documents at a time. The lower the
+    threshold, the more of every document is indexed (including common
+    tokens), making low thresholds considerably more expensive.
+    """
+    sizes = token_sets.sizes
+    owners = np.repeat(np.arange(len(token_sets)), sizes)
+    # number every distinct token by its frequency, rarest first, and order the tokens of every document by number
+    _, tokens, frequencies = np.unique(token_sets.hashes, return_inverse=True, return_counts=True)
+    numbers = np.empty(len(frequencies), dtype=np.int64)
+    numbers[np.argsort(frequencies, kind='stable')] = np.arange(len(frequencies))
+    tokens = numbers[tokens.reshape(-1)]
+    order = np.lexsort((tokens, owners))
+    tokens = tokens[order]
+
+    # a pair sharing at least threshold * size tokens shares one of the first size - that + 1 tokens of either document
+    # (flooring rather than rounding up, including a token more when in doubt)
+    prefix_sizes = np.minimum(sizes - np.floor(threshold * sizes).astype(np.int64) + 1, sizes)
+    token_positions = np.arange(len(tokens)) - token_sets.offsets[owners]
+    in_prefix = token_positions < prefix_sizes[owners]
+    prefix_owners, prefix_tokens, prefix_positions = owners[in_prefix], tokens[in_prefix], token_positions[in_prefix]
+    # the prefix tokens as lists of the documents containing them (ordered by document), the end of the list of every
+    # prefix token and the position of every prefix token in the lists
+    postings = np.lexsort((prefix_owners, prefix_tokens))
+    posting_owners, posting_tokens, posting_positions = (prefix_owners[postings], prefix_tokens[postings],
+                                                         prefix_positions[postings])
+    posting_ends = np.searchsorted(posting_tokens, posting_tokens, side='right')
+    positions = np.empty(len(postings), dtype=np.int64)
+    positions[postings] = np.arange(len(postings))
+
+    firsts, seconds, similarities = [], [], []
+    for start in range(0, len(token_sets), block_size):
+        entries = slice(*np.searchsorted(prefix_owners, (start, start + block_size)))
+        # pair the prefix tokens of the documents in the block with the later documents in their lists
+        begins, ends = positions[entries] + 1, posting_ends[positions[entries]]
+        counts = ends - begins
+        partners = np.repeat(begins - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        first, second = np.repeat(prefix_owners[entries], counts), posting_owners[partners]
+        # the first token a pair shares limits the number of tokens it can share to the number of tokens from there on
+        bounds = np.minimum(sizes[first] - np.repeat(prefix_positions[entries], counts),
+                            sizes[second] - posting_positions[partners])
+        pairs, pair_entries = np.unique(first * len(token_sets) + second, return_inverse=True)
+        max_intersections = np.zeros(len(pairs), dtype=np.int64)
+        np.maximum.at(max_intersections, pair_entries.reshape(-1), bounds)
+        first, second = np.divmod(pairs, len(token_sets))
+        # a pair sharing fewer than threshold / (1 + threshold) of their combined tokens is less than threshold similar
+        # (allowing for rounding errors, verifying the pairs that might be)
+        feasible = max_intersections >= threshold / (1 + threshold) * (sizes[first] + sizes[second]) - 1e-9
+        first, second = first[feasible], second[feasible]
+
+        intersections = _intersections(token_sets.offsets, tokens, len(frequencies), first, second)
+        pair_similarities = intersections / (sizes[first] + sizes[second] - intersections)
+        similar = pair_similarities >= threshold
+        firsts.append(first[similar])
+        seconds.append(second[similar])
+        similarities.append(pair_similarities[similar])
+
+    return (np.concatenate(firsts or [np.empty(0, dtype=np.int64)]),
+            np.concatenate(seconds or [np.empty(0, dtype=np.int64)]),
+            np.concatenate(similarities or [np.empty(0)]))
+
+
+def _intersections(offsets, tokens, num_tokens, first, second):
+    """
+    Count the tokens shared by pairs of documents *first* and *second*,
+    ordered by *first*. The tokens of 64 consecutive documents at a time
+    are marked in a bitmap of all tokens, a bit per document, looking up
+    the tokens of the second document of every pair in there.
+    """
+    bitmap = np.zeros(num_tokens, dtype=np.uint64)
+    intersections = np.empty(len(first), dtype=np.int64)
+    groups, boundaries = np.unique(first // 64, return_index=True)
+    for group, pairs in zip(groups.tolist(), np.split(np.arange(len(first)), boundaries[1:])):
+        group_offsets = offsets[group * 64:group * 64 + 65]
+        group_tokens = tokens[group_offsets[0]:group_offsets[-1]]
+        bits = np.uint64(1) << np.repeat(np.arange(len(group_offsets) - 1, dtype=np.uint64), np.diff(group_offsets))
+        np.bitwise_or.at(bitmap, group_tokens, bits)
+
+        lengths = offsets[second[pairs] + 1] - offsets[second[pairs]]
+        positions = np.repeat(offsets[second[pairs]] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        shifts = np.repeat((first[pairs] - group * 64).astype(np.uint64), lengths)
+        found = (bitmap[tokens[positions]] >> shifts) & np.uint64(1)
+        intersections[pairs] = np.bincount(np.repeat(np.arange(len(pairs)), lengths), weights=found,
+                                           minlength=len(pairs))
+        bitmap[group_tokens] = 0
+
+    return intersections
+
+
+def full_jaccard_matrix(corpus, threshold=None):
+    """
+    Calculate the exact jaccard similarity of every document in *corpus*
+    to every document in *corpus*, yielding 2-tuples of the identifier of
+    a document and its list of ``(jaccard, identifier)`` in the order of
+    *corpus*. *corpus* is either a `TokenSets` or a `dict` of token sets.
+
+    With a *threshold*, only documents that are at least *threshold*
+    similar are listed, using `full_jaccard_pairs` rather than comparing
+    every pair of documents.
+    """
+    if not isinstance(corpus, TokenSets):
+        for query_path, query_token_set in corpus.items():
+            yield query_path, [(jaccard, identifier) for jaccard, identifier in full_jaccard(corpus, query_token_set)
+                               if not threshold or jaccard >= threshold]
+        return
+
+    identifiers = corpus.identifiers
+    if not threshold:
+        for query_path in identifiers:
+            yield query_path, list(zip(corpus.jaccard(corpus[query_path]).tolist(), identifiers))
+        return
+
+    first, second, similarities = full_jaccard_pairs(corpus, threshold)
+    # every non-empty document is completely similar to itself
+    documents = np.flatnonzero(corpus.sizes)
+    rows = np.concatenate((first, second, documents))
+    others = np.concatenate((second, first, documents))
+    similarities = np.concatenate((similarities, similarities, np.ones(len(documents))))
+    order = np.lexsort((others, rows))
+    boundaries = np.searchsorted(rows[order], np.arange(1, len(corpus)))
+    for query_path, row_others, row_similarities in zip(identifiers, np.split(others[order], boundaries),
+                                                        np.split(similarities[order], boundaries)):
+        yield query_path, [(similarity, identifiers[other])
+                           for similarity, other in zip(row_similarities.tolist(), row_others.tolist())]
 
 
 def full_token_set_from_generator(iter_data: Iterable[Tuple[str, str]], condenser=None):
     condenser = condenser or Condenser()
-    return {path: condenser.make_token_set(data)
-            for path, data in iter_data}
+    return TokenSets.from_arrays((path, condenser.make_token_hashes(data))
+                                 for path, data in iter_data)
@@ -0,0 +1,197 @@
+from logging import getLogger as logger
+from typing import List
+
+from copietje.matching import DocumentSelection
+
+
+LOG = logger(__name__)
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS runs (
+        run_id INTEGER PRIMARY KEY,
+        -- equivalent to UNIXEPOCH(), which doesn't seem to be supported
+        ts INTEGER DEFAULT (CAST(strftime('%s', 'now') as INTEGER)),
+        engine TEXT,
+        threshold REAL,
+        fn_weight REAL,
+        -- sequence number of the last document downloaded when the run started (see documents.seq), anything
+        -- downloaded later is left to the next run
+        max_seq INTEGER,
+        -- the finished run an incremental run adds to, NULL for a run matching all documents
+        since_run INTEGER,
+        -- checkpoint: the uid of the last unlabeled document the matches of which have been stored
+        last_uid TEXT,
+        finished INTEGER DEFAULT 0
+    );
+    -- the labeled documents a run matched to, recorded when it started
+    CREATE TABLE IF NOT EXISTS run_labels (
+        run_id INTEGER,
+        uid TEXT,
+        PRIMARY KEY (run_id, uid)
+    ) WITHOUT ROWID;
+"""
+
+
+def create_schema(database):
+    """
+    Create the tables recording match runs, renaming the columns of the
+    tables of a database created before.
+    """
+    database.cursor().executescript(SCHEMA)
+    if 'max_rowid' in {row[1] for row in database.execute('PRAGMA table_info(runs)')}:
+        # runs recorded before documents were given a sequence number, which starts out as their rowid
+        LOG.info('renaming column max_rowid of runs table to max_seq')
+        database.execute('ALTER TABLE runs RENAME COLUMN max_rowid TO max_seq')
+        database.commit()
+
+
+class MatchRun:
+    """
+    A match run storing its matches in the database (see
+    `copietje.output.MatchTable`), checkpointing its progress as it goes.
+    A run that was interrupted can be resumed from its last checkpoint.
+
+    An incremental run adds to the last finished run with the same
+    parameters (*since_run*), matching only what that run did not: the
+    unlabeled documents downloaded or unlabeled since to all labeled
+    documents, and the other unlabeled documents to the documents labeled
+    since. The matches of a document are spread over the runs it was
+    matched in, matches to documents that were unlabeled since are not
+    retracted.
+    """
+
+    def __init__(self, database, run_id: int, max_seq: int, since_run: int = None, since_seq: int = None,
+                 last_uid: str = None):
+        self.database = database
+        self.run_id = run_id
+        self.max_seq = max_seq
+        self.since_run = since_run
+        self.since_seq = since_seq
+        self.last_uid = last_uid
+
+    @classmethod
+    def start(cls, database, engine: str, threshold: float, fn_weight: float, incremental: bool = False) -> 'MatchRun':
+        """
+        Record a new run with its parameters in the ``runs`` table, along
+        with the labeled documents it will match to.
+        """
+        create_schema(database)
+        since_run = None
+        if incremental:
+            if row := cls._latest(database, threshold, fn_weight, finished=True):
+                since_run = row['run_id']
+            else:
+                LOG.info('no finished run to add to, matching all documents')
+
+        cursor = database.cursor()
+        cursor.execute(
+            """
+            INSERT INTO runs (engine, threshold, fn_weight, max_seq, since_run)
+            VALUES (?, ?, ?, (SELECT COALESCE(MAX(seq), 0) FROM documents), ?)
+            """,
+            (engine, threshold, fn_weight, since_run)
+        )
+        run_id = cursor.lastrowid
+        cursor.execute(
+            """
+            INSERT INTO run_labels (run_id, uid)
+            SELECT runs.run_id, documents.uid
+            FROM runs JOIN documents ON documents.seq <= runs.max_seq
+            WHERE runs.run_id = ? AND documents.privileged_status IS NOT NULL AND documents.minhash IS NOT NULL
+            """,
+            (run_id,)
+        )
+        database.commit()
+        run = cls.load(database, run_id)
+        LOG.info('started run %d%s', run.run_id, f', adding to run {since_run}' if since_run else '')
+        return run
+
+    @classmethod
+    def load(cls, database, run_id: int) -> 'MatchRun':
+        row = database.cursor().execute("""
+            SELECT run.run_id, run.max_seq, run.since_run, since.max_seq, run.last_uid
+            FROM runs AS run
+            LEFT JOIN runs AS since ON since.run_id = run.since_run
+            WHERE run.run_id = ?
+        """, (run_id,)).fetchone()
+        return cls(database, *row)
+
+    @classmethod
+    def resume(cls, database, threshold: float, fn_weight: float) -> 'MatchRun | None':
+        """
+        Retrieve the most recent run with the same parameters that did not
+        finish, if any.
+        """
+        create_schema(database)
+        row = cls._latest(database, threshold, fn_weight)
+        if not row or row['finished']:
+            return None
+
+        run = cls.load(database, row['run_id'])
+        LOG.info('resuming run %d after uid %s', run.run_id, run.last_uid)
+        return run
+
+    @staticmethod
+    def _latest(database, threshold, fn_weight, finished=False):
+        return database.cursor().execute(f"""
+            SELECT run_id, finished FROM runs
+            WHERE threshold = ? AND fn_weight = ? {'AND finished' if finished else ''}
+            ORDER BY run_id DESC
+            LIMIT 1
+        """, (threshold, fn_weight)).fetchone()
+
+    @property
+    def selections(self) -> List[DocumentSelection]:
+        """
+        The documents that are part of this run, leaving out the unlabeled
+        documents up to and including the checkpoint. Documents downloaded
+        after the run started are left to the next run.
+        """
+        parameters = {
+            'run_id': self.run_id,
+            'max_seq': self.max_seq,
+            'since_run': self.since_run,
+            'since_seq': self.since_seq,
+            'last_uid': self.last_uid,
+        }
+        queries = 'seq <= :max_seq AND (:last_uid IS NULL OR uid > :last_uid)'
+        labeled = 'uid IN (SELECT uid FROM run_labels WHERE run_id = :run_id)'
+        if self.since_run is None:
+            return [DocumentSelection(queries, labeled, parameters)]
+
+        matched = 'uid IN (SELECT uid FROM run_labels WHERE run_id = :since_run)'
+        selections = [
+            # documents downloaded or unlabeled since, matched to all labeled documents
+            DocumentSelection(f'{queries} AND (seq > :since_seq OR {matched})', labeled, parameters),
+            # documents matched before, matched to the documents labeled since
+            DocumentSelection(f'{queries} AND seq <= :since_seq AND NOT {matched}', f'{labeled} AND NOT {matched}',
+                              parameters),
+        ]
+        return [selection for selection in selections if not selection.is_empty(self.database)]
+
+    def checkpoint(self, last_uid: str):
+        """
+        Record that the matches of all unlabeled documents up to and
+        including *last_uid* have been stored. Part of the transaction
+        storing those matches, committed by the caller.
+        """
+        self.database.cursor().execute("""
+            UPDATE runs SET last_uid = ? WHERE run_id = ?
+        """, (last_uid, self.run_id))
+        self.last_uid = last_uid
+
+    def finish(self):
+        cursor = self.database.cursor()
+        cursor.execute("""
+            UPDATE runs SET finished = 1 WHERE run_id = ?
+        """, (self.run_id,))
+        # the labels of earlier runs with the same parameters are no longer needed to add to
+        cursor.execute("""
+            DELETE FROM run_labels WHERE run_id IN (
+                SELECT earlier.run_id FROM runs AS earlier JOIN runs AS run
+                    ON earlier.threshold = run.threshold AND earlier.fn_weight = run.fn_weight
+                WHERE run.run_id = ? AND earlier.run_id < run.run_id
+            )
+        """, (self.run_id,))
+        self.database.commit()
+        LOG.info('finished run %d', self.run_id)
@@ -0,0 +1,225 @@
+from collections import OrderedDict
+from functools import cache
+import struct
+from typing import Dict, Iterable, List, Sequence
+
+from datasketch import MinHash
+import numpy as np
+
+
+# constants as used by datasketch to permute 32-bit hash values
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+DEFAULT_SEED = 1
+
+# LeanMinHash.serialize(buf, '!') writes a big endian header (seed: int64, length: int32) followed by the hash values
+_HEADER = struct.Struct('!qi')
+
+
+def _cardinalities(values: Sequence[int | None] | np.ndarray) -> np.ndarray:
+    # cardinalities as floats, turning unknown (None) cardinalities into NaN
+    return np.asarray(values, dtype=np.float64)
+
+
+@cache
+def permutations(num_perm: int, seed: int = DEFAULT_SEED) -> np.ndarray:
+    """
+    Retrieve the ``(2, num_perm)`` permutation parameters datasketch uses
+    for a `MinHash` with *num_perm* permutations and *seed*.
+    """
+    # let datasketch generate the parameters, guaranteeing the same values are used
+    return MinHash(num_perm=num_perm, seed=seed).permutations
+
+
+def serialize(hashvalues: np.ndarray, seed: int = DEFAULT_SEED) -> List[bytes]:
+    """
+    Serialize every row of a ``(n, permutations)`` matrix of hash values to
+    the format produced by ``LeanMinHash.serialize(buffer, '!')``.
+    """
+    hashvalues = np.atleast_2d(hashvalues)
+    header = _HEADER.pack(seed, hashvalues.shape[1])
+    # convert the full matrix to big endian uint32 at once, slice the raw bytes per row
+    body = hashvalues.astype('>u4').tobytes()
+    row_size = hashvalues.shape[1] * 4
+    return [header + body[start:start + row_size] for start in range(0, len(body), row_size)]
+
+
+def deserialize(blobs: Iterable[bytes]) -> np.ndarray:
+    """
+    Deserialize blobs produced by ``LeanMinHash.serialize(buffer, '!')``
+    into a ``(n, permutations)`` matrix of uint32 hash values.
+    """
+    blobs = list(blobs)
+    if not blobs:
+        return np.empty((0, 0), dtype=np.uint32)
+
+    data = b''.join(blobs)
+    if len(data) != len(blobs[0]) * len(blobs):
+        raise ValueError('cannot deserialize minhashes of different sizes')
+
+    # view all blobs as rows of big endian uint32 values at once, dropping the values that make up the header
+    return np.frombuffer(data, dtype='>u4').reshape(len(blobs), -1)[:, _HEADER.size // 4:].astype(np.uint32)
+
+
+def size_filter(cardinalities: np.ndarray, other_cardinalities: np.ndarray, threshold: float) -> np.ndarray:
+    """
+    Determine which pairs of sets of *cardinalities* and
+    *other_cardinalities* could be at least *threshold* similar, as a
+    boolean mask. The jaccard similarity of two sets is at most the size of
+    the smaller set divided by the size of the larger one. Pairs involving
+    an unknown (NaN) cardinality are kept.
+    """
+    smaller = np.minimum(cardinalities, other_cardinalities)
+    larger = np.maximum(cardinalities, other_cardinalities)
+    # NaN for unknown cardinalities and pairs of empty sets, comparing false
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return ~(smaller / larger < threshold)
+
+
+class SketchStore:
+    """
+    Compact store of minhashes, kept as rows of a contiguous ``(n,
+    permutations)`` matrix of uint32 hash values, an array of the uids of
+    those rows and a mapping of uid to row number. Along with every
+    minhash, the store keeps the cardinality of the token set it was
+    calculated from (NaN if unknown, see `size_filter`).
+    """
+
+    def __init__(self, permutations: int, capacity: int = 1024):
+        self._hashvalues = np.empty((capacity, permutations), dtype=np.uint32)
+        self._uids = np.empty(capacity, dtype=object)
+        self._cardinalities = np.full(capacity, np.nan)
+        self._size = 0
+        self.rows: Dict[str, int] = {}
+
+    @classmethod
+    def from_hashvalues(cls, uids: Sequence[str], hashvalues: np.ndarray,
+                        cardinalities: Sequence[int | None] | np.ndarray | None = None) -> 'SketchStore':
+        """
+        Create a store from a sequence of uids and the ``(n, permutations)``
+        matrix of hash values for those uids, optionally along with the
+        cardinalities of their token sets (`None` where unknown).
+        """
+        hashvalues = np.atleast_2d(hashvalues)
+        store = cls(hashvalues.shape[1], capacity=len(uids))
+        store.extend(uids, hashvalues, cardinalities)
+        return store
+
+    @classmethod
+    def from_blobs(cls, uids: Sequence[str], blobs: Iterable[bytes],
+                   cardinalities: Sequence[int | None] | np.ndarray | None = None) -> 'SketchStore':
+        """
+        Create a store from a sequence of uids and the serialized minhashes
+        for those uids (see `deserialize`).
+        """
+        return cls.from_hashvalues(uids, deserialize(blobs), cardinalities)
+
+    @property
+    def hashvalues(self) -> np.ndarray:
+        return self._hashvalues[:self._size]
+
+    @property
+    def uids(self) -> np.ndarray:
+        return self._uids[:self._size]
+
+    @property
+    def cardinalities(self) -> np.ndarray:
+        return self._cardinalities[:self._size]
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, uid: str) -> bool:
+        return uid in self.rows
+
+    def __getitem__(self, uid: str) -> np.ndarray:
+        return self._hashvalues[self.rows[uid]]
+
+    def add(self, uid: str, hashvalues: np.ndarray, cardinality: int = None):
+        """
+        Add the hash values for *uid*, replacing the values of a previously
+        added *uid*.
+        """
+        if (row := self.rows.get(uid)) is not None:
+            self._hashvalues[row] = hashvalues
+            self._cardinalities[row] = _cardinalities((cardinality,))[0]
+        else:
+            self.extend((uid,), np.asarray(hashvalues).reshape(1, -1), (cardinality,))
+
+    def extend(self, uids: Sequence[str], hashvalues: np.ndarray,
+               cardinalities: Sequence[int | None] | np.ndarray | None = None):
+        """
+        Add the rows of a ``(n, permutations)`` matrix of hash values for a
+        sequence of uids not yet in the store.
+        """
+        start, end = self._size, self._size + len(uids)
+        if end > len(self._uids):
+            # grow the buffers to (at least) double their size, keeping the cost of adding rows amortized
+            capacity = max(end, len(self._uids) * 2)
+            self._hashvalues = np.resize(self._hashvalues, (capacity, self._hashvalues.shape[1]))
+            self._uids = np.resize(self._uids, capacity)
+            self._cardinalities = np.resize(self._cardinalities, capacity)
+
+        self._hashvalues[start:end] = hashvalues
+        self._uids[start:end] = uids
+        self._cardinalities[start:end] = np.nan if cardinalities is None else _cardinalities(cardinalities)
+        self.rows.update(zip(uids, range(start, end)))
+        self._size = end
+
+    def jaccard(self, query: int | np.ndarray, candidate_rows: Sequence[int] | np.ndarray) -> np.ndarray:
+        """
+        Estimate the jaccard similarity of *query* (either a row number or a
+        vector of hash values) to the minhashes in *candidate_rows*, as
+        ``LeanMinHash.jaccard`` would.
+        """
+        if np.ndim(query) == 0:
+            query = self._hashvalues[query]
+        candidates = self._hashvalues[np.asarray(candidate_rows, dtype=np.intp)]
+        return np.count_nonzero(candidates == query, axis=1) / candidates.shape[1]
+
+    def lookup(self, uids: Sequence[str]) -> List[int]:
+        """
+        Look up the row numbers of *uids*.
+        """
+        return [self.rows[uid] for uid in uids]
+
+
+class LRUSketchStore(SketchStore):
+    """
+    `SketchStore` holding at most *max_size* minhashes, evicting the least
+    recently added or looked up minhash when full.
+    """
+
+    def __init__(self, permutations: int, max_size: int):
+        super().__init__(permutations, capacity=max_size)
+        self.max_size = max_size
+        # keep rows ordered by use, least recently used first
+        self.rows: OrderedDict[str, int] = OrderedDict()
+
+    def add(self, uid: str, hashvalues: np.ndarray, cardinality: int = None):
+        if uid in self.rows:
+            self.rows.move_to_end(uid)
+            self._hashvalues[self.rows[uid]] = hashvalues
+            self._cardinalities[self.rows[uid]] = _cardinalities((cardinality,))[0]
+        elif self._size < self.max_size:
+            super().extend((uid,), np.asarray(hashvalues).reshape(1, -1), (cardinality,))
+        else:
+            # reuse the row of the least recently used minhash
+            _, row = self.rows.popitem(last=False)
+            self._hashvalues[row] = hashvalues
+            self._uids[row] = uid
+            self._cardinalities[row] = _cardinalities((cardinality,))[0]
+            self.rows[uid] = row
+
+    def extend(self, uids: Sequence[str], hashvalues: np.ndarray,
+               cardinalities: Sequence[int | None] | np.ndarray | None = None):
+        if cardinalities is None:
+            cardinalities = [None] * len(uids)
+        for uid, values, cardinality in zip(uids, hashvalues, cardinalities):
+            self.add(uid, values, cardinality)
+
+    def lookup(self, uids: Sequence[str]) -> List[int]:
+        rows = super().lookup(uids)
+        for uid in uids:
+            self.rows.move_to_end(uid)
+        return rows
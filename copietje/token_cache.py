@@ -0,0 +1,157 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Dict, Iterable, List
+
+
+# default maximum number of tokens to keep the hash value of
+DEFAULT_SIZE = 1 << 20
+
+
+class TokenCache(ABC):
+    """
+    Bounded mapping of tokens to the value of *hash_func* for their UTF-8
+    encoding, avoiding hashing the same tokens over and over again. Keeps
+    track of hits and misses. Safe to share between threads (like the
+    worker threads of a download, see `copietje.download.StreamHasher`).
+    """
+
+    def __init__(self, hash_func: Callable[[bytes], int], max_size: int = DEFAULT_SIZE):
+        if max_size < 1:
+            raise ValueError('max_size should be at least 1')
+
+        self.hash_func = hash_func
+        self.max_size = max_size
+        self.hits = self.misses = self.evictions = 0
+        self._lock = Lock()
+
+    def __getstate__(self):
+        # locks can't be pickled (the condenser is sent to worker processes), create a new one when unpickling
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = Lock()
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / ((self.hits + self.misses) or 1)
+
+    def stats(self) -> Dict[str, float]:
+        return {'size': len(self), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hit_rate}
+
+    def hash_tokens(self, tokens: Iterable[str]) -> List[int]:
+        """
+        Hash *tokens*, taking the hash values of known tokens from the cache.
+        """
+        with self._lock:
+            return self._hash_tokens(tokens)
+
+    @abstractmethod
+    def _hash_tokens(self, tokens: Iterable[str]) -> List[int]:
+        """
+        Hash *tokens*, called with the lock held.
+        """
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """
+        The number of tokens in the cache.
+        """
+
+
+class LRUTokenCache(TokenCache):
+    """
+    `TokenCache` evicting the least recently used token when full.
+    """
+
+    def __init__(self, hash_func: Callable[[bytes], int], max_size: int = DEFAULT_SIZE):
+        super().__init__(hash_func, max_size)
+        self.hashes: OrderedDict[str, int] = OrderedDict()
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def _hash_tokens(self, tokens: Iterable[str]) -> List[int]:
+        hashes = self.hashes
+        values = []
+        misses = 0
+        for token in tokens:
+            if (value := hashes.get(token)) is None:
+                # encode the token, the hash function expects bytes
+                value = hashes[token] = self.hash_func(token.encode('utf-8'))
+                misses += 1
+                if len(hashes) > self.max_size:
+                    hashes.popitem(last=False)
+                    self.evictions += 1
+            else:
+                hashes.move_to_end(token)
+            values.append(value)
+
+        self.hits += len(values) - misses
+        self.misses += misses
+        return values
+
+
+class ClockTokenCache(TokenCache):
+    """
+    `TokenCache` approximating least recently used eviction with the CLOCK
+    algorithm: a hit only marks a token as referenced, rather than moving
+    it to the end of a queue. A hand sweeps the slots when full, giving
+    referenced tokens a second chance and evicting the first token that
+    wasn't referenced since the last sweep.
+    """
+
+    def __init__(self, hash_func: Callable[[bytes], int], max_size: int = DEFAULT_SIZE):
+        super().__init__(hash_func, max_size)
+        # slot of every token, the token and hash value in each slot and whether it was referenced since the last sweep
+        self.slots: Dict[str, int] = {}
+        self.tokens: List[str] = []
+        self.values: List[int] = []
+        self.referenced = bytearray(max_size)
+        self.hand = 0
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _hash_tokens(self, tokens: Iterable[str]) -> List[int]:
+        slots, referenced = self.slots, self.referenced
+        values = []
+        misses = 0
+        for token in tokens:
+            if (slot := slots.get(token)) is not None:
+                referenced[slot] = 1
+                values.append(self.values[slot])
+                continue
+
+            # encode the token, the hash function expects bytes
+            value = self.hash_func(token.encode('utf-8'))
+            misses += 1
+            if len(self.tokens) < self.max_size:
+                slots[token] = len(self.tokens)
+                self.tokens.append(token)
+                self.values.append(value)
+            else:
+                while referenced[self.hand]:
+                    referenced[self.hand] = 0
+                    self.hand = (self.hand + 1) % self.max_size
+                del slots[self.tokens[self.hand]]
+                self.evictions += 1
+                slots[token] = self.hand
+                self.tokens[self.hand] = token
+                self.values[self.hand] = value
+                self.hand = (self.hand + 1) % self.max_size
+            values.append(value)
+
+        self.hits += len(values) - misses
+        self.misses += misses
+        return values
+
+
+TOKEN_CACHES: Dict[str, Callable[..., TokenCache]] = {
+    'lru': LRUTokenCache,
+    'clock': ClockTokenCache,
+}
@@ -1,13 +1,33 @@
-from functools import cache, partial
+from functools import cache, lru_cache, partial
+from inspect import signature
 from more_itertools import windowed
-from typing import Iterable
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
 
+import numpy as np
 import spacy
 
 
+SPACY_MODEL = 'nl_core_news_md'
+# default number of documents spaCy processes at once in the batch tokenizers
+SPACY_BATCH_SIZE = 64
+# the pipeline components of SPACY_MODEL, spaCy's tokenizer is not one of them and is always loaded
+_SPACY_COMPONENTS = ('tok2vec', 'morphologizer', 'tagger', 'parser', 'senter', 'attribute_ruler', 'lemmatizer', 'ner')
+# sentence boundaries are set by the dependency parser, which only depends on tok2vec
+_SENTENCE_COMPONENTS = ('tok2vec', 'parser')
+
+# base of the polynomial rolling hashes, odd so it has a multiplicative inverse modulo 2 ** 32
+ROLLING_BASE = np.uint32(0x01000193)
+_INVERSE_BASE = np.uint32(pow(int(ROLLING_BASE), -1, 1 << 32))
+# longest array of powers of the bases to keep cached (4 MiB), the powers for longer texts are calculated every time
+MAX_CACHED_POWERS = 1 << 20
+# the code points str.split() splits on, all of which are below U+3001
+_WHITE_SPACE = np.array([ordinal for ordinal in range(0x3001) if chr(ordinal).isspace()], dtype=np.uint32)
+
+
 @cache
-def _load_spacy(name):
-    return spacy.load(name)
+def _load_spacy(name, components=()):
+    # load a pipeline with only the components that are needed, skipping the others saves loading and running them
+    return spacy.load(name, exclude=[component for component in _SPACY_COMPONENTS if component not in components])
 
 
 def tokenize_white_space(data: str) -> Iterable[str]:
@@ -20,23 +40,153 @@ def tokenize_white_space_n_grams(data: str, n: int = 3) -> Iterable[str]:
 
 
 def tokenize_split_words(data: str) -> Iterable[str]:
-    nlp = _load_spacy('nl_core_news_md')
+    nlp = _load_spacy(SPACY_MODEL)
     spacied_data = nlp(data)
     return [word.text for word in spacied_data]
 
 
 def tokenize_split_sents(data: str) -> Iterable[str]:
-    nlp = _load_spacy('nl_core_news_md')
+    nlp = _load_spacy(SPACY_MODEL, _SENTENCE_COMPONENTS)
     spacied_data = nlp(data)
     assert spacied_data.has_annotation('SENT_START')
     return [sent.text for sent in spacied_data.sents]
 
 
+def tokenize_split_words_batch(documents: Iterable[str],
+                               n_process: int = 1,
+                               batch_size: int = SPACY_BATCH_SIZE) -> Iterator[List[str]]:
+    nlp = _load_spacy(SPACY_MODEL)
+    for spacied_data in nlp.pipe(documents, n_process=n_process, batch_size=batch_size):
+        yield [word.text for word in spacied_data]
+
+
+def tokenize_split_sents_batch(documents: Iterable[str],
+                               n_process: int = 1,
+                               batch_size: int = SPACY_BATCH_SIZE) -> Iterator[List[str]]:
+    nlp = _load_spacy(SPACY_MODEL, _SENTENCE_COMPONENTS)
+    for spacied_data in nlp.pipe(documents, n_process=n_process, batch_size=batch_size):
+        assert spacied_data.has_annotation('SENT_START')
+        yield [sent.text for sent in spacied_data.sents]
+
+
 def tokenize_char_n_grams(data, n=2):
     for idx in range(len(data) - n + 1):
         yield data[idx:idx + n]
 
 
+def _calculate_powers(base: np.uint32, length: int) -> np.ndarray:
+    # base to the powers 0 through length - 1, wrapping around 2 ** 32
+    powers = np.full(length, base, dtype=np.uint32)
+    powers[0] = 1
+    return np.cumprod(powers, dtype=np.uint32)
+
+
+# lengths are powers of two, at most one entry for every length up to MAX_CACHED_POWERS for both bases
+_cached_powers = lru_cache(maxsize=2 * MAX_CACHED_POWERS.bit_length())(_calculate_powers)
+
+
+def _powers(base: np.uint32, length: int) -> np.ndarray:
+    if length > MAX_CACHED_POWERS:
+        # don't keep the powers for a very large document around for the rest of the process
+        return _calculate_powers(base, length)
+    return _cached_powers(base, length)
+
+
+def _prefix_sums(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # prefix sums of value * ROLLING_BASE ** -i, along with the powers of ROLLING_BASE: the polynomial hash of
+    # values[start:end] (the sum of value * ROLLING_BASE ** (end - 1 - i)) is the difference of the prefix sums at
+    # end and start, multiplied by ROLLING_BASE ** (end - 1), making every hash a constant time operation
+    length = 1 << len(values).bit_length()  # keep the number of cached powers in check
+    prefix_sums = np.zeros(len(values) + 1, dtype=np.uint32)
+    np.cumsum(values * _powers(_INVERSE_BASE, length)[:len(values)], dtype=np.uint32, out=prefix_sums[1:])
+    return prefix_sums, _powers(ROLLING_BASE, length)
+
+
+def hash_char_n_grams(data: str, n: int = 2) -> np.ndarray:
+    """
+    Calculate a 32-bit rolling hash for every n-gram of characters in
+    *data*, the same n-grams `tokenize_char_n_grams` produces, without
+    creating a string for each of them.
+    """
+    code_points = np.frombuffer(data.encode('utf-32-le'), dtype=np.uint32)
+    if len(code_points) < n:
+        return np.empty(0, dtype=np.uint32)
+
+    prefix_sums, powers = _prefix_sums(code_points)
+    return (prefix_sums[n:] - prefix_sums[:-n]) * powers[n - 1:len(code_points)]
+
+
+def hash_white_space_n_grams(data: str, n: int = 3) -> np.ndarray:
+    """
+    Calculate a 32-bit hash for every n-gram of words separated by white
+    space, the same n-grams `tokenize_white_space_n_grams` produces, as a
+    rolling hash over the hashes of words.
+    """
+    code_points = np.frombuffer(data.encode('utf-32-le'), dtype=np.uint32)
+    # words start at a non-space preceded by a space (or the start of data), and end the other way around
+    is_word = np.concatenate(([False], ~np.isin(code_points, _WHITE_SPACE), [False]))
+    starts, ends = np.flatnonzero(is_word[1:] != is_word[:-1]).reshape(-1, 2).T
+    prefix_sums, powers = _prefix_sums(code_points)
+    words = (prefix_sums[ends] - prefix_sums[starts]) * powers[ends - 1]
+
+    # like windowed, a single n-gram of all words when there are fewer than n
+    starts = np.arange(len(words) - n + 1 if len(words) >= n else min(len(words), 1))
+    ends = np.minimum(starts + n, len(words))
+    prefix_sums, powers = _prefix_sums(words)
+    return (prefix_sums[ends] - prefix_sums[starts]) * powers[ends - 1]
+
+
+def streaming_context(tokenizer) -> Tuple[str, int] | None:
+    """
+    Determine the trailing context of preceding text that *tokenizer* needs
+    to produce the tokens that cross the boundary between two pieces of
+    text, as a 2-tuple of unit (``'words'`` or ``'chars'``) and amount.
+    Returns `None` for tokenizers that need the full text at once.
+    """
+    # look through partials like the n-gram tokenizers in TOKENIZERS
+    func = getattr(tokenizer, 'func', tokenizer)
+    if func is tokenize_white_space:
+        # tokens never contain white space, no context required
+        return 'words', 0
+    if func in (tokenize_white_space_n_grams, tokenize_char_n_grams, hash_white_space_n_grams, hash_char_n_grams):
+        n = getattr(tokenizer, 'keywords', {}).get('n', signature(func).parameters['n'].default)
+        return 'words' if func in (tokenize_white_space_n_grams, hash_white_space_n_grams) else 'chars', n - 1
+
+    # notably spaCy's tokenize_split_words, which turns white space around the split (other than a single space
+    # between words) into tokens of its own
+    return None
+
+
+def produces_hashes(tokenizer) -> bool:
+    """
+    Determine whether *tokenizer* produces 32-bit hash values of its tokens
+    (as a numpy array) rather than the tokens themselves.
+    """
+    return getattr(tokenizer, 'func', tokenizer) in (hash_white_space_n_grams, hash_char_n_grams)
+
+
+# tokenizers that can process a stream of documents more efficiently than one at a time
+BATCH_TOKENIZERS: Dict[Callable, Callable[..., Iterator[List[str]]]] = {
+    tokenize_split_words: tokenize_split_words_batch,
+    tokenize_split_sents: tokenize_split_sents_batch,
+}
+
+
+def tokenize_batch(tokenizer: Callable[[str], Iterable[str]],
+                   documents: Iterable[str],
+                   n_process: int = 1,
+                   batch_size: int = SPACY_BATCH_SIZE) -> Iterator[Iterable[str]]:
+    """
+    Tokenize multiple documents with *tokenizer*, yielding the tokens of
+    each document in order. The spaCy based tokenizers stream documents
+    through ``nlp.pipe`` in batches of *batch_size*, using *n_process*
+    processes; other tokenizers handle one document at a time.
+    """
+    if batch_tokenizer := BATCH_TOKENIZERS.get(tokenizer):
+        return batch_tokenizer(documents, n_process=n_process, batch_size=batch_size)
+    return map(tokenizer, documents)
+
+
 TOKENIZERS = {
     'split-sents': tokenize_split_sents,
     'sents': tokenize_split_sents,
@@ -55,5 +205,17 @@ TOKENIZERS = {
     '4-grams': partial(tokenize_char_n_grams, n=4),
     '5-grams': partial(tokenize_char_n_grams, n=5),
     '6-grams': partial(tokenize_char_n_grams, n=6),
+    # the same n-grams, hashed by a rolling hash rather than the hash function
+    'rolling-white-space-2-grams': partial(hash_white_space_n_grams, n=2),
+    'rolling-white-space-3-grams': partial(hash_white_space_n_grams, n=3),
+    'rolling-white-space-4-grams': partial(hash_white_space_n_grams, n=4),
+    'rolling-white-space-5-grams': partial(hash_white_space_n_grams, n=5),
+    'rolling-white-space-6-grams': partial(hash_white_space_n_grams, n=6),
+    'rolling-1-grams': partial(hash_char_n_grams, n=1),
+    'rolling-2-grams': partial(hash_char_n_grams, n=2),
+    'rolling-3-grams': partial(hash_char_n_grams, n=3),
+    'rolling-4-grams': partial(hash_char_n_grams, n=4),
+    'rolling-5-grams': partial(hash_char_n_grams, n=5),
+    'rolling-6-grams': partial(hash_char_n_grams, n=6),
 }
 TOKENIZERS[''] = TOKENIZERS['ws']
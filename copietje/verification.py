@@ -0,0 +1,144 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from logging import getLogger as logger
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from copietje.ranking import full_jaccard_on_hashes
+
+
+LOG = logger(__name__)
+
+# default distance to the threshold within which estimated similarities are verified
+DEFAULT_MARGIN = 0.1
+# number of token sets kept in memory by every process verifying matches, labeled documents tend to be matched over and
+# over again
+TOKEN_SET_CACHE_SIZE = 4096
+
+# the condenser to be used by a process verifying matches, set by _init_worker
+_condenser: Any = None
+
+
+def _init_worker(condenser):
+    global _condenser
+    _condenser = condenser
+    _token_hashes.cache_clear()
+
+
+@lru_cache(maxsize=TOKEN_SET_CACHE_SIZE)
+def _token_hashes(path: Optional[str]) -> Optional[np.ndarray]:
+    if not path:
+        # documents that were never downloaded have a NULL (or empty) path, treat them like a missing file
+        LOG.warning('no file to process, document was not downloaded')
+        return None
+    try:
+        with open(path, 'rt') as text:
+            return _condenser.make_token_hashes(text.read())
+    except (IOError, UnicodeError) as e:
+        LOG.warning('failed to process file "%s": %s', path, e)
+        return None
+
+
+def _verify(query_path: Optional[str],
+            candidates: List[Tuple[float, str, Optional[str]]]) -> List[Tuple[float, str, bool]]:
+    """
+    Calculate the exact jaccard similarity of the document at *query_path*
+    to the ``(similarity, uid, path)`` *candidates*, resulting in a list of
+    ``(similarity, uid, verified)``. The estimated similarity is kept when
+    either of the files can't be read or has no path.
+    """
+    if (query := _token_hashes(query_path)) is None:
+        return [(similarity, uid, False) for similarity, uid, _ in candidates]
+
+    verified = []
+    for similarity, uid, path in candidates:
+        if (hashes := _token_hashes(path)) is not None:
+            verified.append((full_jaccard_on_hashes(query, hashes), uid, True))
+        else:
+            verified.append((similarity, uid, False))
+    return verified
+
+
+class ExactVerifier:
+    """
+    Replaces the estimated similarity of borderline matches (those within
+    *margin* of *threshold*) by their exact jaccard similarity, calculated
+    from the token sets of the downloaded files (see
+    `Condenser.make_token_hashes`) by *jobs* worker processes. The match
+    engine should be run with a threshold of ``threshold - margin`` to
+    include the matches that are estimated just below *threshold*.
+    *condenser* should tokenize documents like the condenser used to
+    calculate their minhashes.
+    """
+
+    def __init__(self, database, condenser, threshold: float, margin: float = DEFAULT_MARGIN, jobs: int = 1):
+        self.condenser = condenser
+        self.threshold = threshold
+        self.margin = margin
+        self.jobs = jobs
+        self.paths: Dict[str, Optional[str]] = {
+            row[0]: row[1] for row in database.execute('SELECT uid, path FROM documents WHERE minhash IS NOT NULL')
+        }
+        self.num_verified = self.num_changed = 0
+
+    @property
+    def engine_threshold(self) -> float:
+        return max(self.threshold - self.margin, 0.0)
+
+    def verify(self, results):
+        """
+        Verify the borderline matches of the ``(uid, matches)`` *results* of
+        a match engine, yielding the re-ranked results in the same order,
+        leaving out matches that turn out to be less than threshold similar
+        (and unlabeled documents without any matches left).
+        """
+        _init_worker(self.condenser)
+        if self.jobs > 1:
+            with ProcessPoolExecutor(self.jobs, initializer=_init_worker, initargs=(self.condenser,)) as executor:
+                yield from self._verify(results, executor)
+        else:
+            yield from self._verify(results, None)
+
+        LOG.info('verified %d borderline matches, %d of which changed', self.num_verified, self.num_changed)
+
+    def _verify(self, results, executor):
+        # keep a limited number of queries in flight, yielding their results in the order of the queries
+        pending = deque()
+        for uid, matches in results:
+            borderline = [(similarity, match_uid, self.paths[match_uid]) for similarity, match_uid in matches
+                          if abs(similarity - self.threshold) <= self.margin]
+            if not borderline:
+                pending.append((uid, matches, None))
+            elif executor:
+                pending.append((uid, matches, executor.submit(_verify, self.paths[uid], borderline)))
+            else:
+                pending.append((uid, matches, _verify(self.paths[uid], borderline)))
+
+            if len(pending) >= self.jobs * 16:
+                if verified := self._rerank(*pending.popleft()):
+                    yield verified
+
+        while pending:
+            if verified := self._rerank(*pending.popleft()):
+                yield verified
+
+    def _rerank(self, uid, matches, verified):
+        if verified is None:
+            return uid, matches
+        if not isinstance(verified, list):
+            verified = verified.result()
+
+        exact = {match_uid: similarity for similarity, match_uid, is_exact in verified if is_exact}
+        self.num_verified += len(exact)
+        self.num_changed += sum(similarity != exact.get(match_uid, similarity) for similarity, match_uid in matches)
+        matches = sorted(((exact.get(match_uid, similarity), match_uid) for similarity, match_uid in matches
+                          if exact.get(match_uid, similarity) >= self.threshold),
+                         reverse=True)
+        return (uid, matches) if matches else None
+
+
+VERIFIERS = {
+    'exact': ExactVerifier,
+}
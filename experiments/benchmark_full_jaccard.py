@@ -0,0 +1,25 @@
+from time import perf_counter
+
+import numpy as np
+
+from copietje.ranking import full_jaccard_pairs, TokenSets
+
+
+rng = np.random.default_rng(42)
+# token sets of families of ten near duplicates of about 300 tokens, drawn from a vocabulary with a skewed distribution
+# (like words in text), every version replacing a few more tokens
+num_documents, vocabulary = 100_000, 200_000
+token_sets = []
+for family in range(num_documents // 10):
+    tokens = rng.zipf(1.2, size=300) % vocabulary
+    for version in range(10):
+        tokens[rng.integers(0, len(tokens), size=version * 3)] = rng.zipf(1.2, size=version * 3) % vocabulary
+        token_sets.append((f'doc-{family:05}-{version}', np.unique(tokens.astype(np.uint64))))
+
+corpus = TokenSets.from_arrays(token_sets)
+print(f'{len(corpus)} token sets of {len(corpus.hashes)} tokens in {corpus.hashes.nbytes / 1e6:.1f} MB')
+
+for threshold in (0.9, 0.8):
+    start_time = perf_counter()
+    first, second, similarities = full_jaccard_pairs(corpus, threshold)
+    print(f'threshold {threshold}: {len(first)} pairs in {perf_counter() - start_time:.1f} s')
@@ -0,0 +1,64 @@
+from random import Random
+from time import perf_counter
+
+from bs4 import BeautifulSoup
+
+from copietje.normalizers import normalize, normalize_fast, normalize_html, strip_html
+
+
+num_documents = 200
+
+
+def strip_html_soup(data):
+    # text extraction as normalize_html did before, building a full document tree with BeautifulSoup
+    return BeautifulSoup(data, features='html.parser').get_text()
+
+
+def normalize_html_soup(data):
+    return normalize(strip_html_soup(data))
+
+
+rng = Random(42)
+vocabulary = [''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=rng.randint(2, 9))) for _ in range(2000)]
+
+
+def plain_text():
+    lines = (' '.join(rng.choices(vocabulary, k=rng.randint(5, 15))) + '.' for _ in range(rng.randint(20, 200)))
+    return '\n'.join(lines)
+
+
+def large_text(line):
+    # a multi-megabyte document, with the same special characters on every line
+    return '\n'.join(f'{" ".join(rng.choices(vocabulary, k=12))}{line}' for _ in range(40_000))
+
+
+def html():
+    paragraphs = (f'<p class="body">{text}</p>' for text in plain_text().split('\n'))
+    return (f'<html><head><title>{rng.choice(vocabulary)}</title><style>p {{ margin: 0; }}</style></head>'
+            f'<body><!-- generated -->{"".join(paragraphs)}<script>var x = 1 &lt; 2;</script></body></html>')
+
+
+for name, generate in (('plain text', plain_text), ('html', html)):
+    documents = [generate() for _ in range(num_documents)]
+    num_bytes = sum(len(document.encode('utf-8')) for document in documents)
+    assert all(strip_html_soup(document) == strip_html(document) for document in documents)
+
+    for implementation in (strip_html_soup, strip_html, normalize_html_soup, normalize_html):
+        start_time = perf_counter()
+        for document in documents:
+            implementation(document)
+        run_time = perf_counter() - start_time
+        print(f'{name}, {implementation.__name__}: {num_documents / run_time:.0f} docs/s '
+              f'({num_bytes / run_time / 1e6:.2f} MB/s)')
+
+for name, line in (('ascii', '.'), ('accents', ', café naïve Über.'), ('currency and quotes', ', €5 “x”.'),
+                   ('entities', ' &amp; more.')):
+    document = large_text(line)
+    assert normalize(document) == normalize_fast(document)
+
+    for implementation in (normalize, normalize_fast):
+        start_time = perf_counter()
+        implementation(document)
+        run_time = perf_counter() - start_time
+        print(f'large document ({len(document.encode("utf-8")) / 1e6:.1f} MB, {name}), {implementation.__name__}: '
+              f'{run_time:.2f} s')
@@ -0,0 +1,21 @@
+from time import perf_counter
+
+from datasketch import LeanMinHash
+import numpy as np
+
+from copietje.ranking import rank_matrix, score_matrix
+
+
+rng = np.random.default_rng(42)
+# minhashes of families of ten near duplicates, every version differing in a few more hash values
+num_documents, permutations = 50_000, 128
+hashvalues = rng.integers(0, 1 << 32, size=(num_documents, permutations), dtype=np.uint64)
+for offset in range(1, 10):
+    versions = hashvalues[offset::10]
+    versions[:, :permutations - offset * 8] = hashvalues[::10][:len(versions), :permutations - offset * 8]
+corpus = {f'doc-{idx:05}': LeanMinHash(seed=1, hashvalues=values) for idx, values in enumerate(hashvalues)}
+
+for name, matrix in (('score_matrix', score_matrix), ('rank_matrix', rank_matrix)):
+    start_time = perf_counter()
+    num_pairs = sum(len(scores) for _, scores in matrix(corpus, threshold=0.5))
+    print(f'{name}: {num_pairs} pairs of {num_documents} documents in {perf_counter() - start_time:.1f} s')
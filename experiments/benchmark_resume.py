@@ -0,0 +1,38 @@
+import sqlite3
+from hashlib import sha1
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from copietje.download import determine_stream, KnownDigests, SCHEMA
+
+
+num_documents = 1_000_000
+
+
+class Trace(dict):
+    # mimics the parts of a hansken trace that determine_stream uses
+    def __init__(self, uid, digest):
+        super().__init__({'data.text.size': 1024, 'data.text.mimeClass': 'text', 'data.text.hash.sha1': digest})
+        self.uid = uid
+
+
+# a resumed download, every trace was downloaded before
+traces = [Trace(f'image:{num}', sha1(str(num).encode('utf-8')).hexdigest()) for num in range(num_documents)]
+
+with TemporaryDirectory() as tmp, sqlite3.connect(Path(tmp) / 'resume.db') as database:
+    database.row_factory = sqlite3.Row
+    database.executescript(SCHEMA)
+    database.executemany('INSERT INTO documents (uid, stream, sha1) VALUES (?, ?, ?)',
+                         ((trace.uid, 'text', trace['data.text.hash.sha1']) for trace in traces))
+    database.commit()
+
+    start_time = perf_counter()
+    known = KnownDigests.from_database(database)
+    print(f'loaded {len(known)} digests in {perf_counter() - start_time:.2f}s')
+
+    for name, kwargs in (('database', {'database': database}), ('preloaded', {'known': known})):
+        start_time = perf_counter()
+        assert not any(determine_stream(trace, **kwargs) for trace in traces)
+        run_time = perf_counter() - start_time
+        print(f'{name}: skipped {num_documents} traces in {run_time:.2f}s ({num_documents / run_time:.0f} traces/s)')
@@ -0,0 +1,29 @@
+from random import Random
+from time import perf_counter
+
+from copietje import Condenser
+from copietje.tokenizers import TOKENIZERS
+
+
+rng = Random(42)
+vocabulary = [''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=rng.randint(2, 9))) for _ in range(2000)]
+# a document of about 1 MB, already normalized
+document = ' '.join(rng.choices(vocabulary, k=200_000))[:1_000_000]
+
+
+def timed(func, *args):
+    start_time = perf_counter()
+    func(*args)
+    return perf_counter() - start_time
+
+
+for tokenizer in ('5-grams', 'rolling-5-grams', 'white-space-3-grams', 'rolling-white-space-3-grams'):
+    condenser = Condenser(tokenizer=TOKENIZERS[tokenizer], normalizer=None)
+    if tokenizer.startswith('rolling-'):
+        tokenize_time = timed(condenser.tokenizer, document)
+    else:
+        # tokens of the string tokenizers still need to be hashed by the hash function
+        tokenize_time = timed(lambda data: [condenser.hash_func(token.encode('utf-8'))
+                                            for token in condenser.tokenizer(data)], document)
+    print(f'{tokenizer}: tokens and hashes in {tokenize_time:.3f} s, '
+          f'make_hash in {timed(condenser.make_hash, document):.2f} s')
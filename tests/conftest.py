@@ -1,6 +1,14 @@
+from hashlib import sha1
 from pathlib import Path
+from random import Random
+import sqlite3
 
 import pytest
+import spacy
+
+from copietje import Condenser
+from copietje.download import SCHEMA
+from copietje.sketches import serialize
 
 
 @pytest.fixture
@@ -8,6 +16,70 @@ def test_files():
     return Path(__file__).parent / 'files'
 
 
+@pytest.fixture
+def spacy_model(tmp_path, monkeypatch):
+    """
+    A blank Dutch spaCy pipeline with a rule-based sentencizer, standing in
+    for the trained model used by the spaCy based tokenizers.
+    """
+    nlp = spacy.blank('nl')
+    nlp.add_pipe('sentencizer')
+    nlp.to_disk(tmp_path / 'spacy-model')
+    monkeypatch.setattr('copietje.tokenizers.SPACY_MODEL', str(tmp_path / 'spacy-model'))
+    return nlp
+
+
 @pytest.fixture
 def test_database_file():
     return Path(__file__).parent / 'database' / 'test_news_edits.db'
+
+
+@pytest.fixture
+def case_database(tmp_path):
+    """
+    A case database with families of near duplicate documents, the first
+    version of every other family and the fourth version of every third
+    family are labeled. The last version of every family is an exact copy
+    of the second. The number of distinct tokens of every document is
+    recorded along with its minhash.
+    """
+    rng = Random(42)
+    vocabulary = [''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=rng.randint(2, 9))) for _ in range(2000)]
+    condenser = Condenser()
+
+    with sqlite3.connect(tmp_path / 'case.db') as database:
+        database.row_factory = sqlite3.Row
+        database.executescript(SCHEMA)
+
+        for family in range(12):
+            text = rng.choices(vocabulary, k=200)
+            versions = []
+            for version in range(4):
+                # every version replaces a few more words of the previous version
+                for idx in rng.sample(range(len(text)), k=version * 8):
+                    text[idx] = rng.choice(vocabulary)
+                versions.append(' '.join(text))
+            versions.append(versions[1])
+
+            for version, data in enumerate(versions):
+                minhash, num_tokens = condenser.make_hash_with_count(data)
+                database.execute(
+                    """
+                    INSERT INTO documents (uid, path, stream, size, sha1, tags, privileged_status, minhash, num_tokens)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        f'doc-{family:02}-{version}',
+                        f'{family:02}/{version}.txt',
+                        'text',
+                        len(data.encode('utf-8')),
+                        sha1(data.encode('utf-8')).hexdigest(),
+                        None,
+                        'privileged' if (version, family % 2) == (0, 0) or (version, family % 3) == (3, 0) else None,
+                        serialize(minhash.hashvalues)[0],
+                        num_tokens,
+                    )
+                )
+
+        database.commit()
+        yield database
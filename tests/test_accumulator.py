@@ -0,0 +1,180 @@
+from io import StringIO
+
+import pytest
+
+from copietje import Condenser, COUNT_PRECISION
+from copietje.normalizers import NORMALIZERS, split_point
+from copietje.tokenizers import streaming_context, TOKENIZERS
+
+
+HTML = """<html><head><style>
+p { color: red; }
+</style></head>
+<body><p>Some $TEXT with an &amp; entity</p><br>
+<!-- a comment
+spanning lines -->
+wIth <h1 class="split
+attribute">CAPITALS !</h1><script>var x = 1;
+</script>
+- SpAces, CharacTers& and punctuation?
+</body></html>
+"""
+
+
+def _chunks(data, size):
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('split', (
+    ('text\n', 5),
+    ('no line break', 0),
+    ('<p>a\nb</p>\nc', 11),
+    ('a\n<script>b\n', 2),
+    ('a\n<!-- b\nc', 2),
+    ('a\n<p class="b\n', 2),
+    ('a\nb <br> c\nd <p', 11),
+    ('a\n<template>b\n', 2),
+    ('a\n<ruby>b<rp>(\n</rp><rt>c\n</rt></ruby>', 2),
+    ('a\n<ruby>b<rp>(</rp><rt>c</rt></ruby>\n', 37),
+))
+def test_split_point(split):
+    data, expected = split
+    assert split_point(data) == expected
+
+
+@pytest.mark.parametrize('split', (
+    ('some text', 5),
+    ('some\ttext\n', 10),
+    ('<p class="a b">c d', 17),
+    ('a <script>b c</script>', 2),
+    ('a <!-- b c --><p class="d e', 2),
+))
+def test_split_point_white_space(split):
+    data, expected = split
+    assert split_point(data, white_space=True) == expected
+
+
+@pytest.mark.parametrize(('tokenizer', 'context'), (
+    ('ws', ('words', 0)),
+    ('words', None),
+    ('white-space-4-grams', ('words', 3)),
+    ('1-grams', ('chars', 0)),
+    ('5-grams', ('chars', 4)),
+    ('rolling-white-space-4-grams', ('words', 3)),
+    ('rolling-5-grams', ('chars', 4)),
+    ('sents', None),
+))
+def test_streaming_context(tokenizer, context):
+    assert streaming_context(TOKENIZERS[tokenizer]) == context
+
+
+@pytest.mark.parametrize('normalizer', ('norm', 'norm-html', None))
+@pytest.mark.parametrize('tokenizer', ('ws', '1-grams', '3-grams', 'white-space-2-grams', 'white-space-5-grams',
+                                       'rolling-3-grams', 'rolling-white-space-5-grams', 'words'))
+@pytest.mark.parametrize('size', (3, 64, 1 << 20))
+def test_accumulator(request, test_files, normalizer, tokenizer, size):
+    if tokenizer == 'words':
+        request.getfixturevalue('spacy_model')
+    condenser = Condenser(tokenizer=TOKENIZERS[tokenizer], normalizer=normalizer and NORMALIZERS[normalizer])
+
+    for document in (HTML, (test_files / 'data1').read_text(), '', 'a\nb', 'short\n\ntext  \nwith\n\nbreaks\n'):
+        accumulator = condenser.accumulator()
+        for chunk in _chunks(document, size):
+            accumulator.update(chunk)
+
+        minhash, num_tokens = condenser.make_hash_with_count(document)
+        assert accumulator.digest().hashvalues.tolist() == minhash.hashvalues.tolist()
+        # tokens crossing the splits should be counted once (small documents are counted close to exactly)
+        assert accumulator.num_tokens == pytest.approx(num_tokens, rel=0.01, abs=1)
+
+
+@pytest.mark.parametrize('normalizer', ('norm', 'norm-fast', 'norm-html'))
+@pytest.mark.parametrize('document', (
+    '<p>Notes</p>\nAT&amp;T and caf&eacute;',
+    'AT&amp;T\n<p>Notes</p>\nAT&amp;T and caf&eacute;\n',
+    'a &lt; b\n&amp;amp; c',
+    'an escaped \\x3c\nAT&amp;T',
+))
+@pytest.mark.parametrize('size', (4, 1 << 20))
+def test_accumulator_unescape_html(normalizer, document, size):
+    # ftfy stops unescaping html entities after the first line containing a <, pieces after it should not either
+    condenser = Condenser(normalizer=NORMALIZERS[normalizer])
+    accumulator = condenser.accumulator()
+    for chunk in _chunks(document, size):
+        accumulator.update(chunk)
+
+    assert accumulator.digest().hashvalues.tolist() == condenser.make_hash(document).hashvalues.tolist()
+
+
+def test_accumulator_max_buffer():
+    condenser = Condenser(normalizer=NORMALIZERS['norm'])
+    accumulator = condenser.accumulator()
+    accumulator.max_buffer = 16
+
+    for chunk in _chunks('a long line without line breaks ' * 8, 5):
+        accumulator.update(chunk)
+        assert accumulator.buffered <= 16 + 5
+
+    expected = condenser.make_hash('a long line without line breaks')
+    assert accumulator.digest().hashvalues.tolist() == expected.hashvalues.tolist()
+
+
+def test_accumulator_max_buffer_html():
+    # minified html lacks line breaks, the fallback split should still keep away from markup
+    document = ''.join(f'<div class="item {num}" data-x="a b"><style>.a {{ color: red }}</style>'
+                       f'<!-- comment {num} --><p>paragraph {num} of minified html</p><script>var x = {num};</script>'
+                       f'<ruby>kan<rp>(</rp><rt>kanji {num}</rt><rp>)</rp></ruby></div>' for num in range(100))
+    condenser = Condenser.from_spec('5-grams:norm-html::')
+    accumulator = condenser.accumulator(max_buffer=64)
+
+    for chunk in _chunks(document, 16):
+        accumulator.update(chunk)
+        assert accumulator.buffered <= 256
+
+    assert accumulator.digest().hashvalues.tolist() == condenser.make_hash(document).hashvalues.tolist()
+
+
+@pytest.mark.parametrize('normalizer', ('norm', 'norm-fast', 'norm-html'))
+def test_make_hash_stream(test_files, normalizer):
+    condenser = Condenser.from_spec(f'5-grams:{normalizer}::')
+    for document in (HTML, f'{HTML}AT&amp;T and caf&eacute;\n', '<p>Notes</p>\nAT&amp;T and caf&eacute;'):
+        expected = condenser.make_hash(document).hashvalues.tolist()
+
+        assert condenser.make_hash_stream(StringIO(document), chunk_size=64).hashvalues.tolist() == expected
+        assert condenser.make_hash_stream(iter([document])).hashvalues.tolist() == expected
+        assert condenser.make_hash_stream(_chunks(document, 3)).hashvalues.tolist() == expected
+    with open(test_files / 'data1') as data:
+        assert condenser.make_hash_stream(data, chunk_size=4).hashvalues.tolist() == \
+            condenser.make_hash((test_files / 'data1').read_text()).hashvalues.tolist()
+
+
+@pytest.mark.parametrize('tokenizer', ('ws', '6-grams', 'white-space-6-grams'))
+def test_accumulator_bounded(tokenizer):
+    condenser = Condenser.from_spec(f'{tokenizer}:norm::')
+    accumulator = condenser.accumulator(max_buffer=256)
+    document = ''.join(f'line {num} of a large document\n' for num in range(1_000))
+
+    for chunk in _chunks(document, 64):
+        accumulator.update(chunk)
+        # neither the raw text nor the normalized text should grow with the size of the document
+        assert accumulator.buffered <= 256 + 64
+        assert len(accumulator.pending) <= 256
+        # the tokens are counted by a fixed number of registers
+        assert accumulator.registers.nbytes == 1 << COUNT_PRECISION
+
+    assert accumulator.digest().hashvalues.tolist() == condenser.make_hash(document).hashvalues.tolist()
+    assert accumulator.num_tokens == pytest.approx(condenser.make_hash_with_count(document)[1], rel=0.02)
+
+
+@pytest.mark.parametrize('tokenizer', ('ws', 'rolling-white-space-2-grams'))
+def test_accumulator_num_tokens(tokenizer):
+    condenser = Condenser(tokenizer=TOKENIZERS[tokenizer], normalizer=None)
+    # from linear counting up to the HyperLogLog estimate proper
+    for num_words in (0, 1, 100, 10_000, 100_000):
+        document = ' '.join(f'word{num}' for num in range(num_words))
+        accumulator = condenser.accumulator()
+        for chunk in _chunks(document, 1 << 16):
+            accumulator.update(chunk)
+        accumulator.digest()
+
+        assert accumulator.num_tokens == pytest.approx(condenser.make_hash_with_count(document)[1], rel=0.02)
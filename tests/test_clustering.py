@@ -0,0 +1,101 @@
+from datasketch import LeanMinHash, MinHashLSH
+import numpy as np
+import pytest
+
+from copietje import clustering
+from copietje.clustering import cluster, UnionFind
+
+
+def reference_clusters(database, threshold, fn_weight=0.75):
+    # connected components of the candidates of datasketch's in-memory LSH index that are at least threshold similar
+    index = MinHashLSH(threshold=threshold, weights=(1.0 - fn_weight, fn_weight), num_perm=128)
+    hashes = {row['uid']: LeanMinHash.deserialize(row['minhash'], '!')
+              for row in database.execute('SELECT uid, minhash FROM documents')}
+    for uid, minhash in hashes.items():
+        index.insert(uid, minhash)
+
+    uids = sorted(hashes)
+    components = UnionFind(len(uids))
+    for a, uid in enumerate(uids):
+        for candidate in index.query(hashes[uid]):
+            if hashes[uid].jaccard(hashes[candidate]) >= threshold:
+                components.union(a, uids.index(candidate))
+
+    clusters = {}
+    for idx, uid in enumerate(uids):
+        clusters.setdefault(components.find(idx), []).append(uid)
+    return sorted(members for members in clusters.values() if len(members) > 1)
+
+
+def stored_clusters(database):
+    clusters = {}
+    for row in database.execute('SELECT cluster_id, uid FROM clusters ORDER BY uid'):
+        clusters.setdefault(row['cluster_id'], []).append(row['uid'])
+    return sorted(clusters.values())
+
+
+def test_union_find():
+    components = UnionFind(6)
+    assert components.union(0, 1)
+    assert components.union(2, 3)
+    assert components.union(1, 3)
+    assert not components.union(0, 2)
+
+    assert len({components.find(node) for node in range(4)}) == 1
+    assert components.find(4) == 4
+    assert components.roots(np.arange(6)).tolist() == [components.find(node) for node in range(6)]
+    # every node should point directly at its root after a lookup of all nodes
+    assert np.array_equal(components.parent, components.parent[components.parent])
+
+
+@pytest.mark.parametrize(('threshold', 'fn_weight'), ((0.5, 0.75), (0.8, 0.5), (0.3, 0.9)))
+def test_cluster(case_database, threshold, fn_weight):
+    num_clusters, num_documents = cluster(case_database, threshold, fn_weight)
+
+    expected = reference_clusters(case_database, threshold, fn_weight)
+    assert stored_clusters(case_database) == expected
+    assert (num_clusters, num_documents) == (len(expected), sum(len(members) for members in expected))
+
+
+def test_cluster_rows(case_database, monkeypatch):
+    monkeypatch.setattr(clustering, 'LOAD_BATCH_SIZE', 7)
+    cluster(case_database)
+
+    rows = case_database.execute('SELECT * FROM clusters ORDER BY cluster_id, uid').fetchall()
+    assert [row['cluster_id'] for row in rows] == sorted(row['cluster_id'] for row in rows)
+    for row in rows:
+        # the first uid of a cluster represents it
+        members = [other['uid'] for other in rows if other['cluster_id'] == row['cluster_id']]
+        assert row['representative'] == min(members)
+
+        minhash, representative = (LeanMinHash.deserialize(
+            case_database.execute('SELECT minhash FROM documents WHERE uid = ?', (uid,)).fetchone()['minhash'], '!')
+            for uid in (row['uid'], row['representative']))
+        assert row['similarity_to_rep'] == minhash.jaccard(representative)
+
+    # clustering again replaces the previous results
+    case_database.execute("DELETE FROM documents WHERE uid LIKE 'doc-00-%'")
+    cluster(case_database)
+    assert not any(members[0].startswith('doc-00') for members in stored_clusters(case_database))
+
+
+def test_cluster_empty(case_database):
+    cluster(case_database)
+    case_database.execute('UPDATE documents SET minhash = NULL')
+    assert cluster(case_database) == (0, 0)
+    assert stored_clusters(case_database) == []
+
+
+def test_bucket_pairs():
+    keys = np.array([5, 3, 5, 7, 3, 3, 5, 3], dtype=np.int64)
+
+    # the bucket of key 5 is paired up completely, the larger bucket of key 3 only with its first document
+    expected = {(0, 2), (0, 6), (2, 6), (1, 4), (1, 5), (1, 7)}
+    for block_size in (1, 3, 1024):
+        blocks = list(clustering._bucket_pairs(keys, 3, block_size))
+        assert all(0 < len(a) == len(b) <= block_size for a, b in blocks)
+        pairs = [pair for a, b in blocks for pair in zip(a.tolist(), b.tolist())]
+        assert len(pairs) == len(expected)
+        assert set(pairs) == expected
+
+    assert list(clustering._bucket_pairs(keys[:1], 3)) == []
@@ -1,3 +1,5 @@
+from datasketch import MinHash
+import numpy as np
 import pytest
 
 from copietje import Condenser, HASH_FUNCTIONS
@@ -40,3 +42,17 @@ def test_from_spec(spec, tok, norm, hf, perms):
     assert condenser.normalizer is norm
     assert condenser.hash_func is hf
     assert condenser.permutations is perms
+
+
+@pytest.mark.parametrize('tokenizer', ('rolling-5-grams', 'rolling-white-space-3-grams'))
+def test_rolling_hashes(test_files, tokenizer):
+    condenser = Condenser.from_spec(f'{tokenizer}:norm::64')
+    data = (test_files / 'data1').read_text()
+
+    # equal to a minhash of the tokenizer's hash values, used as is
+    expected = MinHash(num_perm=64, hashfunc=lambda value: int.from_bytes(value, 'little'))
+    expected.update_batch([value.tobytes() for value in condenser.tokenizer(NORMALIZERS['norm'](data))])
+    assert np.array_equal(condenser.make_hash(data).hashvalues, expected.hashvalues)
+    assert np.array_equal(condenser.make_hash_batch([data, '']),
+                          [expected.hashvalues, condenser.make_hash('').hashvalues])
+    assert condenser.make_token_set(data) == set(condenser.tokenizer(NORMALIZERS['norm'](data)).tolist())
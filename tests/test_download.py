@@ -0,0 +1,355 @@
+from contextlib import nullcontext
+from io import BytesIO
+import sqlite3
+from threading import Event, Thread
+
+from datasketch import LeanMinHash
+import pytest
+
+from copietje import Condenser
+from copietje.download import add_metadata_to_db, condense_file, create_schema, DatabaseWriter, determine_stream, \
+    hash_missing, HashPool, KnownDigests, log_error_to_db, SCHEMA, StreamHasher
+from copietje.tokenizers import TOKENIZERS
+
+
+class Trace(dict):
+    # local stand-in for a hansken trace, serving data streams from memory
+    def __init__(self, uid, tags=(), privileged=None, data=None, **properties):
+        super().__init__(properties)
+        self.uid = uid
+        self.tags = list(tags)
+        self.privileged = privileged
+        self.data = data or {}
+
+    def open(self, stream='raw', **_):
+        return BytesIO(self.data[stream])
+
+
+@pytest.fixture
+def database():
+    with sqlite3.connect(':memory:') as database:
+        database.row_factory = sqlite3.Row
+        database.cursor().executescript(SCHEMA)
+        yield database
+
+
+def test_create_schema():
+    with sqlite3.connect(':memory:') as database:
+        # a documents table created before the number of tokens and the sequence number were recorded
+        database.execute("""
+            CREATE TABLE documents (
+                uid TEXT PRIMARY KEY, path TEXT, stream TEXT, size INTEGER, sha1 TEXT, tags TEXT,
+                privileged_status TEXT, minhash BLOB
+            )
+        """)
+        database.execute("INSERT INTO documents (uid, minhash) VALUES ('b', x'00'), ('a', x'01')")
+
+        create_schema(database)
+        create_schema(database)
+        assert database.execute('SELECT uid, minhash, num_tokens, seq FROM documents ORDER BY uid').fetchall() == \
+            [('a', b'\x01', None, 2), ('b', b'\x00', None, 1)]
+
+        # documents added later are numbered after them, whether or not they're given a sequence number
+        database.execute("INSERT INTO documents (uid) VALUES ('c')")
+        with DatabaseWriter(database) as writer:
+            add_metadata_to_db(writer, _text_trace('d', None), 'text', 'd')
+            add_metadata_to_db(writer, _text_trace('e', None), 'text', 'e')
+        assert database.execute('SELECT uid FROM documents ORDER BY seq').fetchall() == \
+            [('b',), ('a',), ('c',), ('d',), ('e',)]
+
+
+def test_condense_file(test_files):
+    condenser = Condenser()
+    expected = condenser.make_hash((test_files / 'data1').read_text())
+
+    minhash, num_tokens = condense_file(condenser, test_files / 'data1')
+
+    assert LeanMinHash.deserialize(minhash, '!').hashvalues.tolist() == expected.hashvalues.tolist()
+    assert num_tokens == len(condenser.make_token_set((test_files / 'data1').read_text()))
+
+
+def test_condense_file_missing(tmp_path):
+    assert condense_file(Condenser(), tmp_path / 'missing') is None
+
+
+def test_hash_pool(database, test_files):
+    condenser = Condenser()
+
+    with DatabaseWriter(database) as writer, HashPool(condenser, 2) as hash_pool:
+        for name in ('data1', 'data2'):
+            add_metadata_to_db(writer, Trace(name), 'text', str(test_files / name),
+                               condenser=condenser, hash_pool=hash_pool)
+        writer.add_minhashes(hash_pool.completed(block=True))
+
+        assert not hash_pool.pending
+
+    rows = database.execute('SELECT path, minhash, num_tokens FROM documents').fetchall()
+    assert len(rows) == 2
+    for row in rows:
+        assert (row['minhash'], row['num_tokens']) == condense_file(condenser, row['path'])
+
+
+@pytest.mark.parametrize('jobs', (0, 2))
+def test_hash_pool_interrupted(database, test_files, monkeypatch, jobs):
+    condenser = Condenser()
+    traces = [_text_trace(name, sha1) for name, sha1 in (('data1', 'abcd'), ('data2', 'ef01'))]
+
+    # the documents are written, but the download is interrupted before the pool's minhashes are collected
+    with monkeypatch.context() as patch:
+        patch.setattr(HashPool, 'completed', lambda self, block=False: [])
+        with DatabaseWriter(database) as writer, HashPool(condenser, 2) as hash_pool:
+            for trace in traces:
+                add_metadata_to_db(writer, trace, 'text', str(test_files / trace.uid), condenser=condenser,
+                                   hash_pool=hash_pool)
+    assert database.execute('SELECT COUNT(*) FROM documents WHERE minhash IS NULL').fetchone()[0] == 2
+
+    # resuming the download skips the documents, but should hash what they're missing
+    known = KnownDigests.from_database(database)
+    assert all(determine_stream(trace, known=known) is False for trace in traces)
+    with (DatabaseWriter(database, known=known) as writer,
+          HashPool(condenser, jobs) if jobs else nullcontext() as hash_pool):
+        assert hash_missing(database, writer, condenser, hash_pool) == 2
+        if hash_pool:
+            writer.add_minhashes(hash_pool.completed(block=True))
+
+    for row in database.execute('SELECT path, minhash, num_tokens FROM documents'):
+        assert (row['minhash'], row['num_tokens']) == condense_file(condenser, row['path'])
+    assert hash_missing(database, writer, condenser) == 0
+
+
+@pytest.mark.parametrize('jobs', (0, 2))
+def test_hash_missing_failed(database, test_files, tmp_path, monkeypatch, caplog, jobs):
+    condenser = Condenser()
+    (tmp_path / 'binary').write_bytes(b'\xff\xfe\x00 binary')
+    with (DatabaseWriter(database) as writer,
+          HashPool(condenser, jobs) if jobs else nullcontext() as hash_pool):
+        for uid, path in (('binary', tmp_path / 'binary'), ('missing', tmp_path / 'missing'),
+                          ('data1', test_files / 'data1')):
+            add_metadata_to_db(writer, _text_trace(uid, None), 'text', str(path), condenser=condenser,
+                               hash_pool=hash_pool)
+        if hash_pool:
+            writer.add_minhashes(hash_pool.completed(block=True))
+
+    assert {row['uid']: row['hash_failed'] for row in database.execute('SELECT uid, hash_failed FROM documents')} == {
+        'binary': 1, 'missing': 1, 'data1': None,
+    }
+
+    # documents that failed to hash should not be retried when resuming, but should be reported
+    monkeypatch.setattr('copietje.download.condense_file', None)
+    with caplog.at_level('INFO', logger='copietje.download'), DatabaseWriter(database) as writer:
+        assert hash_missing(database, writer, condenser) == 0
+    assert 'skipping 2 previously downloaded documents that failed to hash' in caplog.text
+
+
+def test_database_writer_batches(database):
+    with DatabaseWriter(database, batch_size=3, flush_interval=60.0) as writer:
+        for uid in ('a', 'b'):
+            add_metadata_to_db(writer, Trace(uid, tags=['tag']), 'text', uid)
+        # nothing should be written until a batch is complete
+        assert database.execute('SELECT COUNT(*) FROM documents').fetchone()[0] == 0
+
+        log_error_to_db(writer, Trace('c'), 'text', exception=IOError('broken'))
+        assert len(writer) == 0
+        assert database.execute('SELECT COUNT(*) FROM documents').fetchone()[0] == 2
+        assert database.execute('SELECT error FROM errors').fetchone()['error'] == 'broken'
+
+        add_metadata_to_db(writer, Trace('d'), 'text', 'd')
+        writer.add_minhashes([('d', b'minhash', 3), ('a', None, None)])
+
+    # leaving the context should have written the remainder, a result without a minhash records a failure
+    assert {row['uid']: (row['minhash'], row['num_tokens'], row['hash_failed'])
+            for row in database.execute('SELECT uid, minhash, num_tokens, hash_failed FROM documents')} == {
+        'a': (None, None, 1),
+        'b': (None, None, None),
+        'd': (b'minhash', 3, None),
+    }
+    assert writer.num_rows == 6
+
+
+def test_database_writer_interval(database):
+    with DatabaseWriter(database, batch_size=1000, flush_interval=0.0) as writer:
+        add_metadata_to_db(writer, Trace('a'), 'text', 'a')
+        assert database.execute('SELECT COUNT(*) FROM documents').fetchone()[0] == 1
+
+
+def _text_trace(uid, sha1):
+    return Trace(uid, **{'data.text.size': 1024, 'data.text.mimeClass': 'text', 'data.text.hash.sha1': sha1})
+
+
+def test_determine_stream_known(database):
+    digest = '0123456789abcdef0123456789abcdef01234567'
+    with DatabaseWriter(database) as writer:
+        add_metadata_to_db(writer, _text_trace('a', digest), 'text', 'a')
+
+    known = KnownDigests.from_database(database)
+    assert len(known) == 1
+
+    # both the database and the preloaded digests should agree on what to skip
+    for kwargs in ({'database': database}, {'known': known}):
+        assert determine_stream(_text_trace('a', digest), **kwargs) is False
+        assert determine_stream(_text_trace('a', digest.replace('0', 'f')), **kwargs) == 'text'
+        assert determine_stream(_text_trace('b', digest), **kwargs) == 'text'
+        assert determine_stream(_text_trace('b', None), **kwargs) == 'text'
+
+
+def test_known_digests_in_sync(database):
+    known = KnownDigests()
+    with DatabaseWriter(database, known=known) as writer:
+        add_metadata_to_db(writer, _text_trace('a', 'abcd'), 'text', 'a')
+        add_metadata_to_db(writer, _text_trace('b', 'not-hex'), 'text', 'b')
+
+        assert determine_stream(_text_trace('a', 'abcd'), known=known) is False
+        assert determine_stream(_text_trace('b', 'not-hex'), known=known) is False
+
+
+@pytest.mark.parametrize('bufsize', (3, 1 << 20))
+def test_stream_hasher(database, test_files, tmp_path, bufsize):
+    condenser = Condenser()
+    stream_hasher = StreamHasher(condenser, bufsize=bufsize)
+    # include some multibyte characters to be split up by small buffers
+    data = (test_files / 'data1').read_bytes() + '\n<p>ëén ☃</p>'.encode('utf-8')
+    output = str(tmp_path / 'output')
+
+    stream_hasher(Trace('a', data={'text': data}), output, 'text')
+
+    # the stream should have been written as-is
+    assert (tmp_path / 'output').read_bytes() == data
+
+    with DatabaseWriter(database) as writer:
+        add_metadata_to_db(writer, Trace('a'), 'text', output, condenser=condenser, stream_hasher=stream_hasher)
+
+    assert not stream_hasher.minhashes
+    assert tuple(database.execute('SELECT minhash, num_tokens FROM documents').fetchone()) == \
+        condense_file(condenser, output)
+
+
+@pytest.mark.parametrize('bufsize', (1, 1 << 20))
+def test_stream_hasher_line_endings(tmp_path, bufsize):
+    # without a normalizer, character n-grams include the line endings as they are
+    condenser = Condenser(tokenizer=TOKENIZERS['3-grams'], normalizer=None)
+    stream_hasher = StreamHasher(condenser, bufsize=bufsize)
+    data = b'windows\r\nline endings\r\nand old mac\rones\r'
+    output = str(tmp_path / 'output')
+
+    stream_hasher(Trace('a', data={'text': data}), output, 'text')
+
+    assert (tmp_path / 'output').read_bytes() == data
+    assert stream_hasher.pop(output) == condense_file(condenser, output)
+
+
+def test_stream_hasher_not_text(tmp_path):
+    stream_hasher = StreamHasher(Condenser())
+    data = b'\xff\xfe\x00 binary'
+
+    stream_hasher(Trace('a', data={'raw': data}), str(tmp_path / 'output'), 'raw')
+
+    assert (tmp_path / 'output').read_bytes() == data
+    assert stream_hasher.pop(str(tmp_path / 'output')) is None
+
+
+def test_known_digests_sketches(database):
+    digest = '0123456789abcdef0123456789abcdef01234567'
+    with DatabaseWriter(database) as writer:
+        add_metadata_to_db(writer, _text_trace('a', digest), 'text', 'a')
+        writer.add_minhashes([('a', b'minhash', 3)])
+        add_metadata_to_db(writer, _text_trace('b', None), 'text', 'b')
+        writer.add_minhashes([('b', b'other', 4)])
+
+    known = KnownDigests.from_database(database)
+    # the minhashes themselves should be left in the database
+    assert not known.pending
+    assert known.sketch(digest) == (b'minhash', 3)
+    assert known.sketch(digest.upper()) == (b'minhash', 3)
+    assert known.sketch(digest.replace('0', 'f')) is None
+    assert known.sketch(None) is None
+
+    # minhashes calculated after a trace was added should be picked up as well
+    with DatabaseWriter(database, known=known) as writer:
+        add_metadata_to_db(writer, _text_trace('c', 'abcd'), 'text', 'c')
+        writer.add_minhashes([('c', b'later', 5)])
+        assert known.sketch('abcd') == (b'later', 5)
+    # no longer pending once written
+    assert not known.pending
+    assert known.sketch('abcd') == (b'later', 5)
+
+
+def test_known_digests_threads(tmp_path):
+    with sqlite3.connect(tmp_path / 'case.db', check_same_thread=False) as database:
+        create_schema(database)
+        known = KnownDigests.from_database(database)
+        done = Event()
+        errors = []
+
+        def look_up():
+            # look up minhashes from another thread while batches are being written, like StreamHasher does
+            while not done.is_set():
+                try:
+                    known.sketch('abcd')
+                except Exception as e:
+                    errors.append(e)
+
+        with DatabaseWriter(database, batch_size=10, known=known) as writer:
+            # the writer should hold the same lock while it writes to the connection
+            assert writer.lock is known.lock
+            threads = [Thread(target=look_up) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for num in range(500):
+                add_metadata_to_db(writer, _text_trace(f'doc-{num}', 'abcd'), 'text', f'doc-{num}')
+                writer.add_minhashes([(f'doc-{num}', b'minhash', num)])
+
+        done.set()
+        for thread in threads:
+            thread.join()
+
+    assert not errors
+    assert known.sketch('abcd') is not None
+
+
+def test_stream_hasher_duplicate(tmp_path, monkeypatch):
+    condenser = Condenser()
+    known = KnownDigests()
+    known.add('a', 'abcd', b'minhash', 3)
+    stream_hasher = StreamHasher(condenser, known=known)
+    # exact copies should not be hashed again
+    monkeypatch.setattr(condenser, 'accumulator', None)
+
+    trace = _text_trace('b', 'abcd')
+    trace.data['text'] = b'copy of a'
+    stream_hasher(trace, str(tmp_path / 'output'), 'text')
+
+    assert (tmp_path / 'output').read_bytes() == b'copy of a'
+    assert stream_hasher.pop(str(tmp_path / 'output')) == (b'minhash', 3)
+
+
+def test_add_metadata_duplicate(database, test_files, tmp_path):
+    condenser = Condenser()
+    known = KnownDigests()
+
+    with DatabaseWriter(database, known=known) as writer:
+        add_metadata_to_db(writer, _text_trace('a', 'abcd'), 'text', str(test_files / 'data1'), condenser=condenser)
+        # the copy can't be read, its minhash should be that of the original regardless
+        add_metadata_to_db(writer, _text_trace('b', 'abcd'), 'text', str(tmp_path / 'missing'), condenser=condenser)
+        add_metadata_to_db(writer, _text_trace('c', 'ef01'), 'text', str(tmp_path / 'missing'), condenser=condenser)
+
+    sketches = {row['uid']: (row['minhash'], row['num_tokens'])
+                for row in database.execute('SELECT uid, minhash, num_tokens FROM documents')}
+    assert sketches == {'a': condense_file(condenser, test_files / 'data1'), 'b': sketches['a'], 'c': (None, None)}
+
+
+def test_hash_pool_duplicate(database, test_files, tmp_path):
+    condenser = Condenser()
+    known = KnownDigests()
+
+    with DatabaseWriter(database, known=known) as writer, HashPool(condenser, 2) as hash_pool:
+        add_metadata_to_db(writer, _text_trace('a', 'abcd'), 'text', str(test_files / 'data1'),
+                           condenser=condenser, hash_pool=hash_pool)
+        writer.add_minhashes(hash_pool.completed(block=True))
+        add_metadata_to_db(writer, _text_trace('b', 'abcd'), 'text', str(tmp_path / 'missing'),
+                           condenser=condenser, hash_pool=hash_pool)
+
+        assert not hash_pool.pending
+
+    sketches = {row['uid']: (row['minhash'], row['num_tokens'])
+                for row in database.execute('SELECT uid, minhash, num_tokens FROM documents')}
+    assert sketches['a'] == sketches['b'] == condense_file(condenser, test_files / 'data1')
@@ -1,5 +1,9 @@
-from copietje import normalize, tokenize, Condenser
-from copietje.ranking import full_jaccard_on_token_set
+import numpy as np
+import pytest
+
+from copietje import normalize, token_hash64, tokenize, Condenser
+from copietje.ranking import full_jaccard_matrix, full_jaccard_on_token_set, full_jaccard_pairs, \
+    full_token_set_from_generator
 
 
 def test_jaccard():
@@ -50,3 +54,51 @@ def test_jaccard_empty_strings():
     tokens1 = condenser.make_token_set(text1)
     tokens2 = condenser.make_token_set(text2)
     assert full_jaccard_on_token_set(tokens1, tokens2) == 0
+
+
+@pytest.fixture
+def texts():
+    # versions of a text, each replacing a few more words, along with an empty document and an exact copy
+    words = [f'word{idx}' for idx in range(40)]
+    texts = {}
+    for version in range(10):
+        words[version * 7 % len(words)] = f'version{version}'
+        texts[f'data{version}'] = ' '.join(words[version:])
+    texts['empty'] = ''
+    texts['copy'] = texts['data3']
+    return texts
+
+
+def test_token_hashes():
+    condenser = Condenser(normalizer=normalize, tokenizer=tokenize)
+    hashes = condenser.make_token_hashes('This is the first string. This string.')
+    assert hashes.dtype == np.uint64
+    assert hashes.tolist() == sorted({token_hash64(token.encode('utf-8'))
+                                      for token in condenser.make_token_set('This is the first string. This string.')})
+
+
+@pytest.mark.parametrize('threshold', (None, 0.3, 0.6, 0.9))
+def test_full_jaccard_matrix(texts, threshold):
+    condenser = Condenser(normalizer=normalize, tokenizer=tokenize)
+    expected = list(full_jaccard_matrix({identifier: condenser.make_token_set(text)
+                                         for identifier, text in texts.items()}, threshold))
+    # a threshold should leave out some of the documents
+    assert sum(len(scores) for _, scores in expected) < len(texts) ** 2 or not threshold
+
+    assert list(full_jaccard_matrix(full_token_set_from_generator(texts.items(), condenser), threshold)) == expected
+
+
+@pytest.mark.parametrize('threshold', (0.1, 0.5, 0.8, 1.0))
+def test_full_jaccard_pairs(texts, threshold):
+    condenser = Condenser(normalizer=normalize, tokenizer=tokenize)
+    token_sets = [condenser.make_token_set(text) for text in texts.values()]
+    expected = {(first, second, jaccard)
+                for first in range(len(texts))
+                for second in range(first + 1, len(texts))
+                if (jaccard := full_jaccard_on_token_set(token_sets[first], token_sets[second])) >= threshold}
+
+    corpus = full_token_set_from_generator(texts.items(), condenser)
+    for block_size in (1, 3, 100):
+        first, second, similarities = full_jaccard_pairs(corpus, threshold, block_size=block_size)
+        assert len(first) == len(expected)
+        assert set(zip(first.tolist(), second.tolist(), similarities.tolist())) == expected
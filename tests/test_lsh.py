@@ -0,0 +1,209 @@
+from functools import partial
+import logging
+import re
+
+from datasketch import LeanMinHash, MinHashLSH
+import numpy as np
+import pytest
+
+from copietje import matching
+from copietje.lsh import band_keys, BandIndex, bucket_index, candidate_pairs, lsh_params
+from copietje.matching import duplicate_groups, expand_duplicates, get_permutations, match_numpy, match_sqlite
+from copietje.ranking import rank
+from copietje.sketches import deserialize
+
+
+def reference_match(database, threshold, fn_weight):
+    # matches documents the way copietje match did originally, using datasketch's in-memory LSH index
+    index = MinHashLSH(threshold=threshold, weights=(1.0 - fn_weight, fn_weight), num_perm=128)
+    hashes = {}
+    for document in database.execute('SELECT uid, minhash FROM documents WHERE privileged_status IS NOT NULL'):
+        hashes[document['uid']] = LeanMinHash.deserialize(document['minhash'], '!')
+        index.insert(document['uid'], hashes[document['uid']])
+
+    results = []
+    for document in database.execute('SELECT uid, minhash FROM documents WHERE privileged_status IS NULL'):
+        query_hash = LeanMinHash.deserialize(document['minhash'], '!')
+        if matches := rank({uid: hashes[uid] for uid in index.query(query_hash)}, query_hash, threshold=threshold):
+            results.append((document['uid'], matches))
+
+    return sorted(results)
+
+
+@pytest.mark.parametrize(('threshold', 'fn_weight', 'permutations'), [
+    (0.5, 0.75, 128),
+    (0.2, 0.5, 64),
+    (0.8, 0.9, 256),
+    (0.9, 0.1, 128),
+])
+def test_lsh_params(threshold, fn_weight, permutations):
+    index = MinHashLSH(threshold=threshold, weights=(1.0 - fn_weight, fn_weight), num_perm=permutations)
+    assert lsh_params(threshold, fn_weight, permutations) == (index.b, index.r)
+
+    with pytest.raises(ValueError):
+        lsh_params(1.0, 1.0, 2)
+
+
+def test_band_keys():
+    hashvalues = np.array([
+        [1, 2, 3, 4, 5, 6, 7],
+        [1, 2, 3, 4, 6, 5, 7],
+        [2, 1, 3, 4, 5, 6, 8],
+    ], dtype=np.uint32)
+
+    keys = band_keys(hashvalues, 3, 2)
+
+    assert keys.shape == (3, 3)
+    assert keys.dtype == np.int64
+    # rows share keys only for equal bands, the last value is not part of any band
+    assert (keys[0] == keys[1]).tolist() == [True, True, False]
+    assert (keys[0] == keys[2]).tolist() == [False, True, True]
+
+
+def test_band_index(case_database):
+    bands, rows = lsh_params(0.5, 0.75, 128)
+    index = BandIndex(case_database, 128, bands, rows)
+
+    assert index.update() == 60
+    assert case_database.execute('SELECT COUNT(*) FROM bands').fetchone()[0] == 60 * bands
+    # nothing changed, nothing to index
+    assert index.update() == 0
+
+    # documents of unlabeled families should not have candidates
+    candidates = {(row['query_uid'], row['uid']) for row in index.candidates()}
+    assert ('doc-00-1', 'doc-00-0') in candidates
+    assert not any(query_uid.startswith('doc-01') for query_uid, _ in candidates)
+    # exact copies of an unlabeled document are left to the first of their kind
+    assert not any(query_uid.endswith('-4') for query_uid, _ in candidates)
+
+    # band keys are reused for different parameters resulting in the same bands and rows
+    assert BandIndex(case_database, 128, bands, rows).update() == 0
+    assert BandIndex(case_database, 128, bands // 2, rows).update() == 60
+
+
+@pytest.mark.parametrize(('threshold', 'fn_weight'), ((0.5, 0.75), (0.8, 0.5), (0.3, 0.9)))
+def test_match_sqlite(case_database, threshold, fn_weight):
+    expected = reference_match(case_database, threshold, fn_weight)
+    assert list(match_sqlite(case_database, threshold, fn_weight)) == expected
+
+
+def test_match_sqlite_new_label(case_database):
+    assert not any(uid.startswith('doc-01') for uid, _ in match_sqlite(case_database))
+
+    # labeling a document should be picked up by the next match without indexing anything
+    case_database.execute("UPDATE documents SET privileged_status = 'privileged' WHERE uid = 'doc-01-0'")
+    assert any(uid.startswith('doc-01') for uid, _ in match_sqlite(case_database))
+    assert list(match_sqlite(case_database)) == reference_match(case_database, 0.5, 0.75)
+
+
+def test_duplicate_groups(case_database):
+    assert duplicate_groups(case_database) == {f'doc-{family:02}-1': [f'doc-{family:02}-4'] for family in range(12)}
+
+    # labeled copies are not grouped with unlabeled ones
+    case_database.execute("UPDATE documents SET privileged_status = 'privileged' WHERE uid = 'doc-00-1'")
+    case_database.execute("UPDATE documents SET sha1 = NULL WHERE uid = 'doc-01-1'")
+    assert 'doc-00-1' not in duplicate_groups(case_database)
+    assert len(duplicate_groups(case_database)) == 10
+
+
+def test_expand_duplicates():
+    results = [('a', [(1.0, 'x')]), ('c', [(0.5, 'y')]), ('e', [(0.8, 'z')])]
+    duplicates = {'a': ['d', 'b'], 'c': ['f'], 'g': ['h']}
+
+    assert list(expand_duplicates(results, duplicates)) == [
+        ('a', [(1.0, 'x')]),
+        ('b', [(1.0, 'x')]),
+        ('c', [(0.5, 'y')]),
+        ('d', [(1.0, 'x')]),
+        ('e', [(0.8, 'z')]),
+        ('f', [(0.5, 'y')]),
+    ]
+    assert list(expand_duplicates([], duplicates)) == []
+
+
+@pytest.mark.parametrize('engine', (match_sqlite, match_numpy))
+def test_match_duplicates(case_database, engine):
+    # the last version of every family is a copy of the second, make more copies spread across the uids
+    case_database.execute("""
+        INSERT INTO documents (uid, path, stream, size, sha1, tags, privileged_status, minhash)
+        SELECT 'copy-' || uid, path, stream, size, sha1, tags, privileged_status, minhash
+        FROM documents WHERE privileged_status IS NULL AND uid LIKE '%-1'
+    """)
+    assert list(engine(case_database)) == reference_match(case_database, 0.5, 0.75)
+
+
+def test_match_numpy_skips_duplicates(case_database, monkeypatch):
+    num_queries = []
+    match_block = matching._match_block
+
+    def counting_match_block(queries, start, end, *args):
+        num_queries.append(len(queries[start:end]))
+        return match_block(queries, start, end, *args)
+
+    monkeypatch.setattr(matching, '_match_block', counting_match_block)
+    assert list(match_numpy(case_database)) == reference_match(case_database, 0.5, 0.75)
+    # 60 documents, 10 of which are labeled and 12 of which are copies of an unlabeled document
+    assert sum(num_queries) == 60 - 10 - 12
+
+
+def test_candidate_pairs():
+    indexed = np.array([[1, 2], [3, 4], [1, 5], [6, 4]], dtype=np.int64)
+    queries = np.array([[1, 4], [7, 8], [3, 5]], dtype=np.int64)
+
+    pairs = candidate_pairs(queries, *bucket_index(indexed))
+    # query 0 shares band 0 with rows 0 and 2 and band 1 with rows 1 and 3, query 2 shares a band with rows 1 and 2
+    assert pairs.tolist() == [0 * 4 + 0, 0 * 4 + 1, 0 * 4 + 2, 0 * 4 + 3, 2 * 4 + 1, 2 * 4 + 2]
+    assert candidate_pairs(queries[:0], *bucket_index(indexed)).tolist() == []
+
+
+@pytest.mark.parametrize(('threshold', 'fn_weight'), ((0.5, 0.75), (0.8, 0.5), (0.3, 0.9)))
+def test_match_numpy(case_database, threshold, fn_weight):
+    expected = reference_match(case_database, threshold, fn_weight)
+    assert list(match_numpy(case_database, threshold, fn_weight)) == expected
+
+
+def test_match_numpy_blocks(case_database, monkeypatch):
+    monkeypatch.setattr(matching, 'QUERY_BLOCK_SIZE', 7)
+    monkeypatch.setattr(matching, 'PAIR_BLOCK_SIZE', 3)
+    assert list(match_numpy(case_database)) == reference_match(case_database, 0.5, 0.75)
+
+
+@pytest.mark.parametrize('jobs', (2, 3))
+def test_match_numpy_parallel(case_database, monkeypatch, jobs):
+    monkeypatch.setattr(matching, 'QUERY_BLOCK_SIZE', 5)
+    assert list(match_numpy(case_database, jobs=jobs)) == reference_match(case_database, 0.5, 0.75)
+
+
+@pytest.mark.parametrize('engine', (match_sqlite, match_numpy, partial(match_numpy, jobs=2)))
+def test_match_size_filter(case_database, caplog, engine):
+    expected = reference_match(case_database, 0.5, 0.75)
+    with caplog.at_level(logging.INFO, logger='copietje.matching'):
+        assert list(engine(case_database)) == expected
+    # versions of a family share most of their tokens, none of the candidates should have been pruned
+    assert re.search(r'size filter pruned 0 out of [1-9]\d* candidate pairs', caplog.text)
+    caplog.clear()
+
+    # the unlabeled documents can't be half as similar to labeled documents with more than twice their tokens
+    case_database.execute("""
+        UPDATE documents SET num_tokens = num_tokens * 3 WHERE privileged_status IS NOT NULL AND uid LIKE 'doc-00-%'
+    """)
+    with caplog.at_level(logging.INFO, logger='copietje.matching'):
+        results = list(engine(case_database))
+    assert results == [(uid, pruned) for uid, matches in expected
+                       if (pruned := [match for match in matches if not match[1].startswith('doc-00-')])]
+    assert re.search(r'size filter pruned [1-9]\d* out of', caplog.text)
+
+    # unknown numbers of tokens should not prune anything
+    case_database.execute('UPDATE documents SET num_tokens = NULL')
+    assert list(engine(case_database)) == expected
+
+
+def test_match_numpy_unlabeled(case_database):
+    case_database.execute('UPDATE documents SET privileged_status = NULL')
+    assert list(match_numpy(case_database)) == []
+
+
+def test_get_permutations(case_database):
+    assert get_permutations(case_database) == 128
+    minhashes = deserialize(row['minhash'] for row in case_database.execute('SELECT minhash FROM documents'))
+    assert minhashes.shape == (60, 128)
@@ -0,0 +1,65 @@
+from datasketch import LeanMinHash
+import numpy as np
+import pytest
+
+from copietje import Condenser, HASH_FUNCTIONS, TOKENIZERS
+from copietje.sketches import deserialize, serialize
+
+
+def _blob(minhash):
+    lean_minhash = LeanMinHash(minhash)
+    buffer = bytearray(lean_minhash.bytesize('!'))
+    lean_minhash.serialize(buffer, '!')
+    return bytes(buffer)
+
+
+@pytest.fixture
+def documents(test_files):
+    return [
+        (test_files / 'data1').read_text('utf-8'),
+        '',
+        'some tokens',
+        (test_files / 'data2').read_text('utf-8'),
+        '<p>some more</p> tokens',
+    ]
+
+
+@pytest.mark.parametrize('hash_function', ('sha1', 'mmh3', 'crc32'))
+@pytest.mark.parametrize('permutations', (64, 128))
+def test_make_hash_batch(documents, hash_function, permutations):
+    condenser = Condenser(hash_function=HASH_FUNCTIONS[hash_function], permutations=permutations)
+
+    matrix = condenser.make_hash_batch(documents)
+
+    assert matrix.shape == (len(documents), permutations)
+    assert matrix.dtype == np.uint32
+    assert serialize(matrix) == [_blob(condenser.make_hash(document)) for document in documents]
+
+
+def test_make_hash_batch_chunked(documents, monkeypatch):
+    condenser = Condenser(tokenizer=None, normalizer=None)
+    # force documents to be spread over multiple chunks
+    monkeypatch.setattr('copietje.BATCH_TOKENS', 2)
+
+    expected = [_blob(condenser.make_hash(document)) for document in documents]
+    assert serialize(condenser.make_hash_batch(documents)) == expected
+
+
+@pytest.mark.parametrize('tokenizer', ('words', 'sents'))
+@pytest.mark.parametrize('n_process', (1, 2))
+def test_make_hash_batch_spacy(spacy_model, documents, tokenizer, n_process):
+    condenser = Condenser(tokenizer=TOKENIZERS[tokenizer])
+
+    expected = [_blob(condenser.make_hash(document)) for document in documents]
+    assert serialize(condenser.make_hash_batch(documents, n_process=n_process)) == expected
+
+
+def test_make_hash_batch_empty():
+    assert Condenser().make_hash_batch([]).shape == (0, 128)
+
+
+def test_serialization_round_trip(documents):
+    matrix = Condenser().make_hash_batch(documents)
+
+    assert np.array_equal(deserialize(serialize(matrix)), matrix)
+    assert LeanMinHash.deserialize(serialize(matrix)[0], '!').hashvalues.tolist() == matrix[0].tolist()
@@ -1,4 +1,11 @@
+from contextlib import closing
+import sqlite3
+
+from bs4 import BeautifulSoup
+import pytest
+
 from copietje import normalize, normalize_html
+from copietje.normalizers import normalize_fast, NORMALIZERS, strip_html
 
 
 def test_normalize():
@@ -25,3 +32,51 @@ def test_normalize_html():
     normalized_data = normalize_html(data)
 
     assert normalized_data == "some text with capitals spaces characters and punctuation"
+
+
+@pytest.mark.parametrize('data', (
+    '',
+    'plain text\nwithout markup',
+    ' \r\n ',
+    '<p>Some <b>bold</b> text</p>\r\n<p>\r\n</p>',
+    '<html><head><style>p { margin: 0; }</style><script>var x = 1 < 2;</script></head><body>text</body></html>',
+    '<!-- comment -->text<!DOCTYPE html><?pi x?><![CDATA[cdata]]>',
+    '<ruby>kan<rt>kan</rt><rp>(</rp></ruby><template>x<p>y</p></template>z',
+    '<pre>  </pre><textarea>a<b>\n</textarea>',
+    'a &amp &amp; &foo; &#128; &#0; &#x110000; &notin &notit; &#12ab;',
+    '<rt>a<b>b</rt>c</b>d</x>e',
+    'a < b > c <p a="<">d<!-- unterminated',
+))
+def test_strip_html(data):
+    assert strip_html(data) == BeautifulSoup(data, features='html.parser').get_text()
+
+
+@pytest.mark.parametrize('data', (
+    '',
+    'Some $TEXT\n\nwIth       CAPITALS !\n\n- SpAces, CharacTers& and punctuation?',
+    'café naïve Über ŁÓDŹ ß Ж 中文 ﬂ ｆｕｌｌ ¼ e\u0301',
+    '€5 and 10 zł, zzł or £3 “quoted” ‘single’ `tick` ´ … – —',
+    'mojibake: Ã©tÃ© â€œhiâ€\x80\x93\nœ\nÃ',
+    'emoji 😀 👍🏽 👨‍👩‍👧 #️⃣ :smile: :thumbsup: 12:30:45 :no_such: ©®™',
+    '&amp; &lt; &eacute;\n<b>&amp;</b>\n&amp;',
+    'lines\r\nwith\u2028breaks\x85and\x00\x1b[31mcontrols\x7f\ud800',
+    'backslash \\u00e9 \\x41 \\n \\',
+))
+def test_normalize_fast(data):
+    assert normalize_fast(data) == NORMALIZERS['norm'](data)
+    assert normalize_fast(data, unescape_html=False) == NORMALIZERS['norm'](data, unescape_html=False)
+
+
+def test_normalize_fast_files(test_files):
+    assert NORMALIZERS['norm-fast'] is normalize_fast
+    for path in sorted(test_files.rglob('*')):
+        data = path.read_text(errors='replace')
+        assert normalize_fast(data) == NORMALIZERS['norm'](data)
+        assert normalize_fast(strip_html(data)) == NORMALIZERS['norm'](strip_html(data))
+
+
+def test_normalize_fast_articles(test_database_file):
+    with closing(sqlite3.connect(test_database_file)) as database:
+        for title, summary in database.execute('SELECT title, summary FROM article_versions'):
+            assert normalize_fast(title) == NORMALIZERS['norm'](title)
+            assert normalize_fast(summary) == NORMALIZERS['norm'](summary)
@@ -0,0 +1,102 @@
+import csv
+from io import StringIO
+import json
+
+import pytest
+
+from copietje.console import match
+from copietje.matching import match_numpy
+from copietje.output import CSVWriter, JSONLinesWriter, MatchTable, TextWriter
+from copietje.runs import MatchRun
+
+
+MATCHES = [
+    ('a', [(1.0, 'x'), (0.5, 'y')]),
+    ('b', [(0.75, 'z')]),
+]
+
+
+def test_text_writer():
+    out_file = StringIO()
+    with TextWriter(out_file) as writer:
+        for uid, matches in MATCHES:
+            writer.write(uid, matches)
+
+    assert out_file.getvalue() == 'a  # max 1.000 matches x, y\nb  # max 0.750 matches z\n'
+    assert writer.num_queries == 2
+
+
+def test_jsonl_writer():
+    out_file = StringIO()
+    with JSONLinesWriter(out_file) as writer:
+        for uid, matches in MATCHES:
+            writer.write(uid, matches)
+
+    assert [json.loads(line) for line in out_file.getvalue().splitlines()] == [
+        {'uid': 'a', 'matches': [{'uid': 'x', 'similarity': 1.0}, {'uid': 'y', 'similarity': 0.5}]},
+        {'uid': 'b', 'matches': [{'uid': 'z', 'similarity': 0.75}]},
+    ]
+
+
+def test_csv_writer():
+    out_file = StringIO()
+    with CSVWriter(out_file) as writer:
+        for uid, matches in MATCHES:
+            writer.write(uid, matches)
+
+    assert list(csv.reader(StringIO(out_file.getvalue()))) == [
+        ['query_uid', 'match_uid', 'similarity'],
+        ['a', 'x', '1.0'],
+        ['a', 'y', '0.5'],
+        ['b', 'z', '0.75'],
+    ]
+
+
+def test_match_table(case_database):
+    with MatchTable(case_database, MatchRun.start(case_database, 'numpy', 0.5, 0.75), batch_size=2) as writer:
+        writer.write(*MATCHES[0])
+        # a complete batch should have been written
+        assert case_database.execute('SELECT COUNT(*) FROM matches').fetchone()[0] == 2
+        writer.write(*MATCHES[1])
+        assert writer.rows
+
+    assert writer.num_rows == 3
+    rows = case_database.execute('SELECT query_uid, match_uid, similarity, run_id FROM matches').fetchall()
+    assert [tuple(row) for row in rows] == [
+        ('a', 'x', 1.0, writer.run_id),
+        ('a', 'y', 0.5, writer.run_id),
+        ('b', 'z', 0.75, writer.run_id),
+    ]
+
+    # the run should have been checkpointed and finished
+    assert tuple(case_database.execute('SELECT last_uid, finished FROM runs WHERE run_id = ?',
+                                       (writer.run_id,)).fetchone()) == ('b', 1)
+
+
+@pytest.mark.parametrize('engine', ('sqlite', 'numpy'))
+def test_match_output(case_database, tmp_path, capsys, engine):
+    expected = list(match_numpy(case_database))
+    case_database.commit()
+
+    match(database=tmp_path / 'case.db', engine=engine)
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split()[0] for line in lines] == [uid for uid, _ in expected]
+
+    match(database=tmp_path / 'case.db', engine=engine, output='jsonl', output_file=tmp_path / 'matches.jsonl')
+    with open(tmp_path / 'matches.jsonl') as lines:
+        assert [(line['uid'], [(match['similarity'], match['uid']) for match in line['matches']])
+                for line in map(json.loads, lines)] == expected
+
+    match(database=tmp_path / 'case.db', engine=engine, output='csv', output_file=tmp_path / 'matches.csv')
+    with open(tmp_path / 'matches.csv', newline='') as lines:
+        assert len(list(csv.DictReader(lines))) == sum(len(matches) for _, matches in expected)
+
+    match(database=tmp_path / 'case.db', engine=engine, output='database')
+    rows = case_database.execute("""
+        SELECT query_uid, match_uid, similarity FROM matches
+        WHERE run_id = (SELECT MAX(run_id) FROM runs)
+        ORDER BY rowid
+    """).fetchall()
+    assert [tuple(row) for row in rows] == [(uid, match_uid, similarity)
+                                            for uid, matches in expected
+                                            for similarity, match_uid in matches]
@@ -1,7 +1,7 @@
 import pytest
 
 from copietje import Condenser, normalize, tokenize
-from copietje.ranking import rank, score
+from copietje.ranking import rank, rank_matrix, score, score_matrix
 
 
 @pytest.fixture
@@ -39,3 +39,38 @@ def test_filtered_rank(corpus, condenser):
     assert {item[1] for item in rank(corpus, condenser.make_hash('some tokens'), threshold=0.1)} == {'data1', 'data2'}
     assert {item[1] for item in rank(corpus, condenser.make_hash('some tokens'), threshold=0.9)} == {'data1'}
     assert {item[1] for item in rank(corpus, condenser.make_hash('more tokens'), threshold=0.5)} == {'data2'}
+
+
+@pytest.fixture
+def versions_corpus(condenser):
+    # versions of a text, each replacing a few more words, including exact copies (for equal similarities)
+    words = [f'word{idx}' for idx in range(50)]
+    corpus = {}
+    for version in range(12):
+        words[version * 3 % len(words)] = f'version{version}'
+        corpus[f'data{version:02}'] = condenser.make_hash(' '.join(words))
+        corpus[f'copy{version:02}'] = corpus[f'data{version:02}']
+    return corpus
+
+
+@pytest.mark.parametrize('block_size', (1, 5, 256))
+@pytest.mark.parametrize('threshold', (None, 0.6, 0.9))
+def test_matrix(versions_corpus, block_size, threshold):
+    # matrices should be exactly what ranking and scoring every document would result in
+    assert list(score_matrix(versions_corpus, threshold=threshold, block_size=block_size)) == [
+        (identifier, list(score(versions_corpus, minhash, threshold=threshold)))
+        for identifier, minhash in versions_corpus.items()
+    ]
+    assert list(rank_matrix(versions_corpus, threshold=threshold, block_size=block_size)) == [
+        (identifier, rank(versions_corpus, minhash, threshold=threshold))
+        for identifier, minhash in versions_corpus.items()
+    ]
+
+
+def test_matrix_permutations():
+    # more permutations than fit a byte
+    condenser = Condenser(tokenizer=tokenize, normalizer=normalize, permutations=512)
+    corpus = {'data1': condenser.make_hash('some tokens'), 'data2': condenser.make_hash('some more tokens')}
+    assert list(score_matrix(corpus)) == [(identifier, list(score(corpus, minhash)))
+                                          for identifier, minhash in corpus.items()]
+    assert list(rank_matrix({})) == []
@@ -0,0 +1,169 @@
+import pytest
+
+from copietje import console
+from copietje.matching import match_numpy, match_selections
+from copietje.runs import create_schema, MatchRun
+
+
+def test_match_run(case_database):
+    assert MatchRun.resume(case_database, 0.5, 0.75) is None
+
+    run = MatchRun.start(case_database, 'numpy', 0.5, 0.75)
+    assert run.max_seq == 60
+    assert run.last_uid is None
+    run.checkpoint('doc-05-2')
+    case_database.commit()
+
+    # only an unfinished run with the same parameters is resumed
+    assert MatchRun.resume(case_database, 0.8, 0.75) is None
+    resumed = MatchRun.resume(case_database, 0.5, 0.75)
+    assert (resumed.run_id, resumed.max_seq, resumed.last_uid) == (run.run_id, 60, 'doc-05-2')
+
+    resumed.finish()
+    assert MatchRun.resume(case_database, 0.5, 0.75) is None
+    assert MatchRun.start(case_database, 'sqlite', 0.5, 0.75).run_id != run.run_id
+
+
+def test_create_schema(case_database):
+    # a runs table created before documents were given a sequence number
+    case_database.execute('CREATE TABLE runs (run_id INTEGER PRIMARY KEY, max_rowid INTEGER, since_run INTEGER)')
+    case_database.execute('INSERT INTO runs (max_rowid) VALUES (60)')
+
+    create_schema(case_database)
+    create_schema(case_database)
+    assert [tuple(row) for row in case_database.execute('SELECT run_id, max_seq FROM runs')] == [(1, 60)]
+
+
+def test_match_run_selection(case_database):
+    run = MatchRun.start(case_database, 'numpy', 0.5, 0.75)
+    expected = list(match_numpy(case_database))
+    # VACUUM is free to renumber the rowids of documents, that should not affect the documents of the run
+    case_database.execute('UPDATE documents SET rowid = rowid + 1000')
+    # documents downloaded after the run started are not part of it
+    case_database.execute("""
+        INSERT INTO documents (uid, path, stream, size, sha1, tags, privileged_status, minhash)
+        SELECT 'new-' || uid, path, stream, size, NULL, tags, privileged_status, minhash FROM documents
+    """)
+    assert list(match_numpy(case_database, selection=run.selections[0])) == expected
+
+    run.checkpoint(expected[3][0])
+    assert list(match_numpy(case_database, selection=run.selections[0])) == expected[4:]
+
+
+class Interrupted(Exception):
+    pass
+
+
+def interrupt_after(engine, num_results):
+    def interrupted(*args, **kwargs):
+        for num, result in enumerate(engine(*args, **kwargs)):
+            if num == num_results:
+                raise Interrupted()
+            yield result
+
+    return interrupted
+
+
+@pytest.mark.parametrize('engine', ('sqlite', 'numpy'))
+def test_match_resume(case_database, tmp_path, monkeypatch, engine):
+    expected = list(match_numpy(case_database))
+    case_database.commit()
+
+    match_engine = console.ENGINES[engine]
+    monkeypatch.setitem(console.ENGINES, engine, interrupt_after(match_engine, 5))
+    with pytest.raises(Interrupted):
+        console.match(database=tmp_path / 'case.db', engine=engine, output='database', checkpoint_interval=0.0)
+
+    # the matches of the documents before the interruption should have been stored
+    run = case_database.execute('SELECT run_id, last_uid, finished FROM runs').fetchone()
+    assert (run['last_uid'], run['finished']) == (expected[4][0], 0)
+
+    # resuming should continue after the checkpoint, without repeating stored matches
+    monkeypatch.setitem(console.ENGINES, engine, match_engine)
+    console.match(database=tmp_path / 'case.db', engine=engine, output='database')
+
+    assert case_database.execute('SELECT COUNT(*) FROM runs').fetchone()[0] == 1
+    rows = case_database.execute('SELECT query_uid, match_uid, similarity, run_id FROM matches ORDER BY rowid')
+    assert [tuple(row) for row in rows] == [(uid, match_uid, similarity, run['run_id'])
+                                            for uid, matches in expected
+                                            for similarity, match_uid in matches]
+
+    # the run has finished, a next match starts a new one
+    console.match(database=tmp_path / 'case.db', engine=engine, output='database', resume=False)
+    assert case_database.execute('SELECT COUNT(*) FROM runs').fetchone()[0] == 2
+
+
+def stored_matches(database, run_id):
+    rows = database.execute('SELECT query_uid, match_uid, similarity FROM matches WHERE run_id = ? ORDER BY rowid',
+                            (run_id,))
+    return [tuple(row) for row in rows]
+
+
+@pytest.mark.parametrize('engine', ('sqlite', 'numpy'))
+def test_match_incremental(case_database, tmp_path, engine):
+    case_database.commit()
+    # without a finished run to add to, an incremental run matches all documents
+    console.match(database=tmp_path / 'case.db', engine=engine, output='database', incremental=True)
+    first = case_database.execute('SELECT run_id, since_run FROM runs').fetchone()
+    assert first['since_run'] is None
+
+    labeled = {row['uid']
+               for row in case_database.execute('SELECT uid FROM documents WHERE privileged_status IS NOT NULL')}
+    case_database.executescript("""
+        UPDATE documents SET privileged_status = 'privileged' WHERE uid = 'doc-01-0';
+        UPDATE documents SET privileged_status = NULL WHERE uid = 'doc-02-0';
+        INSERT INTO documents (uid, path, stream, size, sha1, tags, privileged_status, minhash)
+        SELECT 'new-' || uid, path, stream, size, sha1, tags, privileged_status, minhash FROM documents
+        WHERE uid = 'doc-04-2';
+    """)
+    expected = []
+    for uid, matches in match_numpy(case_database):
+        # documents matched before are only matched to documents labeled since
+        if uid not in ('new-doc-04-2', 'doc-02-0'):
+            matches = [match for match in matches if match[1] not in labeled]
+        if matches:
+            expected.append((uid, matches))
+    assert expected
+
+    console.match(database=tmp_path / 'case.db', engine=engine, output='database', incremental=True)
+    second = case_database.execute('SELECT run_id, since_run, finished FROM runs WHERE run_id > ?',
+                                   (first['run_id'],)).fetchone()
+    assert (second['since_run'], second['finished']) == (first['run_id'], 1)
+    assert stored_matches(case_database, second['run_id']) == [(uid, match_uid, similarity)
+                                                               for uid, matches in expected
+                                                               for similarity, match_uid in matches]
+    # only the labels of the last run are kept to add to
+    assert {row['run_id'] for row in case_database.execute('SELECT run_id FROM run_labels')} == {second['run_id']}
+
+    # nothing changed since, nothing to match
+    console.match(database=tmp_path / 'case.db', engine=engine, output='database', incremental=True)
+    assert stored_matches(case_database, second['run_id'] + 1) == []
+
+
+def test_match_incremental_resume(case_database, tmp_path, monkeypatch):
+    case_database.commit()
+    console.match(database=tmp_path / 'case.db', engine='numpy', output='database')
+    case_database.execute("UPDATE documents SET privileged_status = 'privileged' WHERE uid LIKE 'doc-__-1'")
+    case_database.commit()
+
+    run = MatchRun.start(case_database, 'numpy', 0.5, 0.75, incremental=True)
+    expected = list(match_selections(match_numpy, case_database, 0.5, 0.75, run.selections))
+    assert len(expected) > 3
+    # forget about the run, the next one reuses its id
+    for table in ('runs', 'run_labels'):
+        case_database.execute(f'DELETE FROM {table} WHERE run_id = ?', (run.run_id,))
+    case_database.commit()
+
+    match_engine = console.ENGINES['numpy']
+    monkeypatch.setitem(console.ENGINES, 'numpy', interrupt_after(match_engine, 3))
+    with pytest.raises(Interrupted):
+        console.match(database=tmp_path / 'case.db', engine='numpy', output='database', incremental=True,
+                      checkpoint_interval=0.0)
+
+    # resuming continues the incremental run
+    monkeypatch.setitem(console.ENGINES, 'numpy', match_engine)
+    console.match(database=tmp_path / 'case.db', engine='numpy', output='database')
+    run_id = case_database.execute('SELECT MAX(run_id) FROM runs').fetchone()[0]
+    assert stored_matches(case_database, run_id) == [(uid, match_uid, similarity)
+                                                     for uid, matches in expected
+                                                     for similarity, match_uid in matches]
@@ -0,0 +1,148 @@
+from zipfile import ZipFile
+
+from datasketch import LeanMinHash
+import numpy as np
+import pytest
+
+from copietje import Condenser, HashIndex
+from copietje.sketches import LRUSketchStore, serialize, size_filter, SketchStore
+
+
+@pytest.fixture
+def hashvalues():
+    return np.random.default_rng(42).integers(0, 4, size=(10, 16), dtype=np.uint32)
+
+
+def test_sketch_store(hashvalues):
+    store = SketchStore(16, capacity=3)
+    for idx, values in enumerate(hashvalues):
+        store.add(f'doc-{idx}', values)
+
+    assert len(store) == 10
+    assert 'doc-3' in store
+    assert 'doc-10' not in store
+    assert store.uids.tolist() == [f'doc-{idx}' for idx in range(10)]
+    assert np.array_equal(store.hashvalues, hashvalues)
+    assert store.hashvalues.dtype == np.uint32
+    assert store.hashvalues.flags.c_contiguous
+
+    # adding a known uid replaces its hash values
+    store.add('doc-3', hashvalues[0])
+    assert len(store) == 10
+    assert np.array_equal(store['doc-3'], hashvalues[0])
+
+
+def test_lru_sketch_store(hashvalues):
+    store = LRUSketchStore(16, max_size=3)
+    store.extend(['doc-0', 'doc-1', 'doc-2'], hashvalues[:3])
+    # looking up doc-0 makes doc-1 the least recently used
+    assert store.lookup(['doc-0']) == [0]
+    store.add('doc-3', hashvalues[3])
+
+    assert len(store) == 3
+    assert set(store.uids) == {'doc-0', 'doc-2', 'doc-3'}
+    assert np.array_equal(store['doc-3'], hashvalues[3])
+    assert np.array_equal(store['doc-0'], hashvalues[0])
+    assert store.jaccard(hashvalues[3], store.lookup(['doc-3'])).tolist() == [1.0]
+
+
+def test_sketch_store_cardinalities(hashvalues):
+    store = SketchStore.from_blobs(['doc-0', 'doc-1', 'doc-2'], serialize(hashvalues[:3]), [3, None, 5])
+    assert store.cardinalities.tolist()[::2] == [3.0, 5.0]
+    assert np.isnan(store.cardinalities[1])
+
+    # cardinalities should survive the store growing, unknown cardinalities are NaN
+    store.add('doc-3', hashvalues[3], 7)
+    store.extend(['doc-4', 'doc-5'], hashvalues[4:6])
+    store.add('doc-1', hashvalues[1], 4)
+    assert store.cardinalities[:4].tolist() == [3.0, 4.0, 5.0, 7.0]
+    assert np.isnan(store.cardinalities[4:]).all()
+
+    lru_store = LRUSketchStore(16, max_size=2)
+    lru_store.extend(['doc-0', 'doc-1'], hashvalues[:2], [3, 4])
+    lru_store.add('doc-2', hashvalues[2], 5)
+    assert lru_store.cardinalities[lru_store.lookup(['doc-1', 'doc-2'])].tolist() == [4.0, 5.0]
+
+
+def test_size_filter():
+    cardinalities = np.array([10, 10, 7, 6, 20, 0, 0, np.nan, 10])
+    others = np.array([10, 7, 10, 10, 10, 0, 5, 1, np.nan])
+    # sets of 7 and 10 tokens could be exactly 0.7 similar, a set of 6 tokens can't be
+    assert size_filter(cardinalities, others, 0.7).tolist() == [True, True, True, False, False, True, False, True,
+                                                                True]
+    assert size_filter(cardinalities, others, 0.0).all()
+    # a single cardinality is compared to all others
+    assert size_filter(cardinalities[:1], others, 0.5).tolist() == [True, True, True, True, True, False, True, False,
+                                                                    True]
+
+
+def test_sketch_store_jaccard(hashvalues):
+    store = SketchStore.from_blobs([f'doc-{idx}' for idx in range(10)], serialize(hashvalues))
+    minhashes = [LeanMinHash(seed=1, hashvalues=values) for values in hashvalues]
+
+    expected = [minhashes[0].jaccard(minhash) for minhash in minhashes[3:]]
+    assert store.jaccard(0, range(3, 10)).tolist() == expected
+    assert store.jaccard(hashvalues[0], np.arange(3, 10)).tolist() == expected
+    assert store.jaccard(0, []).tolist() == []
+
+
+def test_hash_index(case_database, tmp_path):
+    case_database.execute('UPDATE documents SET tags = privileged_status')
+    with ZipFile(tmp_path / 'documents.zip', 'w'):
+        pass
+
+    index = HashIndex(Condenser(), case_database)
+    index.make_index(tmp_path / 'documents.zip')
+    assert len(index.sketches) == 10
+
+    results = list(index.query_index(tmp_path / 'documents.zip'))
+    assert results
+    for uid, matches in results:
+        query_hash = index.get_minhash(uid)
+        assert matches == sorted(((match_uid, query_hash.jaccard(index.get_minhash(match_uid)))
+                                  for match_uid, _ in matches), key=lambda match: match[1], reverse=True)
+        assert all(match_uid in index.sketches for match_uid, _ in matches)
+
+
+@pytest.mark.parametrize('max_sketches', (None, 3))
+def test_hash_index_queries(case_database, tmp_path, max_sketches):
+    case_database.execute('UPDATE documents SET tags = privileged_status')
+    with ZipFile(tmp_path / 'documents.zip', 'w'):
+        pass
+
+    expected = HashIndex(Condenser(), case_database)
+    expected.make_index(tmp_path / 'documents.zip')
+    expected = list(expected.query_index(tmp_path / 'documents.zip'))
+
+    index = HashIndex(Condenser(), case_database, max_sketches=max_sketches)
+    index.make_index(tmp_path / 'documents.zip')
+    assert len(index.sketches) == (max_sketches or 10)
+
+    statements = []
+    case_database.set_trace_callback(statements.append)
+    assert list(index.query_index(tmp_path / 'documents.zip')) == expected
+    case_database.set_trace_callback(None)
+
+    lookups = [statement for statement in statements if 'WHERE uid IN' in statement]
+    # at most a single lookup per query when not all sketches fit in memory, none otherwise
+    assert len(lookups) <= (len(expected) if max_sketches else 0)
+
+
+def test_hash_index_duplicates(case_database, tmp_path):
+    case_database.execute('UPDATE documents SET tags = privileged_status')
+    expected = HashIndex(Condenser(), case_database)
+    with ZipFile(tmp_path / 'documents.zip', 'w'):
+        pass
+    expected.make_index(tmp_path / 'documents.zip')
+    expected = list(expected.query_index(tmp_path / 'documents.zip'))
+
+    # the last version of every family is a copy of the second, its minhash should be taken from that copy rather
+    # than from a document that is not in the (empty) zip file
+    minhashes = dict(case_database.execute("SELECT uid, minhash FROM documents WHERE uid LIKE '%-4'").fetchall())
+    case_database.execute("UPDATE documents SET minhash = NULL WHERE uid LIKE '%-4'")
+
+    index = HashIndex(Condenser(), case_database)
+    index.make_index(tmp_path / 'documents.zip')
+    assert list(index.query_index(tmp_path / 'documents.zip')) == expected
+    rows = case_database.execute("SELECT uid, minhash FROM documents WHERE uid LIKE '%-4'").fetchall()
+    assert dict(rows) == minhashes
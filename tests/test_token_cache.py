@@ -0,0 +1,117 @@
+from concurrent.futures import ThreadPoolExecutor
+import pickle
+
+from datasketch.hashfunc import sha1_hash32
+import pytest
+
+from copietje import Condenser, HASH_FUNCTIONS
+from copietje.token_cache import ClockTokenCache, LRUTokenCache, TOKEN_CACHES
+
+
+class CountingHash:
+    def __init__(self, hash_func=sha1_hash32):
+        self.hash_func = hash_func
+        self.calls = 0
+
+    def __call__(self, data):
+        self.calls += 1
+        return self.hash_func(data)
+
+
+@pytest.mark.parametrize('policy', TOKEN_CACHES.keys())
+def test_token_cache(policy):
+    cache = TOKEN_CACHES[policy](sha1_hash32, max_size=3)
+
+    assert cache.hash_tokens(['a', 'b', 'a', 'c']) == [sha1_hash32(token.encode('utf-8')) for token in 'abac']
+    assert (cache.hits, cache.misses, cache.evictions, len(cache)) == (1, 3, 0, 3)
+
+    assert cache.hash_tokens(['d', 'é']) == [sha1_hash32('d'.encode('utf-8')), sha1_hash32('é'.encode('utf-8'))]
+    assert (cache.hits, cache.misses, cache.evictions, len(cache)) == (1, 5, 2, 3)
+    assert cache.hit_rate == pytest.approx(1 / 6)
+    assert cache.stats() == {'size': 3, 'hits': 1, 'misses': 5, 'evictions': 2, 'hit_rate': cache.hit_rate}
+
+
+def test_token_cache_size():
+    with pytest.raises(ValueError):
+        LRUTokenCache(sha1_hash32, max_size=0)
+
+
+def test_lru_token_cache():
+    hash_func = CountingHash()
+    cache = LRUTokenCache(hash_func, max_size=2)
+    cache.hash_tokens(['a', 'b', 'a'])
+    # b is the least recently used, evicted to make room for c
+    cache.hash_tokens(['c'])
+    assert list(cache.hashes) == ['a', 'c']
+
+    cache.hash_tokens(['a', 'c'])
+    assert hash_func.calls == 3
+
+
+def test_clock_token_cache():
+    hash_func = CountingHash()
+    cache = ClockTokenCache(hash_func, max_size=3)
+    cache.hash_tokens(['a', 'b', 'c', 'a'])
+    # a was referenced and gets a second chance, b was not and makes room for d
+    cache.hash_tokens(['d'])
+    assert set(cache.slots) == {'a', 'c', 'd'}
+    # the hand moved past a, clearing its reference, c is next in line
+    cache.hash_tokens(['e'])
+    assert set(cache.slots) == {'a', 'd', 'e'}
+
+    assert cache.hash_tokens(['a', 'd', 'e']) == [sha1_hash32(token.encode('utf-8')) for token in 'ade']
+    assert hash_func.calls == 5
+
+
+@pytest.mark.parametrize('policy', TOKEN_CACHES.keys())
+def test_token_cache_threads(policy):
+    cache = TOKEN_CACHES[policy](sha1_hash32, max_size=50)
+    tokens = [str(num % 80) for num in range(1000)]
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(cache.hash_tokens, [tokens] * 32))
+
+    expected = [sha1_hash32(token.encode('utf-8')) for token in tokens]
+    assert all(result == expected for result in results)
+    assert cache.hits + cache.misses == len(tokens) * 32
+
+
+@pytest.mark.parametrize('policy', TOKEN_CACHES.keys())
+def test_token_cache_pickle(policy):
+    cache = TOKEN_CACHES[policy](sha1_hash32, max_size=3)
+    cache.hash_tokens(['a', 'b'])
+
+    copy = pickle.loads(pickle.dumps(cache))
+    assert len(copy) == 2
+    assert copy.hash_tokens(['a', 'c']) == cache.hash_tokens(['a', 'c'])
+
+
+@pytest.mark.parametrize('policy', TOKEN_CACHES.keys())
+@pytest.mark.parametrize('tokenizer', ('ws', 'white-space-2-grams', '3-grams'))
+def test_condenser_token_cache(test_files, policy, tokenizer):
+    documents = [(test_files / 'data1').read_text(), (test_files / 'data2').read_text(), 'a a a b', '']
+    condenser = Condenser.from_spec(f'{tokenizer}:norm:mmh3:64')
+    expected = [condenser.make_hash(document).hashvalues.tolist() for document in documents]
+
+    cache = condenser.use_token_cache(max_size=16, policy=policy)
+    assert cache.hash_func is HASH_FUNCTIONS['mmh3']
+    assert [condenser.make_hash(document).hashvalues.tolist() for document in documents] == expected
+    assert condenser.make_hash_batch(documents).tolist() == expected
+    assert cache.hits > 0
+
+
+def test_condenser_hashes_vocabulary():
+    hash_func = CountingHash()
+    condenser = Condenser(hash_function=hash_func)
+    vocabulary = [f'token{num}' for num in range(100)]
+
+    # tokens are hashed once per document, regardless of how often they occur
+    condenser.make_hash(' '.join(vocabulary * 10))
+    assert hash_func.calls == 100
+
+    # and only once at all when cached
+    condenser.use_token_cache()
+    for _ in range(10):
+        condenser.make_hash(' '.join(vocabulary[::-1]))
+    assert hash_func.calls == 200
+    assert condenser.token_cache.hit_rate == pytest.approx(0.9)
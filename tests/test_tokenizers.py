@@ -1,7 +1,15 @@
+import numpy as np
 import pytest
 
-from copietje.tokenizers import (tokenize_split_sents,
+from copietje import tokenizers
+from copietje.tokenizers import (hash_char_n_grams,
+                                 hash_white_space_n_grams,
+                                 ROLLING_BASE,
+                                 tokenize_batch,
+                                 tokenize_split_sents,
+                                 tokenize_split_sents_batch,
                                  tokenize_split_words,
+                                 tokenize_split_words_batch,
                                  tokenize_white_space,
                                  tokenize_white_space_n_grams,
                                  tokenize_char_n_grams)
@@ -61,3 +69,72 @@ def test_tokenize_char_5_grams(example_sentence):
         'th me',
         'h me!'
     ]
+
+
+@pytest.fixture
+def documents(example_sentence):
+    return [example_sentence, '', 'Een zin. En nog een zin!', 'Dit is de derde, laatste zin. ' * 20]
+
+
+def test_tokenize_split_words_batch(spacy_model, documents):
+    expected = [list(tokenize_split_words(document)) for document in documents]
+    assert expected[0] == ['ABC', ',', 'sing', 'with', 'me', '!']
+    assert list(tokenize_split_words_batch(documents, batch_size=3)) == expected
+    assert list(tokenize_batch(tokenize_split_words, iter(documents), n_process=2, batch_size=2)) == expected
+
+
+def test_tokenize_split_sents_batch(spacy_model, documents):
+    expected = [list(tokenize_split_sents(document)) for document in documents]
+    assert expected[2] == ['Een zin.', 'En nog een zin!']
+    assert list(tokenize_split_sents_batch(documents, batch_size=3)) == expected
+    assert list(tokenize_batch(tokenize_split_sents, iter(documents), n_process=2, batch_size=2)) == expected
+
+
+def test_tokenize_batch(documents):
+    assert list(tokenize_batch(tokenize_white_space, documents)) == [document.split() for document in documents]
+
+
+def _polynomial_hash(values):
+    value = 0
+    for v in values:
+        value = (value * int(ROLLING_BASE) + v) % (1 << 32)
+    return value
+
+
+@pytest.mark.parametrize('data', ('', 'a', 'ABC, sing with me!', 'twee  woorden\n', 'één 😀\u3000drie\tvier vijf zes'))
+@pytest.mark.parametrize('n', (1, 2, 5))
+def test_hash_char_n_grams(data, n):
+    hashes = hash_char_n_grams(data, n)
+
+    assert hashes.dtype == np.uint32
+    assert hashes.tolist() == [_polynomial_hash(map(ord, token)) for token in tokenize_char_n_grams(data, n)]
+
+
+@pytest.mark.parametrize('data', ('', 'a', 'ABC, sing with me!', 'twee  woorden\n', 'één 😀\u3000drie\tvier vijf zes'))
+@pytest.mark.parametrize('n', (2, 3, 5))
+def test_hash_white_space_n_grams(data, n):
+    hashes = hash_white_space_n_grams(data, n)
+
+    assert hashes.dtype == np.uint32
+    # a hash of the hashes of the words in each n-gram
+    assert hashes.tolist() == [_polynomial_hash(_polynomial_hash(map(ord, word)) for word in token.split(' '))
+                               for token in tokenize_white_space_n_grams(data, n)]
+
+
+def test_hash_n_grams_distinct(test_files):
+    data = (test_files / 'data1').read_text() * 3 + 'ABC, sing with me!'
+    assert len(set(hash_char_n_grams(data, 5).tolist())) == len(set(tokenize_char_n_grams(data, 5)))
+    assert len(set(hash_white_space_n_grams(data, 3).tolist())) == len(set(tokenize_white_space_n_grams(data, 3)))
+
+
+def test_hash_n_grams_large(monkeypatch):
+    monkeypatch.setattr(tokenizers, 'MAX_CACHED_POWERS', 64)
+    tokenizers._cached_powers.cache_clear()
+    data = 'ABC, sing with me! ' * 10
+
+    hash_char_n_grams(data[:20], 5)
+    cached = tokenizers._cached_powers.cache_info().currsize
+    # the powers for texts longer than the cached powers are calculated without caching them
+    assert hash_char_n_grams(data, 5).tolist() == [_polynomial_hash(map(ord, token))
+                                                   for token in tokenize_char_n_grams(data, 5)]
+    assert tokenizers._cached_powers.cache_info().currsize == cached
@@ -0,0 +1,110 @@
+import pytest
+
+from copietje import Condenser
+from copietje.console import match
+from copietje.matching import match_numpy
+from copietje.ranking import full_jaccard_on_token_set
+from copietje.verification import ExactVerifier
+
+
+@pytest.fixture
+def texts(case_database, tmp_path):
+    """
+    The texts of the documents in the case database, written to the paths
+    stored with them.
+    """
+    rows = case_database.execute('SELECT uid, path FROM documents').fetchall()
+    texts = {}
+    for uid, path in rows:
+        family, version = map(int, uid.split('-')[1:])
+        # the last version of every family is an exact copy of the second
+        version = 1 if version == 4 else version
+        # every version replaces 4 more words of the first version, making versions 0.67, 0.43 and 0.25 similar to it
+        texts[uid] = ' '.join(f'v{version}f{family}w{idx}' if idx < version * 4 else f'f{family}w{idx}'
+                              for idx in range(20))
+
+    for uid, path in rows:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text(texts[uid])
+        case_database.execute('UPDATE documents SET path = ? WHERE uid = ?', (str(tmp_path / path), uid))
+
+    case_database.commit()
+    return texts
+
+
+def exact(texts, uid, match_uid):
+    condenser = Condenser()
+    return full_jaccard_on_token_set(condenser.make_token_set(texts[uid]), condenser.make_token_set(texts[match_uid]))
+
+
+def test_verify(case_database, texts):
+    verifier = ExactVerifier(case_database, Condenser(), threshold=0.5, margin=1.0)
+    estimated = dict(match_numpy(case_database, threshold=verifier.engine_threshold))
+    verified = dict(verifier.verify(match_numpy(case_database, threshold=verifier.engine_threshold)))
+
+    # all matches are borderline with a margin of 1.0, their similarities should be the exact ones
+    assert verified
+    for uid, matches in verified.items():
+        assert matches == sorted(matches, reverse=True)
+        assert {match_uid for _, match_uid in matches} <= {match_uid for _, match_uid in estimated[uid]}
+        for similarity, match_uid in matches:
+            assert similarity == pytest.approx(exact(texts, uid, match_uid))
+            assert similarity >= 0.5
+
+    # matches that turn out to be less than threshold similar should have been left out
+    for uid, matches in estimated.items():
+        for _, match_uid in matches:
+            if exact(texts, uid, match_uid) < 0.5:
+                assert match_uid not in {match_uid for _, match_uid in verified.get(uid, [])}
+    assert verifier.num_verified == sum(len(matches) for matches in estimated.values())
+
+
+def test_verify_margin(case_database, texts):
+    # nothing is borderline with a margin of 0.0 unless estimated at exactly the threshold
+    verifier = ExactVerifier(case_database, Condenser(), threshold=0.5, margin=0.0)
+    expected = [(uid, matches) for uid, matches in match_numpy(case_database, threshold=0.5)
+                if all(similarity != 0.5 for similarity, _ in matches)]
+    verified = list(verifier.verify(expected))
+    assert verified == expected
+    assert verifier.num_verified == 0
+
+
+def test_verify_missing_file(case_database, texts, tmp_path):
+    verifier = ExactVerifier(case_database, Condenser(), threshold=0.5, margin=1.0)
+    # the estimated similarity should be kept for matches that can't be verified
+    (tmp_path / '00' / '0.txt').unlink()
+    results = [('doc-00-1', [(0.75, 'doc-00-0'), (0.6, 'doc-01-0')])]
+    assert list(verifier.verify(results)) == [('doc-00-1', [(0.75, 'doc-00-0')])]
+    assert verifier.num_verified == 1
+
+
+@pytest.mark.parametrize('path', (None, ''))
+def test_verify_missing_path(case_database, texts, path):
+    case_database.execute('UPDATE documents SET path = ? WHERE uid = ?', (path, 'doc-00-0'))
+    verifier = ExactVerifier(case_database, Condenser(), threshold=0.5, margin=1.0)
+    # a document without a path is handled like a missing file, for both the query and its candidates
+    results = [('doc-00-1', [(0.75, 'doc-00-0'), (0.6, 'doc-01-0')]), ('doc-00-0', [(0.75, 'doc-00-1')])]
+    assert list(verifier.verify(results)) == [('doc-00-1', [(0.75, 'doc-00-0')]), ('doc-00-0', [(0.75, 'doc-00-1')])]
+    assert verifier.num_verified == 1
+
+
+def test_verify_jobs(case_database, texts):
+    results = list(match_numpy(case_database, threshold=0.25))
+    verified = list(ExactVerifier(case_database, Condenser(), 0.5, margin=0.25).verify(results))
+    assert list(ExactVerifier(case_database, Condenser(), 0.5, margin=0.25, jobs=2).verify(results)) == verified
+
+
+@pytest.mark.parametrize('engine', ('sqlite', 'numpy'))
+def test_match_verify(case_database, texts, tmp_path, engine):
+    verifier = ExactVerifier(case_database, Condenser(), threshold=0.5)
+    expected = list(verifier.verify(match_numpy(case_database, threshold=verifier.engine_threshold)))
+
+    match(database=tmp_path / 'case.db', engine=engine, output='database', verify='exact')
+    rows = case_database.execute("""
+        SELECT query_uid, match_uid, similarity FROM matches
+        WHERE run_id = (SELECT MAX(run_id) FROM runs)
+        ORDER BY rowid
+    """).fetchall()
+    assert [tuple(row) for row in rows] == [(uid, match_uid, similarity)
+                                            for uid, matches in expected
+                                            for similarity, match_uid in matches]